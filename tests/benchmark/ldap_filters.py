@@ -0,0 +1,148 @@
+"""
+Compare the building of LDAP filters for large group lists, by the character-by-character
+escaping and per-group concatenation the LDAP connector used to do, with its translation-table
+escaping and filter templates.
+
+    python tests/benchmark/ldap_filters.py --groups 100000
+
+Both ways are checked to build the same filters before they are timed.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import six
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector
+
+GROUP_FILTER_FORMAT = six.text_type('(&(|(objectCategory=group)(objectClass=groupOfNames)(objectClass=posixGroup))'
+                                    '(cn={group}))')
+GROUP_MEMBER_FILTER_FORMAT = six.text_type('(memberOf={group_dn})')
+ALL_USERS_FILTER = six.text_type('(&(objectClass=user)(objectCategory=person)'
+                                 '(!(userAccountControl:1.2.840.113556.1.4.803:=2)))')
+
+
+def legacy_format_ldap_query_string(query, **kwargs):
+    escape_chars = six.text_type('*()\\&|<>~!:')
+    escaped_args = {}
+    for k, v in six.iteritems(kwargs):
+        escaped_list = []
+        for c in v:
+            if c in escape_chars:
+                replace = six.text_type(hex(ord(c))).replace('0x', '\\')
+                escaped_list.append(replace)
+            else:
+                escaped_list.append(c)
+        escaped_args[k] = six.text_type('').join(escaped_list)
+    return query.format(**escaped_args)
+
+
+def legacy_parenthesize(filter_string):
+    if not filter_string.startswith('('):
+        filter_string = six.text_type('(') + filter_string + six.text_type(')')
+    return filter_string
+
+
+def legacy_group_batch_filter(groups):
+    return six.text_type('(|') + six.text_type('').join(
+        legacy_parenthesize(legacy_format_ldap_query_string(GROUP_FILTER_FORMAT, group=group))
+        for group in groups) + six.text_type(')')
+
+
+def legacy_group_user_filters(group_dns):
+    filters = []
+    for group_dn in group_dns:
+        group_member_subfilter = legacy_format_ldap_query_string(GROUP_MEMBER_FILTER_FORMAT, group_dn=group_dn)
+        group_member_subfilter = legacy_parenthesize(group_member_subfilter)
+        user_subfilter = legacy_parenthesize(ALL_USERS_FILTER)
+        filters.append(six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')'))
+    return filters
+
+
+def make_connector():
+    """
+    A connector with just the options that filter building uses (it isn't connected to a directory).
+    """
+    connector = LDAPDirectoryConnector.__new__(LDAPDirectoryConnector)
+    connector.options = {
+        'group_filter_format': GROUP_FILTER_FORMAT,
+        'group_member_filter_format': GROUP_MEMBER_FILTER_FORMAT,
+        'all_users_filter': ALL_USERS_FILTER,
+    }
+    connector.group_user_filter_format = None
+    return connector
+
+
+def group_batch_filter(groups):
+    format_group_filter = LDAPDirectoryConnector.parenthesize(GROUP_FILTER_FORMAT).format
+    escape = LDAPDirectoryConnector.escape_ldap_value
+    return six.text_type('(|') + six.text_type('').join(
+        format_group_filter(group=escape(group)) for group in groups) + six.text_type(')')
+
+
+def make_groups(group_count):
+    """
+    Group names, a tenth of which have special characters, and the DNs of the groups.
+    """
+    groups = []
+    for i in range(group_count):
+        if i % 10 == 0:
+            groups.append(six.text_type('Team (%d) R&D: *all*') % i)
+        else:
+            groups.append(six.text_type('Directory Group %d') % i)
+    group_dns = [six.text_type('CN=%s,OU=Groups,DC=example,DC=com') % group.replace(',', '\\,')
+                 for group in groups]
+    return groups, group_dns
+
+
+def run_benchmark(group_count, repeat=3):
+    """
+    :return: dict with, for each kind of filter, the best time of each way of building it
+    """
+    groups, group_dns = make_groups(group_count)
+    connector = make_connector()
+    assert legacy_group_batch_filter(groups) == group_batch_filter(groups)
+    assert legacy_group_user_filters(group_dns) == [connector.format_group_user_filter(dn) for dn in group_dns]
+
+    def best(function):
+        return min(timeit.repeat(function, number=1, repeat=repeat))
+
+    return {
+        'query string': {
+            'legacy': best(lambda: [legacy_format_ldap_query_string(GROUP_FILTER_FORMAT, group=group)
+                                    for group in groups]),
+            'current': best(lambda: [LDAPDirectoryConnector.format_ldap_query_string(GROUP_FILTER_FORMAT,
+                                                                                    group=group)
+                                     for group in groups]),
+        },
+        'group batch filter': {
+            'legacy': best(lambda: legacy_group_batch_filter(groups)),
+            'current': best(lambda: group_batch_filter(groups)),
+        },
+        'group user filters': {
+            'legacy': best(lambda: legacy_group_user_filters(group_dns)),
+            'current': best(lambda: [connector.format_group_user_filter(dn) for dn in group_dns]),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--groups', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.groups, args.repeat)
+    print('%d groups' % args.groups)
+    print('%-20s %10s %10s %8s' % ('filter', 'legacy', 'current', 'speedup'))
+    for name in ('query string', 'group batch filter', 'group user filters'):
+        result = results[name]
+        print('%-20s %10.3f %10.3f %7.1fx' % (name, result['legacy'], result['current'],
+                                              result['legacy'] / result['current']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Benchmark the rule processor against synthetic directory and Adobe organizations.
+
+    python tests/benchmark/rule_processor.py --users 300000 --groups 200 --secondaries 2
+
+Fake directory and umapi connectors serve generated users to RuleProcessor.run, and
+the time and peak memory of each phase of the run are reported.  Timings come from
+a run without memory tracing; peak memory comes from a second, traced run
+(using tracemalloc, which is not available in Python 2).
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from user_sync.connector.helper import create_blank_user
+from user_sync.rules import AdobeGroup, RuleProcessor, UmapiConnectors
+
+PHASES = ('read_desired_user_groups', 'update_umapi_users_for_connector', 'manage_strays')
+
+IDENTITY_TYPES = ('federatedID', 'enterpriseID', 'adobeID')
+
+
+class SyntheticOrgs(object):
+    """
+    Generates a directory, the primary Adobe org that mirrors it, and any number of secondary orgs.
+    Generation is deterministic for a given seed, so every run sees the same users.
+    """
+
+    def __init__(self, users=1000, groups=50, groups_per_user=3, unmapped_groups_per_user=2,
+                 identity_types=IDENTITY_TYPES, secondaries=0, stray_ratio=0.05, new_ratio=0.05,
+                 change_ratio=0.1, seed=1):
+        self.user_count = users
+        self.group_count = groups
+        self.groups_per_user = min(groups_per_user, groups)
+        self.unmapped_groups_per_user = unmapped_groups_per_user
+        self.identity_types = identity_types
+        self.secondary_names = ['org%d' % i for i in range(secondaries)]
+        self.stray_ratio = stray_ratio
+        self.new_ratio = new_ratio
+        self.change_ratio = change_ratio
+        self.seed = seed
+
+    def make_mappings(self):
+        """
+        Map each directory group to a primary group, and to a group in one of the secondaries (if any).
+        :rtype dict(str, list(AdobeGroup))
+        """
+        mappings = {}
+        for j in range(self.group_count):
+            adobe_groups = [AdobeGroup.create('Adobe Group %d' % j)]
+            if self.secondary_names:
+                secondary_name = self.secondary_names[j % len(self.secondary_names)]
+                adobe_groups.append(AdobeGroup.create('%s::Adobe Group %d' % (secondary_name, j)))
+            mappings['Directory Group %d' % j] = adobe_groups
+        return mappings
+
+    def make_users(self):
+        """
+        :return: the directory users, and the Adobe users of each org (by umapi name, with None for the primary)
+        """
+        rng = random.Random(self.seed)
+        directory_users = []
+        umapi_users = dict((name, []) for name in [None] + self.secondary_names)
+        for i in range(self.user_count):
+            identity_type = self.identity_types[i % len(self.identity_types)]
+            email = 'user%d@example.com' % i
+            group_ids = rng.sample(range(self.group_count), self.groups_per_user)
+            user = create_blank_user()
+            user['identity_type'] = identity_type
+            user['email'] = user['username'] = email
+            user['domain'] = 'example.com'
+            user['firstname'] = 'Given%d' % i
+            user['lastname'] = 'Surname%d' % i
+            user['country'] = 'US'
+            user['groups'] = ['Directory Group %d' % j for j in group_ids]
+            user['source_attributes'] = {'email': email, 'givenName': user['firstname'], 'sn': user['lastname']}
+            directory_users.append(user)
+            if rng.random() < self.new_ratio:
+                continue
+            if rng.random() < self.change_ratio:
+                # the user's Adobe groups are out of date
+                group_ids[0] = (group_ids[0] + 1) % self.group_count
+            unmapped = ['Profile %d' % rng.randrange(100) for _ in range(self.unmapped_groups_per_user)]
+            umapi_users[None].append(self.make_umapi_user(identity_type, email, group_ids, unmapped))
+            for k, secondary_name in enumerate(self.secondary_names):
+                secondary_ids = [j for j in group_ids if j % len(self.secondary_names) == k]
+                if secondary_ids:
+                    umapi_users[secondary_name].append(self.make_umapi_user(identity_type, email, secondary_ids, []))
+        for i in range(int(self.user_count * self.stray_ratio)):
+            group_ids = rng.sample(range(self.group_count), self.groups_per_user)
+            umapi_users[None].append(self.make_umapi_user('federatedID', 'stray%d@example.com' % i, group_ids, []))
+        return directory_users, umapi_users
+
+    @staticmethod
+    def make_umapi_user(identity_type, email, group_ids, unmapped_groups):
+        return {
+            'email': email,
+            'status': 'active',
+            'username': email,
+            'domain': 'example.com',
+            'firstname': 'Given',
+            'lastname': 'Surname',
+            'country': 'US',
+            'type': identity_type,
+            'groups': ['Adobe Group %d' % j for j in group_ids] + unmapped_groups,
+        }
+
+
+class FakeDirectoryConnector(object):
+    def __init__(self, users):
+        self.users = users
+
+    def load_users_and_groups(self, groups, extended_attributes=None, all_users=True):
+        return iter(self.users)
+
+
+class FakeActionManager(object):
+    def __init__(self):
+        self.action_count = 0
+
+    def flush(self):
+        pass
+
+    def has_work(self):
+        return False
+
+    def get_statistics(self):
+        return self.action_count, 0
+
+
+class FakeUmapiConnector(object):
+    def __init__(self, users):
+        self.users = users
+        self.action_manager = FakeActionManager()
+
+    def prefetch_users(self):
+        pass
+
+    def stop_prefetch(self):
+        pass
+
+    def iter_users(self):
+        return iter(self.users)
+
+    def get_user_cache(self):
+        return None
+
+    def save_user_cache(self):
+        pass
+
+    def get_action_manager(self):
+        return self.action_manager
+
+    def send_commands(self, commands, callback=None, user_key=None):
+        if len(commands) > 0:
+            self.action_manager.action_count += 1
+
+
+class PhaseRecorder(object):
+    """
+    Wraps the phase methods of a rule processor, to accumulate the time spent in each,
+    and (if tracing) the highest memory use above what was in use when the phase started.
+    """
+
+    def __init__(self, processor, trace_memory):
+        self.trace_memory = trace_memory
+        self.results = dict((phase, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0}) for phase in PHASES)
+        for phase in PHASES:
+            setattr(processor, phase, self.wrap(phase, getattr(processor, phase)))
+
+    def wrap(self, phase, method):
+        result = self.results[phase]
+
+        def recorded(*args, **kwargs):
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+                start_bytes = tracemalloc.get_traced_memory()[0]
+            start = timeit.default_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                result['seconds'] += timeit.default_timer() - start
+                result['calls'] += 1
+                if self.trace_memory:
+                    peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+                    result['peak_bytes'] = max(result['peak_bytes'], peak_bytes)
+        return recorded
+
+
+def run_benchmark(orgs, trace_memory=False):
+    """
+    Do one full run of the rule processor against the synthetic orgs.
+    :type orgs: SyntheticOrgs
+    :type trace_memory: bool
+    :return: dict with results by phase, the total time of the run, and the action counts by org
+    """
+    if trace_memory and not hasattr(tracemalloc, 'reset_peak'):
+        raise RuntimeError('Tracing memory needs Python 3.9 or later')
+    AdobeGroup.index_map.clear()
+    mappings = orgs.make_mappings()
+    directory_users, umapi_users = orgs.make_users()
+    primary = FakeUmapiConnector(umapi_users[None])
+    secondaries = dict((name, FakeUmapiConnector(umapi_users[name])) for name in orgs.secondary_names)
+    processor = RuleProcessor({
+        'process_groups': True,
+        'remove_strays': True,
+        'max_adobe_only_users': len(umapi_users[None]),
+    })
+    recorder = PhaseRecorder(processor, trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = timeit.default_timer()
+        processor.run(mappings, FakeDirectoryConnector(directory_users), UmapiConnectors(primary, secondaries))
+        total_seconds = timeit.default_timer() - start
+        total_peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    actions = dict((name, connector.action_manager.action_count) for name, connector in secondaries.items())
+    actions['primary'] = primary.action_manager.action_count
+    return {
+        'phases': recorder.results,
+        'total_seconds': total_seconds,
+        'total_peak_bytes': total_peak_bytes,
+        'actions': actions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=100, help='number of mapped directory groups')
+    parser.add_argument('--groups-per-user', type=int, default=5)
+    parser.add_argument('--unmapped-groups-per-user', type=int, default=5,
+                        help='number of Adobe groups per user that are not mapped')
+    parser.add_argument('--identity-types', default=','.join(IDENTITY_TYPES),
+                        help='comma-separated identity types, assigned to users in turn')
+    parser.add_argument('--secondaries', type=int, default=0)
+    parser.add_argument('--stray-ratio', type=float, default=0.05, help='Adobe-only users, per directory user')
+    parser.add_argument('--new-ratio', type=float, default=0.05, help='directory users not yet in Adobe')
+    parser.add_argument('--change-ratio', type=float, default=0.1, help='Adobe users with out-of-date groups')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-memory', action='store_true', help="don't do the traced run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('processor').setLevel(logging.WARNING)
+    orgs = SyntheticOrgs(users=args.users, groups=args.groups, groups_per_user=args.groups_per_user,
+                         unmapped_groups_per_user=args.unmapped_groups_per_user,
+                         identity_types=args.identity_types.split(','), secondaries=args.secondaries,
+                         stray_ratio=args.stray_ratio, new_ratio=args.new_ratio, change_ratio=args.change_ratio,
+                         seed=args.seed)
+    timed = run_benchmark(orgs)
+    traced = None
+    if not args.skip_memory and hasattr(tracemalloc, 'reset_peak'):
+        traced = run_benchmark(orgs, trace_memory=True)
+
+    print('%d directory users, %d groups, %d secondaries; actions: %s' %
+          (args.users, args.groups, args.secondaries,
+           ', '.join('%s %d' % item for item in sorted(timed['actions'].items()))))
+    print('%-34s %6s %10s %12s' % ('phase', 'calls', 'seconds', 'peak MB'))
+    for phase in PHASES:
+        result = timed['phases'][phase]
+        peak = '%12.1f' % (traced['phases'][phase]['peak_bytes'] / 1e6) if traced else '%12s' % 'n/a'
+        print('%-34s %6d %10.3f %s' % (phase, result['calls'], result['seconds'], peak))
+    peak = '%12.1f' % (traced['total_peak_bytes'] / 1e6) if traced else '%12s' % 'n/a'
+    print('%-34s %6s %10.3f %s' % ('total (RuleProcessor.run)', '', timed['total_seconds'], peak))
+
+
+if __name__ == '__main__':
+    main()
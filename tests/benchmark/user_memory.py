@@ -0,0 +1,99 @@
+"""
+Compare the resident memory of directory users held as plain dicts (as they used to be)
+with that of the slotted DirectoryUser records the connectors now create.
+
+    python tests/benchmark/user_memory.py [user_count]
+
+Each kind of record is measured in a fresh interpreter, so the numbers don't affect each other.
+Both kinds are filled with the same values in the same way (the source attributes are not copied
+for either), so the difference is down to the records alone.
+"""
+import gc
+import subprocess
+import sys
+import os
+
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from user_sync.connector.helper import create_blank_user
+
+
+def create_dict_user():
+    return {
+        "identity_type": None,
+        "username": None,
+        "domain": None,
+        "firstname": None,
+        "lastname": None,
+        "email": None,
+        "groups": [],
+        "country": None,
+    }
+
+
+def make_users(create_user, user_count):
+    users = {}
+    for i in range(user_count):
+        email = u'user%d@example.com' % i
+        user = create_user()
+        source_attributes = {
+            'email': email,
+            'identity_type': None,
+            'username': None,
+            'domain': None,
+            'givenName': u'Given%d' % i,
+            'sn': u'Surname%d' % i,
+            'c': u'US',
+        }
+        user['email'] = email
+        user['identity_type'] = 'federatedID'
+        user['username'] = email
+        user['domain'] = u'example.com'
+        user['firstname'] = source_attributes['givenName']
+        user['lastname'] = source_attributes['sn']
+        user['country'] = source_attributes['c']
+        user['member_groups'] = []
+        user['groups'].append(u'Group %d' % (i % 50))
+        user['source_attributes'] = source_attributes
+        users[u'federatedID,%s,' % email] = user
+    return users
+
+
+def measure(kind, user_count):
+    """
+    :return: the growth in resident memory (bytes) from creating the users
+    """
+    process = psutil.Process()
+    gc.collect()
+    before = process.memory_info().rss
+    users = make_users(create_dict_user if kind == 'dict' else create_blank_user, user_count)
+    gc.collect()
+    after = process.memory_info().rss
+    assert len(users) == user_count
+    return after - before
+
+
+def main():
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    results = {}
+    for kind in ('dict', 'slots'):
+        output = subprocess.check_output([sys.executable, __file__, '--measure', kind, str(user_count)])
+        results[kind] = int(output.strip())
+    print('%d users' % user_count)
+    for kind in ('dict', 'slots'):
+        print('  %-6s %8.1f MB  %6d bytes/user' % (kind, results[kind] / 1e6, results[kind] // user_count))
+    print('  saved  %7.1f%%' % (100.0 * (results['dict'] - results['slots']) / results['dict']))
+    # the records themselves account for all of the difference: the values they hold are the same for both
+    dict_user = make_users(create_dict_user, 1).popitem()[1]
+    slots_user = make_users(create_blank_user, 1).popitem()[1]
+    print('  record: dict %d bytes, slots %d bytes (source_attributes %d bytes in both)' % (
+        sys.getsizeof(dict_user), sys.getsizeof(slots_user), sys.getsizeof(slots_user['source_attributes'])))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        print(measure(sys.argv[2], int(sys.argv[3])))
+    else:
+        main()
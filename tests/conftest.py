@@ -1,9 +1,21 @@
 import os
 import pytest
 
+from umapi_server import UmapiStandIn
+
 
 @pytest.fixture
 def fixture_dir():
     return os.path.abspath(
            os.path.join(
              os.path.dirname(__file__), 'fixture'))
+
+
+@pytest.fixture
+def umapi_stand_in(monkeypatch):
+    """A running UMAPI stand-in with an empty org; umapi connections made during the test go to it over http."""
+    monkeypatch.setenv('UMAPI_MOCK', 'playback')
+    stand_in = UmapiStandIn()
+    stand_in.start()
+    yield stand_in
+    stand_in.stop()
@@ -0,0 +1,309 @@
+"""
+A local stand-in for the Okta API, for testing the Okta connector without an Okta org.
+
+    python tests/okta_server.py --users 5000 --groups 20 --latency 0.05 --rate-limit 100
+
+It serves enough of /api/v1 for the connector to list groups (all of them, those whose names
+start with q, or those updated since a lastUpdated filter), page through their members, and
+read the users and System Log events since a given time, with "next" links in the Link header of each page, as Okta does.  Every response carries the
+X-Rate-Limit headers of a fixed window (of window_seconds); once the window's requests are used
+up, further requests are refused with 429 until it resets.
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+
+from six.moves.urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+from umapi_server import RequestHandler, ThreadingHTTPServer
+
+
+class OktaStandIn(object):
+    """
+    An in-memory Okta org served over http on a local port.  Users and groups are held in the form the
+    API returns them, and group members as lists of user ids, by group id.
+
+    Every request counts towards the statistics in self.stats.
+    """
+
+    def __init__(self, users=(), groups=(), page_size=200, latency=0.0, rate_limit=0, window_seconds=60):
+        """
+        :param users: Okta user dicts to start with
+        :param groups: tuples of a group name and the ids of its members
+        :param page_size: maximum number of objects in a page (whatever larger limit is asked for)
+        :param latency: seconds to wait before answering each request
+        :param rate_limit: requests allowed in each window (0 for no limit)
+        :type window_seconds: float
+        """
+        self.lock = threading.Lock()
+        self.user_by_id = dict((user['id'], user) for user in users)
+        self.group_by_id = {}
+        self.member_ids_by_group_id = {}
+        # System Log events, oldest first
+        self.events = []
+        for name, member_ids in groups:
+            self.add_group(name, member_ids)
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window_seconds = window_seconds
+        self.window_end = 0
+        self.window_requests = 0
+        self.active = 0
+        self.stats = {
+            'requests': 0,
+            'throttled': 0,
+            'max_concurrent': 0,
+            'group_searches': 0,
+            'member_pages': 0,
+            'user_pages': 0,
+            'log_pages': 0,
+        }
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def make_user(user_id, email, status='ACTIVE', **profile):
+        """
+        :return: an Okta user, with the given email as its login, and any other profile attributes given
+        """
+        user_profile = {'login': email, 'email': email, 'firstName': None, 'lastName': None}
+        user_profile.update(profile)
+        return {
+            'id': user_id,
+            'status': status,
+            'created': '2018-01-01T00:00:00.000Z',
+            'lastUpdated': '2018-01-01T00:00:00.000Z',
+            'profile': user_profile,
+        }
+
+    def add_user(self, user):
+        with self.lock:
+            self.user_by_id[user['id']] = user
+
+    def add_group(self, name, member_ids=()):
+        """
+        :return: the id of the new group
+        """
+        group_id = '00g%06d' % (len(self.member_ids_by_group_id) + 1)
+        self.group_by_id[group_id] = {'id': group_id, 'type': 'OKTA_GROUP', 'lastUpdated': self.get_timestamp(),
+                                      'profile': {'name': name}}
+        self.member_ids_by_group_id[group_id] = list(member_ids)
+        return group_id
+
+    def rename_group(self, group_id, name):
+        with self.lock:
+            group = self.group_by_id[group_id]
+            group['profile']['name'] = name
+            group['lastUpdated'] = self.get_timestamp()
+
+    def delete_group(self, group_id):
+        with self.lock:
+            del self.group_by_id[group_id]
+            self.add_event('group.lifecycle.delete', group_id=group_id)
+
+    def update_user(self, user_id, status=None, **profile):
+        with self.lock:
+            user = self.user_by_id[user_id]
+            if status is not None:
+                user['status'] = status
+            user['profile'].update(profile)
+            user['lastUpdated'] = self.get_timestamp()
+
+    def delete_user(self, user_id):
+        with self.lock:
+            del self.user_by_id[user_id]
+            for member_ids in self.member_ids_by_group_id.values():
+                if user_id in member_ids:
+                    member_ids.remove(user_id)
+            self.add_event('user.lifecycle.delete.completed', user_id=user_id)
+
+    def add_member(self, group_id, user_id):
+        with self.lock:
+            self.member_ids_by_group_id[group_id].append(user_id)
+            self.add_event('group.user_membership.add', user_id=user_id, group_id=group_id)
+
+    def remove_member(self, group_id, user_id):
+        with self.lock:
+            self.member_ids_by_group_id[group_id].remove(user_id)
+            self.add_event('group.user_membership.remove', user_id=user_id, group_id=group_id)
+
+    def add_event(self, event_type, user_id=None, group_id=None):
+        """
+        Log an event, as the System Log does, with the user and group it is about as its targets.
+        """
+        targets = []
+        if user_id is not None:
+            targets.append({'id': user_id, 'type': 'User'})
+        if group_id is not None:
+            targets.append({'id': group_id, 'type': 'UserGroup'})
+        self.events.append({
+            'uuid': 'event-%06d' % (len(self.events) + 1),
+            'published': self.get_timestamp(),
+            'eventType': event_type,
+            'outcome': {'result': 'SUCCESS'},
+            'target': targets,
+        })
+
+    @staticmethod
+    def get_timestamp():
+        """
+        :return: the time now, in the form of Okta's created and lastUpdated times
+        """
+        now = time.time()
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)) + '.%03dZ' % (now * 1000 % 1000)
+
+    def start(self, port=0):
+        """
+        Start serving on a local port (any free one by default).
+        :return: the url to read the API from (without the /api/v1 path)
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.stand_in = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='okta-stand-in')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.get_url()
+
+    def get_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def handle(self, method, path, body):
+        """
+        :return: tuple of the http status, a dict of extra headers, and the content to be sent as json
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            now = time.time()
+            if now >= self.window_end:
+                self.window_end = now + self.window_seconds
+                self.window_requests = 0
+            self.window_requests += 1
+            throttled = self.rate_limit and self.window_requests > self.rate_limit
+            headers = {}
+            if self.rate_limit:
+                headers = {
+                    'X-Rate-Limit-Limit': str(self.rate_limit),
+                    'X-Rate-Limit-Remaining': str(max(self.rate_limit - self.window_requests, 0)),
+                    'X-Rate-Limit-Reset': '%.3f' % self.window_end,
+                }
+            if throttled:
+                self.stats['throttled'] += 1
+            else:
+                self.active += 1
+                self.stats['max_concurrent'] = max(self.stats['max_concurrent'], self.active)
+        if throttled:
+            return 429, headers, {'errorCode': 'E0000047', 'errorSummary': 'API call exceeded rate limit'}
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            url = urlparse(path)
+            route = [unquote(part) for part in url.path.split('/')[1:]]
+            query = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+            with self.lock:
+                if method == 'GET' and route == ['api', 'v1', 'groups']:
+                    self.stats['group_searches'] += 1
+                    name_prefix = query.get('q', '').lower()
+                    groups = [group for _, group in sorted(self.group_by_id.items())
+                              if group['profile']['name'].lower().startswith(name_prefix)]
+                    if 'filter' in query:
+                        # only the filter the connector uses: lastUpdated gt "<time>"
+                        match = re.match(r'^lastUpdated gt "([^"]+)"$', query['filter'])
+                        if not match:
+                            return 400, headers, {'errorCode': 'E0000031', 'errorSummary': 'Invalid search criteria.'}
+                        groups = [group for group in groups if group['lastUpdated'] > match.group(1)]
+                    return self.get_page(url.path, query, groups, headers)
+                if method == 'GET' and len(route) == 5 and route[:3] == ['api', 'v1', 'groups'] and \
+                        route[4] == 'users':
+                    if route[3] not in self.group_by_id:
+                        return 404, headers, {'errorCode': 'E0000007', 'errorSummary': 'Not found: Resource'}
+                    self.stats['member_pages'] += 1
+                    members = [self.user_by_id[user_id] for user_id in self.member_ids_by_group_id[route[3]]
+                               if user_id in self.user_by_id]
+                    return self.get_page(url.path, query, members, headers)
+                if method == 'GET' and route == ['api', 'v1', 'users']:
+                    self.stats['user_pages'] += 1
+                    users = [user for _, user in sorted(self.user_by_id.items())]
+                    if 'search' in query:
+                        # only the search the connector uses: lastUpdated gt "<time>"
+                        match = re.match(r'^lastUpdated gt "([^"]+)"$', query['search'])
+                        if not match:
+                            return 400, headers, {'errorCode': 'E0000031', 'errorSummary': 'Invalid search criteria.'}
+                        users = [user for user in users if user['lastUpdated'] > match.group(1)]
+                    return self.get_page(url.path, query, users, headers)
+                if method == 'GET' and len(route) == 4 and route[:3] == ['api', 'v1', 'users']:
+                    if route[3] not in self.user_by_id:
+                        return 404, headers, {'errorCode': 'E0000007', 'errorSummary': 'Not found: Resource'}
+                    return 200, headers, self.user_by_id[route[3]]
+                if method == 'GET' and route == ['api', 'v1', 'logs']:
+                    self.stats['log_pages'] += 1
+                    # the filter can only be on event types: eventType eq "<type>" or ...
+                    event_types = re.findall(r'eventType eq "([^"]+)"', query.get('filter', ''))
+                    events = [event for event in self.events
+                              if query.get('since', '') <= event['published'] < query.get('until', '~') and
+                              (not event_types or event['eventType'] in event_types)]
+                    return self.get_page(url.path, query, events, headers, id_key='uuid')
+            return 404, headers, {'errorCode': 'E0000022', 'errorSummary': 'The endpoint does not support the '
+                                                                           'provided HTTP method'}
+        finally:
+            if not throttled:
+                with self.lock:
+                    self.active -= 1
+
+    def get_page(self, path, query, objects, headers, id_key='id'):
+        """
+        :return: the page of objects after the one whose id (the value of id_key) is the "after" query value,
+        with a link to the next page if there is one
+        """
+        limit = min(int(query.get('limit', self.page_size)), self.page_size)
+        start = 0
+        if 'after' in query:
+            ids = [obj[id_key] for obj in objects]
+            start = ids.index(query['after']) + 1 if query['after'] in ids else len(ids)
+        page = objects[start:start + limit]
+        if start + limit < len(objects):
+            next_query = dict(query, after=page[-1][id_key], limit=str(limit))
+            headers = dict(headers, Link='<%s%s?%s>; rel="next"' % (self.get_url(), path, urlencode(next_query)))
+        return 200, headers, page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=10, help='each user is in one group, in turn')
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests allowed per window')
+    parser.add_argument('--window-seconds', type=float, default=60)
+    args = parser.parse_args()
+
+    users = [OktaStandIn.make_user('00u%06d' % i, 'user%d@example.com' % i, countryCode='US')
+             for i in range(args.users)]
+    groups = [('Group %d' % j, [user['id'] for i, user in enumerate(users) if i % args.groups == j])
+              for j in range(args.groups)]
+    stand_in = OktaStandIn(users, groups, page_size=args.page_size, latency=args.latency,
+                           rate_limit=args.rate_limit, window_seconds=args.window_seconds)
+    stand_in.start(args.port)
+    print('Serving %d users in %d groups at %s/api/v1' % (args.users, args.groups, stand_in.get_url()))
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(stand_in.stats, sort_keys=True))
+    except KeyboardInterrupt:
+        stand_in.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
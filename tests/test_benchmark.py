@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmark'))
+
+from rule_processor import PHASES, SyntheticOrgs, run_benchmark
+
+
+def test_rule_processor_benchmark_runs():
+    orgs = SyntheticOrgs(users=300, groups=20, secondaries=2, stray_ratio=0.1, new_ratio=0.1, change_ratio=0.2)
+    results = run_benchmark(orgs)
+    assert all(results['phases'][phase]['calls'] > 0 for phase in PHASES)
+    assert results['phases']['update_umapi_users_for_connector']['calls'] == 3
+    # creates, group changes and stray removals were all sent
+    assert results['actions']['primary'] > 300 * (0.1 + 0.1)
+    assert results['actions']['org0'] > 0
+
+
+def test_ldap_filters_benchmark_runs():
+    pytest.importorskip('ldap')
+    from ldap_filters import run_benchmark as run_ldap_filters_benchmark
+    results = run_ldap_filters_benchmark(200, repeat=1)
+    assert set(results) == {'query string', 'group batch filter', 'group user filters'}
@@ -0,0 +1,83 @@
+import pytest
+
+from user_sync.connector.helper import DirectoryUser, create_blank_user
+
+
+def test_directory_user_acts_like_dict():
+    user = create_blank_user()
+    user['email'] = 'user@example.com'
+    user['groups'].append('group')
+    assert user['email'] == 'user@example.com'
+    assert 'member_groups' not in user
+    assert user.get('member_groups', []) == []
+    with pytest.raises(KeyError):
+        user['member_groups']
+
+    # keys that aren't fields are kept too
+    user.update({'firstname': 'First', 'employee_id': '1234'})
+    assert user['employee_id'] == '1234'
+    assert user.to_dict() == {
+        'identity_type': None, 'username': None, 'domain': None, 'firstname': 'First', 'lastname': None,
+        'email': 'user@example.com', 'groups': ['group'], 'country': None, 'employee_id': '1234',
+    }
+    assert user == DirectoryUser(user.to_dict())
+    assert user.pop('employee_id') == '1234'
+    assert 'employee_id' not in user
+    assert not hasattr(user, '__dict__')
+
+
+def test_directory_user_round_trips_through_dict():
+    user = create_blank_user()
+    user.update(email='user@example.com', source_attributes={'mail': 'user@example.com'}, uid='00u1')
+    user['employee_id'] = '1234'
+    as_dict = user.to_dict()
+    assert type(as_dict) is dict
+    assert as_dict['uid'] == '00u1'
+    assert as_dict['employee_id'] == '1234'
+    assert DirectoryUser(as_dict).to_dict() == as_dict
+    assert DirectoryUser(as_dict) == user
+    assert sorted(DirectoryUser(as_dict)) == sorted(as_dict)
+
+
+def test_directory_user_keeps_keys_that_are_not_fields():
+    user = create_blank_user()
+    # every key the connectors set is a field, so no dict is made for other keys
+    user.update(email='user@example.com', member_groups=[], source_attributes={}, uid=None)
+    assert user._extra is None
+    user['employee_id'] = '1234'
+    assert user._extra == {'employee_id': '1234'}
+    assert 'employee_id' in user
+    assert 'employee_id' in user.keys()
+    assert len(user) == 12
+    del user['employee_id']
+    assert 'employee_id' not in user
+    with pytest.raises(KeyError):
+        del user['employee_id']
+
+
+def test_directory_user_in_and_get():
+    user = DirectoryUser(email='user@example.com')
+    assert 'email' in user
+    assert 'username' not in user
+    assert 'no_such_key' not in user
+    assert user.get('email') == 'user@example.com'
+    assert user.get('username') is None
+    assert user.get('no_such_key', 'default') == 'default'
+    # a field that is set to None is still there
+    user['username'] = None
+    assert 'username' in user
+    assert user.get('username', 'default') is None
+
+
+def test_directory_user_copy_is_shallow():
+    user = create_blank_user()
+    user['groups'].append('group')
+    user['employee_id'] = '1234'
+    copy = user.copy()
+    assert isinstance(copy, DirectoryUser)
+    assert copy == user
+    copy['email'] = 'other@example.com'
+    copy['employee_id'] = '5678'
+    assert user['email'] is None
+    assert user['employee_id'] == '1234'
+    assert copy['groups'] is user['groups']
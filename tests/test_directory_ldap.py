@@ -0,0 +1,772 @@
+import re
+import threading
+import time
+import traceback
+
+import pytest
+
+ldap = pytest.importorskip('ldap')
+
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector
+from user_sync.error import AssertionException
+
+
+class FakeLDAPConnection(object):
+    """
+    Serves a small directory, given as a dict of entries by DN (each a dict of attribute values, as lists of
+    bytes), with filters matched well enough for these tests.  Each search's results are sent a message at a
+    time: a message for each entry found, then the message that ends the search, with paged searches sent a
+    page at a time.  Messages for several searches are interleaved.  Every search it is asked to do is recorded,
+    and every change made with modify (or add or delete) moves the directory's highestCommittedUSN on.
+    If on_search is set, it is called with the filter of each search (and can delay or fail it).  A base search of
+    a DN in errors fails with the error given for it.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.on_search = None
+        self.errors = {}
+        self.usn = max([int(entry['uSNChanged'][0]) for entry in entries.values() if 'uSNChanged' in entry] + [0])
+        self.searches = []
+        self.search_bases = []
+        self.max_outstanding = 0
+        self.messages = []
+        self.abandoned = []
+        self.next_msgid = 1
+        self.last_msgid = None
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, username, password):
+        pass
+
+    def add(self, entry_dn, attributes):
+        self.entries[entry_dn] = {}
+        self.modify(entry_dn, attributes)
+
+    def modify(self, entry_dn, attributes):
+        self.usn += 1
+        self.entries[entry_dn].update(attributes)
+        self.entries[entry_dn]['uSNChanged'] = [str(self.usn).encode()]
+
+    def delete(self, entry_dn):
+        self.usn += 1
+        del self.entries[entry_dn]
+
+    def search_ext(self, base_dn, scope, filterstr='(objectClass=*)', attrlist=None, serverctrls=None):
+        if self.on_search:
+            self.on_search(filterstr)
+        self.searches.append(filterstr)
+        self.search_bases.append(base_dn)
+        msgid = self.next_msgid
+        self.next_msgid += 1
+        if base_dn == '' and scope == ldap.SCOPE_BASE:
+            entries = [('', {'objectClass': [b'top'], 'highestCommittedUSN': [str(self.usn).encode()],
+                             'namingContexts': [b'dc=example,dc=com']})]
+        elif scope == ldap.SCOPE_BASE and base_dn in self.errors:
+            self.messages.append((None, self.errors[base_dn], msgid, []))
+            return msgid
+        elif scope == ldap.SCOPE_BASE:
+            entry = self.find_entry(base_dn)
+            if entry is None:
+                self.messages.append((None, ldap.NO_SUCH_OBJECT(base_dn), msgid, []))
+                return msgid
+            entries = [(base_dn, entry)]
+        else:
+            entries = [(entry_dn, entry) for entry_dn, entry in sorted(self.entries.items())
+                       if entry_dn.lower().endswith(base_dn.lower())]
+        matches = self.parse_filter(filterstr)
+        rows = [(entry_dn, self.select(entry, attrlist)) for entry_dn, entry in entries if matches(entry)]
+        page_controls = [c for c in serverctrls or []
+                         if c.controlType == ldap.controls.libldap.SimplePagedResultsControl.controlType]
+        response_controls = []
+        if page_controls:
+            start = int(page_controls[0].cookie or 0)
+            end = start + page_controls[0].size
+            cookie = str(end) if end < len(rows) else ''
+            rows = rows[start:end]
+            response_controls = [ldap.controls.libldap.SimplePagedResultsControl(True, size=0, cookie=cookie)]
+        for row in rows:
+            self.messages.append((ldap.RES_SEARCH_ENTRY, [row], msgid, []))
+        self.messages.append((ldap.RES_SEARCH_RESULT, [], msgid, response_controls))
+        self.max_outstanding = max(self.max_outstanding, len(set(m[2] for m in self.messages)))
+        return msgid
+
+    def search(self, base_dn, scope, filterstr='(objectClass=*)', attrlist=None):
+        return self.search_ext(base_dn, scope, filterstr=filterstr, attrlist=attrlist)
+
+    def search_s(self, base_dn, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        return self.result2(self.search(base_dn, scope, filterstr=filterstr, attrlist=attrlist))[1]
+
+    def result3(self, msgid=ldap.RES_ANY, all=1):
+        rows = []
+        while True:
+            result_type, data, rmsgid, controls = self.take_message(msgid)
+            if result_type is None:
+                raise data
+            if not all:
+                return result_type, data, rmsgid, controls
+            rows.extend(data)
+            if result_type == ldap.RES_SEARCH_RESULT:
+                return result_type, rows, rmsgid, controls
+            msgid = rmsgid
+
+    def result2(self, msgid=ldap.RES_ANY, all=1):
+        return self.result3(msgid, all)[:3]
+
+    def take_message(self, msgid):
+        """
+        :return: the next message of the search, or with RES_ANY the next message of a different search from
+        the last one (if there is one), so that searches are interleaved
+        """
+        if msgid == ldap.RES_ANY:
+            candidates = [m for m in self.messages if m[2] != self.last_msgid] or self.messages
+        else:
+            candidates = [m for m in self.messages if m[2] == msgid]
+        message = candidates[0]
+        self.messages.remove(message)
+        self.last_msgid = message[2]
+        return message
+
+    def abandon(self, msgid):
+        self.abandoned.append(msgid)
+        self.messages = [m for m in self.messages if m[2] != msgid]
+
+    def find_entry(self, entry_dn):
+        for other_dn, entry in self.entries.items():
+            if other_dn.lower() == entry_dn.lower():
+                return entry
+        return None
+
+    @staticmethod
+    def select(entry, attrlist):
+        if attrlist is None:
+            return dict(entry)
+        names = set(name.lower() for name in attrlist)
+        return dict((name, values) for name, values in entry.items() if name.lower() in names)
+
+    def get_values(self, entry, name):
+        return [value.decode('utf-8') for key, values in entry.items() if key.lower() == name.lower()
+                for value in values]
+
+    def parse_filter(self, filter_string):
+        """
+        :return: a function that tells whether an entry matches the filter (which may use &, |, !, =, >=,
+        presence, substrings, and the in-chain matching rule for memberOf)
+        """
+        position = [0]
+
+        def parse():
+            assert filter_string[position[0]] == '('
+            position[0] += 1
+            operator = filter_string[position[0]]
+            if operator in '&|!':
+                position[0] += 1
+                terms = []
+                while filter_string[position[0]] == '(':
+                    terms.append(parse())
+                position[0] += 1
+                if operator == '&':
+                    return lambda entry: all(term(entry) for term in terms)
+                if operator == '|':
+                    return lambda entry: any(term(entry) for term in terms)
+                return lambda entry: not terms[0](entry)
+            end = filter_string.index(')', position[0])
+            name, operator, value = re.match(r'([^=<>:]+)(:[0-9.]+:=|>=|=)(.*)$',
+                                             filter_string[position[0]:end]).groups()
+            position[0] = end + 1
+            value = re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+            if operator == '>=':
+                key = int if value.isdigit() else str
+                return lambda entry: any(key(v) >= key(value) for v in self.get_values(entry, name))
+            if operator == ':1.2.840.113556.1.4.1941:=':
+                return lambda entry: value.lower() in self.get_group_chain(entry, name)
+            if value == '*':
+                return lambda entry: bool(self.get_values(entry, name))
+            pattern = re.compile('^' + '.*'.join(re.escape(part) for part in value.split('*')) + '$', re.I)
+            return lambda entry: any(pattern.match(v) for v in self.get_values(entry, name))
+
+        return parse()
+
+    def get_group_chain(self, entry, name):
+        chain = set()
+        values = self.get_values(entry, name)
+        while values:
+            value = values.pop().lower()
+            if value not in chain:
+                chain.add(value)
+                values.extend(self.get_values(self.find_entry(value) or {}, name))
+        return chain
+
+
+def make_directory():
+    """
+    :return: ten users and three groups, with each user a member of some of the groups (named in the member
+    values of the groups, and the memberOf values of the users)
+    """
+    entries = {}
+    groups = ['group0', 'group1', 'group2']
+    for j, group in enumerate(groups):
+        entries['cn=%s,dc=example,dc=com' % group] = {
+            'objectClass': [b'group'],
+            'cn': [group.encode()],
+            'member': [('cn=user%d,dc=example,dc=com' % i).encode() for i in range(10) if i % (j + 2) == 0],
+            'uSNChanged': [str(j + 1).encode()],
+        }
+    for i in range(10):
+        entries['cn=user%d,dc=example,dc=com' % i] = {
+            'objectClass': [b'person'],
+            'mail': [('user%d@example.com' % i).encode()],
+            'givenName': [b'User'],
+            'sn': [str(i).encode()],
+            'c': [b'us'],
+            'memberOf': [('cn=group%d,dc=example,dc=com' % j).encode() for j in range(3) if i % (j + 2) == 0],
+            'uSNChanged': [str(i + 10).encode()],
+        }
+    return entries, groups
+
+
+def make_connector(monkeypatch, connection, worker_connections=(), **options):
+    """
+    :param worker_connections: the connections of the search workers (max_search_workers of them, if more than 1)
+    """
+    connections = iter([connection] + list(worker_connections))
+    monkeypatch.setattr(ldap, 'initialize', lambda *args, **kwargs: next(connections))
+    connector_options = {
+        'host': 'ldap://ldap.example.com',
+        'username': 'reader',
+        'password': 'password',
+        'base_dn': 'dc=example,dc=com',
+        'all_users_filter': '(objectClass=person)',
+        'group_filter_format': '(cn={group})',
+        'user_identity_type': 'federatedID',
+    }
+    connector_options.update(options)
+    return LDAPDirectoryConnector(connector_options)
+
+
+def test_all_users_are_searched_for_once(monkeypatch):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection)
+    loaded = dict((user['email'], sorted(user['groups']))
+                  for user in connector.load_users_and_groups(groups, [], True))
+
+    assert len(loaded) == 10
+    assert loaded['user0@example.com'] == ['group0', 'group1', 'group2']
+    assert loaded['user1@example.com'] == []
+    assert loaded['user6@example.com'] == ['group0', 'group1']
+    # one search finds all the group DNs, one reads all the users, and one per group finds its members
+    assert len(connection.searches) == 1 + 1 + len(groups)
+    assert sum(1 for filter_string in connection.searches if filter_string == '(objectClass=person)') == 1
+
+
+def test_users_with_groups_from_member_of_are_streamed(monkeypatch):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection, groups_from_member_of=True)
+    loaded_users = connector.load_users_and_groups(groups, [], True)
+    first_user = next(loaded_users)
+
+    # the first user comes complete from the all-users search, with no group searches to wait for
+    assert first_user['email'] == 'user0@example.com'
+    assert sorted(first_user['groups']) == ['group0', 'group1', 'group2']
+    assert len(connection.searches) == 2
+    assert len(list(loaded_users)) == 9
+    assert len(connection.searches) == 2
+
+
+def load_user_groups(connector, groups, all_users=True):
+    return dict((user['email'], sorted(user['groups']))
+                for user in connector.load_users_and_groups(groups, [], all_users))
+
+
+def test_incremental_sync_reads_only_changed_users(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json')}}
+    first_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    assert len(first_run) == 10
+    assert '(objectClass=person)' in connection.searches
+
+    connection.modify('cn=user3,dc=example,dc=com', {'mail': [b'renamed3@example.com']})
+    connection.modify('cn=user4,dc=example,dc=com', {'objectClass': [b'contact']})
+    connection.add('cn=user10,dc=example,dc=com', {'objectClass': [b'person'], 'mail': [b'user10@example.com'],
+                                                    'givenName': [b'User'], 'sn': [b'10'], 'c': [b'us']})
+    connection.modify('cn=group0,dc=example,dc=com', {'description': [b'changed']})
+    del connection.searches[:]
+    second_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+
+    # only the entries changed since the mark are read, and those that are no longer users are dropped
+    assert '(objectClass=person)' not in connection.searches
+    assert '(uSNChanged>=20)' in connection.searches
+    assert '(&(objectClass=person)(uSNChanged>=20))' in connection.searches
+    assert second_run['renamed3@example.com'] == ['group1']
+    assert second_run['user10@example.com'] == []
+    assert 'user3@example.com' not in second_run
+    assert 'user4@example.com' not in second_run
+    assert second_run['user6@example.com'] == first_run['user6@example.com']
+    assert len(second_run) == 10
+
+
+def test_incremental_sync_with_timestamps_reads_changes_again(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    for i in range(10):
+        entries['cn=user%d,dc=example,dc=com' % i]['modifyTimestamp'] = [('201801011200%02d.0Z' % i).encode()]
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json'), 'change_attribute': 'modifyTimestamp'}}
+    load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    # a change committed while the users were being read, with a timestamp before the latest one read
+    connection.modify('cn=user2,dc=example,dc=com', {'mail': [b'renamed2@example.com'],
+                                                     'modifyTimestamp': [b'20180101120005.0Z']})
+    del connection.searches[:]
+    second_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+
+    # changes are read from a while before the latest timestamp read last time
+    assert '(modifyTimestamp>=20180101115509Z)' in connection.searches
+    assert second_run['renamed2@example.com'] == ['group0']
+    assert 'user2@example.com' not in second_run
+    assert len(second_run) == 10
+
+
+def test_incremental_sync_drops_deleted_users_on_full_refresh(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json'), 'full_refresh_hours': 1}}
+    load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    connection.delete('cn=user5,dc=example,dc=com')
+
+    # a deleted entry can't be found by its change, so it stays until the snapshot is rebuilt
+    assert 'user5@example.com' in load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 3601)
+    del connection.searches[:]
+    refreshed = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    assert '(objectClass=person)' in connection.searches
+    assert 'user5@example.com' not in refreshed
+    assert len(refreshed) == 9
+
+
+def test_incremental_sync_prunes_deleted_users_when_listing_member_of(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json')}, 'groups_from_member_of': True}
+    load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    connection.delete('cn=user5,dc=example,dc=com')
+    del connection.searches[:]
+    second_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+
+    # the memberOf values of every user are listed anyway, which finds the deleted user
+    assert connection.searches.count('(objectClass=person)') == 1
+    assert 'user5@example.com' not in second_run
+    assert len(second_run) == 9
+
+
+def test_incremental_sync_rereads_all_users_when_settings_change(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json')}}
+    load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    del connection.searches[:]
+    options['user_username_format'] = '{cn}'
+    loaded = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    assert '(objectClass=person)' in connection.searches
+    assert len(loaded) == 10
+
+
+def test_incremental_sync_yields_only_group_members_without_all_users(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json')}}
+    loaded = load_user_groups(make_connector(monkeypatch, connection, **options), groups, all_users=False)
+    assert sorted(loaded) == ['user%d@example.com' % i for i in (0, 2, 3, 4, 6, 8, 9)]
+    assert all(loaded.values())
+
+
+def make_worker_connections(entries, count):
+    return [FakeLDAPConnection(entries) for _ in range(count)]
+
+
+def test_search_workers_yield_groups_in_order(monkeypatch):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    workers = make_worker_connections(entries, 3)
+    # the first group's search is the slowest, so the others finish first
+    for worker in workers:
+        worker.on_search = lambda filter_string: time.sleep(0.1) if 'group0' in filter_string else None
+    connector = make_connector(monkeypatch, connection, workers, max_search_workers=3)
+    searches = list(connector.iter_group_member_searches(groups, []))
+
+    assert [group for group, _, _ in searches] == groups
+    assert [len(members) for _, _, members in searches] == [5, 4, 3]
+    # the main connection only found the group DNs, and each group was searched on a worker connection
+    assert connection.searches == ['(|(cn=group0)(cn=group1)(cn=group2))']
+    assert sorted(search for worker in workers for search in worker.searches) == [
+        '(&(memberOf=cn=group%d,dc=example,dc=com)(objectClass=person))' % i for i in range(3)]
+    loaded = load_user_groups(connector, groups)
+    assert loaded['user0@example.com'] == ['group0', 'group1', 'group2']
+
+
+def test_search_worker_errors_are_raised_in_order(monkeypatch):
+    entries, groups = make_directory()
+    workers = make_worker_connections(entries, 2)
+
+    def fail_group1(filter_string):
+        if 'group1' in filter_string:
+            raise ldap.NO_SUCH_OBJECT('group1')
+
+    for worker in workers:
+        worker.on_search = fail_group1
+    connector = make_connector(monkeypatch, FakeLDAPConnection(entries), workers, max_search_workers=2)
+    searches = connector.iter_group_member_searches(groups, [])
+    assert next(searches)[0] == 'group0'
+    with pytest.raises(AssertionException) as error:
+        next(searches)
+    assert 'Unexpected LDAP failure reading group members' in str(error.value)
+    # the traceback is the worker's, from where the error was raised
+    assert 'in run_worker' in ''.join(traceback.format_tb(error.tb))
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('ldap-search-')]
+
+
+def test_search_workers_stop_when_results_are_abandoned(monkeypatch):
+    entries, _ = make_directory()
+    groups = ['group%d' % (i % 3) for i in range(30)]
+    workers = make_worker_connections(entries, 2)
+    connector = make_connector(monkeypatch, FakeLDAPConnection(entries), workers, max_search_workers=2)
+    connector.max_held_group_results = 4
+    searches = connector.iter_group_member_searches(groups, [])
+    next(searches)
+    time.sleep(0.1)
+    # the workers have stopped short of the end, with at most 4 groups held (and one more started)
+    assert sum(len(worker.searches) for worker in workers) <= 6
+    searches.close()
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('ldap-search-')]
+    assert sum(len(worker.searches) for worker in workers) < len(groups)
+
+
+def test_groups_from_member_of_match_group_searches(monkeypatch):
+    entries, groups = make_directory()
+    # memberOf values needn't be written the way the group DNs are
+    entries['cn=user6,dc=example,dc=com']['memberOf'] = [b'CN=group0,DC=example,DC=com',
+                                                         b'cn=Group1,dc=Example,dc=com']
+    searched = load_user_groups(make_connector(monkeypatch, FakeLDAPConnection(entries)), groups)
+    connection = FakeLDAPConnection(entries)
+    single_pass = load_user_groups(make_connector(monkeypatch, connection, groups_from_member_of=True), groups)
+
+    assert single_pass == searched
+    assert single_pass['user6@example.com'] == ['group0', 'group1']
+    # one search finds the group DNs, and one reads every user with their groups
+    assert len(connection.searches) == 2
+
+
+def test_groups_from_member_of_with_snapshot(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    options = {'incremental_sync': {'state_path': str(tmp_path / 'users.json')}, 'groups_from_member_of': True}
+    first_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+    assert first_run == load_user_groups(make_connector(monkeypatch, FakeLDAPConnection(entries)), groups)
+
+    # in Active Directory, a change of membership changes the group's entry, but not the member's
+    connection.modify('cn=group0,dc=example,dc=com', {'member': [b'cn=user1,dc=example,dc=com']})
+    entries['cn=user1,dc=example,dc=com']['memberOf'].append(b'cn=group0,dc=example,dc=com')
+    for i in (0, 2, 4, 6, 8):
+        entries['cn=user%d,dc=example,dc=com' % i]['memberOf'].remove(b'cn=group0,dc=example,dc=com')
+    connection.modify('cn=user3,dc=example,dc=com', {'mail': [b'renamed3@example.com']})
+    del connection.searches[:]
+    second_run = load_user_groups(make_connector(monkeypatch, connection, **options), groups)
+
+    assert second_run == load_user_groups(make_connector(monkeypatch, FakeLDAPConnection(entries)), groups)
+    assert second_run['user1@example.com'] == ['group0']
+    assert second_run['user0@example.com'] == ['group1', 'group2']
+    assert second_run['renamed3@example.com'] == ['group1']
+    # no group is searched for its members, and the users are listed once, for their memberOf values
+    assert not [search for search in connection.searches if search.startswith('(&(memberOf')]
+    assert connection.searches.count('(objectClass=person)') == 1
+
+
+def add_groups(entries, names):
+    for name in names:
+        entries['cn=%s,ou=groups,dc=example,dc=com' % name] = {'objectClass': [b'group'], 'cn': [name.encode()]}
+
+
+def test_group_dns_are_found_in_batches(monkeypatch):
+    entries, _ = make_directory()
+    groups = ['team %d' % i for i in range(5)] + ['a*b (c)']
+    add_groups(entries, groups)
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection)
+    connector.group_lookup_batch_size = 4
+    group_dn_by_name = connector.find_ldap_group_dns(groups + ['missing', 'team 0'])
+
+    assert group_dn_by_name == dict((group, 'cn=%s,ou=groups,dc=example,dc=com' % group) for group in groups)
+    # each batch is one search, with the group names escaped
+    assert connection.searches == ['(|(cn=team 0)(cn=team 1)(cn=team 2)(cn=team 3))',
+                                   '(|(cn=team 4)(cn=a\\2ab \\28c\\29)(cn=missing))']
+
+
+def test_group_dns_of_names_differing_in_case(monkeypatch, caplog):
+    entries, _ = make_directory()
+    add_groups(entries, ['Sales'])
+    connector = make_connector(monkeypatch, FakeLDAPConnection(entries))
+    group_dn_by_name = connector.find_ldap_group_dns(['Sales', 'sales'])
+
+    # the directory doesn't tell names apart by case, so both are the same group
+    assert group_dn_by_name == {'Sales': 'cn=Sales,ou=groups,dc=example,dc=com',
+                                'sales': 'cn=Sales,ou=groups,dc=example,dc=com'}
+    assert 'differ only in case' in caplog.text
+    add_groups(entries, ['SALES'])
+    with pytest.raises(AssertionException):
+        connector.find_ldap_group_dns(['sales'])
+
+
+def test_group_dn_cache(monkeypatch, tmp_path):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    cache_options = {'group_dn_cache': {'path': str(tmp_path / 'groups.json'), 'max_age_hours': 1}}
+    connector = make_connector(monkeypatch, connection, **cache_options)
+    assert sorted(connector.find_ldap_group_dns(groups)) == groups
+    assert len(connection.searches) == 1
+
+    # a cached DN is used by later runs, and only the groups that aren't cached are looked for
+    connector = make_connector(monkeypatch, connection, **cache_options)
+    add_groups(entries, ['group3'])
+    assert sorted(connector.find_ldap_group_dns(groups + ['group3'])) == groups + ['group3']
+    assert connection.searches[1:] == ['(|(cn=group3))']
+
+    # the cache is dropped if the settings change, and each DN is looked for again once it's too old
+    connector = make_connector(monkeypatch, connection, group_filter_format='(&(objectClass=group)(cn={group}))',
+                               **cache_options)
+    connector.find_ldap_group_dns(groups)
+    assert len(connection.searches) == 3
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 3601)
+    connector = make_connector(monkeypatch, connection, group_filter_format='(&(objectClass=group)(cn={group}))',
+                               **cache_options)
+    connector.find_ldap_group_dns(groups)
+    assert len(connection.searches) == 4
+
+
+def test_members_are_read_with_pipelined_base_searches(monkeypatch):
+    entries, groups = make_directory()
+    # a member that isn't a user, listed by two groups
+    for group in ('group0', 'group1'):
+        entries['cn=%s,dc=example,dc=com' % group]['member'].append(b'cn=group2,dc=example,dc=com')
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection, two_steps_lookup={'group_member_attribute_name': 'member'})
+    connector.member_lookup_pipeline_size = 2
+    loaded = load_user_groups(connector, groups, all_users=False)
+
+    assert sorted(loaded) == ['user%d@example.com' % i for i in (0, 2, 3, 4, 6, 8, 9)]
+    assert loaded['user0@example.com'] == ['group0', 'group1', 'group2']
+    # each member is searched for once, however many groups list it, and so is the member that isn't a user
+    member_searches = [base for base, filter_string in zip(connection.search_bases, connection.searches)
+                       if filter_string == '(objectClass=person)']
+    assert sorted(member_searches) == sorted(set(member_searches))
+    assert len(member_searches) == 8
+    assert 'cn=group2,dc=example,dc=com' in member_searches
+    assert 'cn=group2,dc=example,dc=com' in connector.non_user_dns
+    # two searches are sent before waiting for the first result, and no more
+    assert connection.max_outstanding == 2
+
+
+def test_base_searches_are_abandoned(monkeypatch):
+    entries, _ = make_directory()
+    user_dns = ['cn=user%d,dc=example,dc=com' % i for i in range(6)]
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection)
+    connector.member_lookup_pipeline_size = 3
+    results = connector.iter_base_search_results(user_dns, '(objectClass=person)', ['mail'])
+    assert next(results)[0] == user_dns[0]
+    results.close()
+    assert connection.abandoned == [2, 3]
+
+    # on an error, the searches still waiting for their results are abandoned too
+    result2 = connection.result2
+
+    def fail_second_result(msgid, all=1):
+        if msgid == 6:
+            raise RuntimeError('connection lost')
+        return result2(msgid, all)
+
+    connection.result2 = fail_second_result
+    del connection.abandoned[:]
+    with pytest.raises(RuntimeError):
+        list(connector.iter_base_search_results(user_dns, '(objectClass=person)', ['mail']))
+    assert connection.abandoned == [7, 8]
+
+
+def make_nested_directory():
+    """
+    :return: users in groups that are nested in a loop (outer > middle > inner > outer), and another group that
+    has the middle group as a member
+    """
+    member_names = {
+        'outer': ['user0', 'middle'],
+        'middle': ['user1', 'inner'],
+        'inner': ['user2', 'outer'],
+        'other': ['user3', 'middle'],
+    }
+    entries = {}
+    for i in range(4):
+        entries['cn=user%d,dc=example,dc=com' % i] = {
+            'objectClass': [b'person'],
+            'mail': [('user%d@example.com' % i).encode()],
+            'givenName': [b'User'],
+            'sn': [str(i).encode()],
+            'c': [b'us'],
+        }
+    for group in member_names:
+        entries['cn=%s,dc=example,dc=com' % group] = {'objectClass': [b'group'], 'cn': [group.encode()]}
+    for group, names in member_names.items():
+        group_dn = ('cn=%s,dc=example,dc=com' % group).encode()
+        entries[group_dn.decode()]['member'] = [('cn=%s,dc=example,dc=com' % name).encode() for name in names]
+        for name in names:
+            entries['cn=%s,dc=example,dc=com' % name].setdefault('memberOf', []).append(group_dn)
+    return entries
+
+
+def test_nested_groups_are_read_level_by_level(monkeypatch):
+    connection = FakeLDAPConnection(make_nested_directory())
+    connector = make_connector(monkeypatch, connection, two_steps_lookup={
+        'group_member_attribute_name': 'member', 'nested_group': True})
+    loaded = load_user_groups(connector, ['outer', 'other'], all_users=False)
+
+    # the other group has the middle group as a member, and so (round the loop) the outer group too
+    assert loaded == {
+        'user0@example.com': ['other', 'outer'],
+        'user1@example.com': ['other', 'outer'],
+        'user2@example.com': ['other', 'outer'],
+        'user3@example.com': ['other'],
+    }
+    # each group lists its members once, however many mapped groups it is nested in (or loops back to)
+    member_reads = [base for base, filter_string in zip(connection.search_bases, connection.searches)
+                    if filter_string == '(objectClass=*)']
+    assert sorted(member_reads) == sorted(set(member_reads))
+    assert len([base for base in member_reads if base.startswith('cn=user')]) == 4
+    assert len(member_reads) == 8
+
+
+def test_nested_groups_in_chain(monkeypatch):
+    connection = FakeLDAPConnection(make_nested_directory())
+    connector = make_connector(monkeypatch, connection, two_steps_lookup={
+        'group_member_attribute_name': 'member', 'nested_group': True, 'nested_group_in_chain': True})
+    loaded = load_user_groups(connector, ['outer', 'other'], all_users=False)
+
+    assert loaded['user2@example.com'] == ['other', 'outer']
+    assert loaded['user3@example.com'] == ['other']
+    assert '(memberOf:1.2.840.113556.1.4.1941:=cn=outer,dc=example,dc=com)' in connection.searches
+    assert '(objectClass=*)' not in connection.searches
+
+
+def test_errors_reading_members_are_raised(monkeypatch):
+    connection = FakeLDAPConnection(make_nested_directory())
+    connector = make_connector(monkeypatch, connection, two_steps_lookup={
+        'group_member_attribute_name': 'member', 'nested_group': True})
+
+    def fail_second_level(filter_string):
+        # the outer group's members are read, and then the connection fails
+        if filter_string == '(objectClass=*)' and '(objectClass=*)' in connection.searches:
+            raise RuntimeError('connection lost')
+
+    connection.on_search = fail_second_level
+    with pytest.raises(AssertionException) as error:
+        load_user_groups(connector, ['outer'], all_users=False)
+    assert 'connection lost' in str(error.value)
+
+
+def test_members_that_cant_be_read_are_skipped(monkeypatch):
+    entries = make_nested_directory()
+    remote_dn = 'cn=remote,dc=example,dc=com'
+    secret_dn = 'cn=secret,dc=example,dc=com'
+    entries['cn=outer,dc=example,dc=com']['member'] += [b'cn=user9,dc=other,dc=com', remote_dn.encode(),
+                                                       secret_dn.encode()]
+    connection = FakeLDAPConnection(entries)
+    connection.errors[remote_dn] = ldap.REFERRAL({'desc': 'Referral', 'info': 'ldap://other.example.com/'})
+    connection.errors[secret_dn] = ldap.INSUFFICIENT_ACCESS({'desc': 'Insufficient access'})
+    connector = make_connector(monkeypatch, connection, two_steps_lookup={
+        'group_member_attribute_name': 'member', 'nested_group': True})
+    loaded = load_user_groups(connector, ['outer'], all_users=False)
+
+    assert sorted(loaded) == ['user%d@example.com' % i for i in range(3)]
+    # the member in another domain is outside the base DN, so isn't read at all
+    assert 'cn=user9,dc=other,dc=com' not in connection.search_bases
+    assert remote_dn in connection.search_bases and secret_dn in connection.search_bases
+
+
+def test_async_search_streams_entries_across_pages(monkeypatch):
+    entries, _ = make_directory()
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection, async_search=True, search_page_size=3)
+    results = connector.iter_search_result('dc=example,dc=com', ldap.SCOPE_SUBTREE, '(objectClass=person)', ['mail'])
+
+    # the first entry is passed on while the rest of its page is still to be read
+    assert next(results)[0] == 'cn=user0,dc=example,dc=com'
+    assert len(connection.searches) == 1
+    assert len(connection.messages) == 3
+    # each next page is asked for with the cookie of the last, until there is none
+    assert [dn for dn, _ in results] == ['cn=user%d,dc=example,dc=com' % i for i in range(1, 10)]
+    assert len(connection.searches) == 4
+    assert not connection.abandoned
+
+    results = connector.iter_search_result('dc=example,dc=com', ldap.SCOPE_SUBTREE, '(objectClass=person)', ['mail'])
+    next(results)
+    results.close()
+    assert connection.abandoned == [5]
+
+
+def test_multiplexed_searches_share_a_connection(monkeypatch):
+    entries, groups = make_directory()
+    groups = groups * 2
+    searched = dict((group, [dn for dn, _ in members]) for group, _, members in make_connector(
+        monkeypatch, FakeLDAPConnection(entries)).iter_group_member_searches(groups, []))
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection, async_search=True, search_page_size=2)
+    connector.max_multiplexed_searches = 3
+    multiplexed = [(group, [dn for dn, _ in members])
+                   for group, _, members in connector.iter_group_member_searches(groups, [])]
+
+    # the results are the same, in the same order, with up to three searches at once on the one connection
+    assert [group for group, _ in multiplexed] == groups
+    assert dict(multiplexed) == searched
+    assert connection.max_outstanding == 3
+    # every page of every search was asked for (the last page of each being a partial one)
+    assert len([search for search in connection.searches if search.startswith('(&(memberOf')]) == 2 * (3 + 2 + 2)
+
+
+def test_multiplexed_searches_are_abandoned(monkeypatch):
+    entries, groups = make_directory()
+    connection = FakeLDAPConnection(entries)
+    connector = make_connector(monkeypatch, connection, async_search=True, search_page_size=2)
+    searches = (('group%d' % i, 'dc=example,dc=com', '(memberOf=cn=group%d,dc=example,dc=com)' % i, ['mail'])
+                for i in range(3))
+    results = connector.iter_multiplexed_search_results(searches)
+    key, members = next(results)
+    results.close()
+    assert sorted(connection.abandoned) == sorted(set(connection.abandoned))
+    assert len(connection.abandoned) == 2
+    assert not connection.messages
+
+
+def test_value_plan(monkeypatch):
+    connector = make_connector(monkeypatch, FakeLDAPConnection({}),
+                               user_username_format='{uid}',
+                               user_domain_format='{ou}.{dc}',
+                               user_given_name_format='{givenName}',
+                               user_identity_type_format='{idType}ID')
+    formatters = [connector.user_email_formatter, connector.user_identity_type_formatter,
+                  connector.user_username_formatter, connector.user_domain_formatter,
+                  connector.user_given_name_formatter, connector.user_surname_formatter,
+                  connector.user_country_code_formatter]
+    for record in ({'mail': [b'one@example.com'], 'uid': [b'one', b'uno'], 'ou': [b'sales'], 'dc': [b'example'],
+                    'givenName': [u'Émile'.encode('utf8')], 'sn': [b''], 'c': [b'us'], 'idType': [b'adobe']},
+                   {'mail': [b'two@example.com'], 'dc': [b'example'], 'givenName': [], 'c': [b'US']},
+                   {}):
+        plan_values = connector.user_value_plan.generate_values(record)
+        for formatter, plan_value in zip(formatters, plan_values):
+            assert plan_value == formatter.generate_value(record)
+    # an attribute is only decoded if a formatter gets as far as it, as with generate_value
+    record = {'mail': [b'three@example.com'], 'dc': [b'\xff']}
+    assert connector.user_value_plan.generate_values(record)[3] == (None, 'ou')
+    with pytest.raises(AssertionException):
+        connector.user_value_plan.generate_values({'mail': [b'\xff']})
@@ -0,0 +1,238 @@
+import json
+import logging
+import time
+
+import pytest
+
+okta = pytest.importorskip('okta')
+
+from okta_server import OktaStandIn
+from user_sync.connector.directory_okta import OktaApiClient, OktaDirectoryConnector, OktaRecord, OktaUserFilter
+from user_sync.error import AssertionException
+
+
+def make_stand_in(user_count, group_count, **kwargs):
+    users = [OktaStandIn.make_user('00u%06d' % i, 'user%d@example.com' % i, countryCode='us',
+                                   firstName='Given%d' % i, lastName='Surname%d' % i)
+             for i in range(user_count)]
+    users[0]['status'] = 'SUSPENDED'
+    groups = [('Group %d' % j, [user['id'] for i, user in enumerate(users) if i % (j + 1) == 0])
+              for j in range(group_count)]
+    return OktaStandIn(users, groups, **kwargs)
+
+
+def make_connector(stand_in, **options):
+    connector_options = {'host': 'example.okta.com', 'api_token': 'token'}
+    connector_options.update(options)
+    connector = OktaDirectoryConnector(connector_options)
+    connector.api_client = OktaApiClient(stand_in.get_url(), 'token', connector.options['max_search_workers'],
+                                         connector.logger)
+    return connector
+
+
+def test_group_members_read_concurrently():
+    stand_in = make_stand_in(300, 6, page_size=20, latency=0.01)
+    stand_in.start()
+    try:
+        connector = make_connector(stand_in, max_search_workers=4, search_page_size=20)
+        groups = ['Group %d' % j for j in range(6)] + ['Missing Group']
+        users = dict((user['email'], user) for user in connector.load_users_and_groups(groups, [], False))
+    finally:
+        stand_in.stop()
+
+    # user0 is not active, so is filtered out
+    assert len(users) == 299
+    assert 'user0@example.com' not in users
+    assert users['user6@example.com']['groups'] == ['Group 0', 'Group 1', 'Group 2', 'Group 5']
+    assert users['user7@example.com']['groups'] == ['Group 0']
+    assert users['user7@example.com']['country'] == 'US'
+    assert stand_in.stats['member_pages'] == sum((299 // (j + 1) + 20) // 20 for j in range(6))
+    # the groups are found in a single page of all of them, rather than searched for one by one
+    assert stand_in.stats['group_searches'] == 1
+    assert 1 < stand_in.stats['max_concurrent'] <= 4
+
+
+def test_users_in_several_groups_are_converted_once(monkeypatch, caplog):
+    stand_in = make_stand_in(30, 3, page_size=10)
+    stand_in.update_user('00u000004', email='')
+    stand_in.start()
+    try:
+        connector = make_connector(stand_in, max_search_workers=3)
+        converted = []
+        filtered = []
+        convert_user = connector.convert_user
+        matches = connector.user_filter.matches
+
+        def count_conversions(record, extended_attributes):
+            converted.append(record.id)
+            return convert_user(record, extended_attributes)
+
+        def count_filtering(record):
+            filtered.append(record.id)
+            return matches(record)
+
+        monkeypatch.setattr(connector, 'convert_user', count_conversions)
+        monkeypatch.setattr(connector.user_filter, 'matches', count_filtering)
+        with caplog.at_level(logging.DEBUG):
+            users = dict((user['email'], user) for user in connector.load_users_and_groups(['Group 0', 'Group 1',
+                                                                                             'Group 2'], [], False))
+    finally:
+        stand_in.stop()
+
+    assert len(users) == 28
+    # user0, which is in every group, is filtered out once (by whichever worker reads it first), and the others
+    # are converted once
+    assert sorted(filtered) == sorted(set(filtered)) and len(filtered) == 30
+    assert sorted(converted) == sorted(set(converted)) and len(converted) == 29
+    assert users['user6@example.com']['groups'] == ['Group 0', 'Group 1', 'Group 2']
+    assert users['user6@example.com']['firstname'] == 'Given6'
+    # every membership of a user that matches the filter is counted, including that of user4, which has no email
+    assert 'Group Group 1 members: 14 users: 13' in caplog.text
+
+
+def test_value_plan():
+    connector = OktaDirectoryConnector({'host': 'example.okta.com', 'api_token': 'token',
+                                        'user_username_format': '{login}',
+                                        'user_domain_format': '{department}.example.com',
+                                        'user_country_code_format': '{countryCode}'})
+    formatters = [connector.user_email_formatter, connector.user_username_formatter,
+                  connector.user_domain_formatter, connector.user_given_name_formatter,
+                  connector.user_surname_formatter, connector.user_country_code_formatter]
+    for profile in ({'login': 'one', 'email': 'one@example.com', 'firstName': 'One', 'lastName': '',
+                     'countryCode': 52, 'department': 'sales'},
+                    {'email': 'two@example.com', 'firstName': None, 'department': ''}):
+        record = OktaRecord({'id': '00u1', 'profile': profile})
+        assert connector.user_value_plan.generate_values(record) == [formatter.generate_value(record)
+                                                                     for formatter in formatters]
+
+
+def test_group_index_cache(tmpdir):
+    stand_in = make_stand_in(10, 4, page_size=2)
+    stand_in.start()
+    cache_options = {'group_index_cache': {'path': str(tmpdir.join('groups.json'))}}
+    try:
+        def load_groups(groups):
+            connector = make_connector(stand_in, **cache_options)
+            return dict((group, members is not None)
+                        for group, members in connector.iter_group_member_records(groups))
+
+        assert load_groups(['Group 1', 'Group 3', 'Missing Group']) == {'Group 1': True, 'Group 3': True,
+                                                                        'Missing Group': False}
+        assert stand_in.stats['group_searches'] == 2
+        # nothing has changed, so nothing is read from the list of groups
+        load_groups(['Group 1'])
+        assert stand_in.stats['group_searches'] == 3
+        time.sleep(0.01)
+        stand_in.rename_group('00g000002', 'Renamed Group')
+        stand_in.delete_group('00g000004')
+        assert load_groups(['Group 1', 'Renamed Group', 'Group 3']) == {'Group 1': False, 'Renamed Group': True,
+                                                                        'Group 3': False}
+        # the deleted group had the index read again in full, which was cached for the next run
+        assert stand_in.stats['group_searches'] == 4 + 2
+        assert load_groups(['Renamed Group']) == {'Renamed Group': True}
+        assert stand_in.stats['group_searches'] == 7
+    finally:
+        stand_in.stop()
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_group_made_again_with_the_same_name(tmpdir, incremental):
+    stand_in = make_stand_in(10, 2, page_size=2)
+    stand_in.start()
+    cache_path = str(tmpdir.join('groups.json'))
+    options = {'group_index_cache': {'path': cache_path}}
+    if incremental:
+        options['incremental_sync'] = {'state_path': str(tmpdir.join('okta-members.json'))}
+
+    def made_again(group_id):
+        member_ids = stand_in.member_ids_by_group_id[group_id]
+        name = stand_in.group_by_id[group_id]['profile']['name']
+        stand_in.delete_group(group_id)
+        return stand_in.add_group(name, member_ids)
+
+    try:
+        def load_users():
+            connector = make_connector(stand_in, **options)
+            return dict((user['email'], user['groups'])
+                        for user in connector.load_users_and_groups(['Group 0', 'Group 1'], [], False))
+
+        assert load_users()['user2@example.com'] == ['Group 0', 'Group 1']
+        time.sleep(0.01)
+        # the group read since the index was cached takes the place of the deleted one
+        made_again('00g000002')
+        assert load_users()['user2@example.com'] == ['Group 0', 'Group 1']
+        assert stand_in.stats['group_searches'] == 2
+        time.sleep(0.01)
+        # when the new group isn't read with the cached index, its members are found by reading the index again
+        group_id = made_again('00g000001')
+        with open(cache_path) as f:
+            state = json.load(f)
+        state['mark'] = stand_in.group_by_id[group_id]['lastUpdated']
+        with open(cache_path, 'w') as f:
+            json.dump(state, f)
+        assert load_users()['user2@example.com'] == ['Group 0', 'Group 1']
+        assert stand_in.stats['group_searches'] == 4
+    finally:
+        stand_in.stop()
+
+
+def test_incremental_sync(tmpdir):
+    stand_in = make_stand_in(30, 3, page_size=10)
+    stand_in.start()
+    sync_options = {'incremental_sync': {'state_path': str(tmpdir.join('okta-members.json'))}}
+    try:
+        def load_users():
+            connector = make_connector(stand_in, **sync_options)
+            return dict((user['email'], user) for user in connector.load_users_and_groups(['Group 1', 'Group 2'],
+                                                                                          [], False))
+
+        users = load_users()
+        assert len(users) == 19
+        assert stand_in.stats['member_pages'] == 2 + 1
+        stand_in.update_user('00u000002', status='SUSPENDED')
+        stand_in.update_user('00u000004', lastName='Changed')
+        stand_in.add_member('00g000002', '00u000001')
+        stand_in.remove_member('00g000003', '00u000006')
+        stand_in.delete_user('00u000008')
+        users = load_users()
+    finally:
+        stand_in.stop()
+
+    # no group members were read again, only the changes
+    assert stand_in.stats['member_pages'] == 3
+    assert stand_in.stats['log_pages'] == 1
+    assert sorted(users) == sorted('user%d@example.com' % i for i in range(1, 30)
+                                   if i in (1, 6) or (i % 2 == 0 or i % 3 == 0) and i not in (2, 8))
+    assert users['user1@example.com']['groups'] == ['Group 1']
+    assert users['user4@example.com']['lastname'] == 'Changed'
+    assert users['user6@example.com']['groups'] == ['Group 1']
+
+
+def test_rate_limit_is_waited_for():
+    stand_in = make_stand_in(100, 1, page_size=10, rate_limit=6, window_seconds=0.5)
+    stand_in.start()
+    try:
+        client = OktaApiClient(stand_in.get_url(), 'token', 2, logging.getLogger('test'))
+        group_id = sorted(stand_in.group_by_id)[0]
+        members = [member for page in client.iter_pages('/groups/%s/users' % group_id, {'limit': 10})
+                   for member in page]
+    finally:
+        stand_in.stop()
+
+    assert len(members) == 100
+    # requests were held back for the window to reset, instead of being refused
+    assert client.get_statistics() == (10, client.wait_count)
+    assert client.wait_count > 0
+    assert stand_in.stats['throttled'] == 0
+
+
+def test_user_filter():
+    user = OktaRecord({'id': '00u1', 'status': 'ACTIVE', 'profile': {'email': 'One@Example.com',
+                                                                      'countryCode': 'MX'}})
+    assert OktaUserFilter('user.status == "ACTIVE" and user.profile.countryCode in ("MX", "US")').matches(user)
+    assert OktaUserFilter('user.profile.email.lower().endswith("@example.com")').matches(user)
+    assert OktaUserFilter('not user.profile.department').matches(user)
+    assert not OktaUserFilter('user.status != "ACTIVE" or len(user.profile.countryCode) > 2').matches(user)
+    for unsafe in ('__import__("os").getcwd()', 'user.__class__', '[u for u in user.profile]'):
+        with pytest.raises(AssertionException):
+            OktaUserFilter(unsafe)
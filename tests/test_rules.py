@@ -0,0 +1,160 @@
+import threading
+import time
+
+import pytest
+
+from user_sync.rules import RuleProcessor, UmapiConnectors
+from user_sync.error import AssertionException
+
+
+class FakeActionManager(object):
+    def __init__(self, name, events):
+        self.name = name
+        self.events = events
+
+    def flush(self):
+        self.events.append(('flush', self.name))
+
+    def has_work(self):
+        return False
+
+    def get_statistics(self):
+        return 0, 0
+
+
+class FakeUmapiConnector(object):
+    """Records the commands sent to it, taking a little time for each so that secondaries overlap."""
+
+    def __init__(self, name, events, delay=0.01):
+        self.name = name
+        self.events = events
+        self.delay = delay
+        self.action_manager = FakeActionManager(name, events)
+        self.active = set()
+
+    def send_commands(self, commands, callback=None, user_key=None):
+        self.active.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        self.events.append(('send', self.name, commands.username))
+
+    def get_action_manager(self):
+        return self.action_manager
+
+
+def make_connectors(events, secondary_count):
+    primary = FakeUmapiConnector('primary', events)
+    secondaries = {'org%d' % i: FakeUmapiConnector('org%d' % i, events) for i in range(secondary_count)}
+    return UmapiConnectors(primary, secondaries)
+
+
+def make_strays(processor, umapi_names, user_count):
+    for umapi_name in umapi_names:
+        processor.add_stray(umapi_name, None)
+        for i in range(user_count):
+            processor.add_stray(umapi_name, 'federatedID,user%d@example.com,' % i)
+
+
+def test_secondary_strays_removed_before_primary():
+    events = []
+    processor = RuleProcessor({'remove_strays': True, 'max_secondary_workers': 4})
+    umapi_connectors = make_connectors(events, 6)
+    make_strays(processor, [None] + list(umapi_connectors.get_secondary_connectors()), 3)
+    processor.manage_strays(umapi_connectors)
+
+    first_primary = events.index(('send', 'primary', 'user0@example.com'))
+    secondary_events = [event for event in events if event[1] != 'primary']
+    assert len(secondary_events) == 6 * (3 + 1)
+    assert all(events.index(event) < first_primary for event in secondary_events)
+    # secondaries were worked on by more than one thread
+    threads = set()
+    for connector in umapi_connectors.get_secondary_connectors().values():
+        threads |= connector.active
+    assert len(threads) > 1
+
+
+def test_secondary_errors_are_raised():
+    processor = RuleProcessor({'max_secondary_workers': 3})
+    umapi_connectors = make_connectors([], 5)
+
+    def work(umapi_name, umapi_connector):
+        if umapi_name == 'org2':
+            raise AssertionException('failed in %s' % umapi_name)
+
+    with pytest.raises(AssertionException) as exc_info:
+        processor.for_each_secondary(umapi_connectors, work)
+    assert exc_info.value.args[0] == 'failed in org2'
+
+
+def test_secondaries_share_state_safely():
+    processor = RuleProcessor({'remove_strays': True, 'max_secondary_workers': 4})
+    umapi_connectors = make_connectors([], 8)
+
+    def work(umapi_name, umapi_connector):
+        processor.add_stray(umapi_name, None)
+        for i in range(500):
+            username = 'user%d@example.com' % i
+            processor.add_stray(umapi_name, 'federatedID,%s,' % username)
+            processor.map_email_override({'username': username, 'email': 'other%d@example.com' % i})
+
+    processor.for_each_secondary(umapi_connectors, work)
+    assert sorted(processor.stray_key_map) == ['org%d' % i for i in range(8)]
+    assert all(len(strays) == 500 for strays in processor.stray_key_map.values())
+    assert len(processor.email_override) == 500
+
+
+class ListUmapiConnector(FakeUmapiConnector):
+    """Serves a fixed list of users and records the commands sent to it."""
+
+    def __init__(self, users):
+        super(ListUmapiConnector, self).__init__('primary', [], delay=0)
+        self.users = users
+        self.commands = {}
+
+    def iter_users(self):
+        return iter(self.users)
+
+    def get_user_cache(self):
+        return None
+
+    def send_commands(self, commands, callback=None, user_key=None):
+        self.commands[user_key] = commands.do_list
+
+
+def make_user(email, groups, **fields):
+    user = {'email': email, 'username': email, 'domain': 'example.com', 'type': 'federatedID',
+            'identity_type': 'federatedID', 'firstname': None, 'lastname': None, 'country': 'US',
+            'groups': groups}
+    user.update(fields)
+    return user
+
+
+def test_group_differences():
+    processor = RuleProcessor({'process_groups': True, 'remove_strays': True,
+                               'exclude_groups': ['Excluded']})
+    umapi_info = processor.get_umapi_info(None)
+    for group in ('Mapped A', 'Mapped B', 'Mapped C'):
+        umapi_info.add_mapped_group(group)
+    directory_users = [make_user('user%d@example.com' % i, []) for i in range(3)]
+    for directory_user in directory_users:
+        user_key = processor.get_directory_user_key(directory_user)
+        processor.directory_user_by_user_key[user_key] = directory_user
+        processor.filtered_directory_user_by_user_key[user_key] = directory_user
+    umapi_info.add_desired_group_for('federatedID,user0@example.com,', 'Mapped A')
+    umapi_info.add_desired_group_for('federatedID,user0@example.com,', 'mapped b')
+    umapi_info.add_desired_group_for('federatedID,user1@example.com,', None)
+    umapi_info.add_desired_group_for('federatedID,user2@example.com,', 'Mapped C')
+    connector = ListUmapiConnector([
+        make_user('user0@example.com', ['MAPPED A', 'Mapped C', 'Unmapped']),
+        make_user('user1@example.com', ['Unmapped', 'Excluded', 'Mapped A']),
+        make_user('stray@example.com', ['Mapped B', 'Other']),
+    ])
+    users_to_create = processor.update_umapi_users_for_connector(umapi_info, connector)
+
+    assert users_to_create == {'federatedID,user2@example.com,': {'mapped c'}}
+    assert connector.commands['federatedID,user0@example.com,'] == [
+        ('remove_from_groups', {'groups': {'mapped c'}}),
+        ('add_to_groups', {'groups': {'mapped b'}}),
+    ]
+    assert 'federatedID,user1@example.com,' not in connector.commands
+    assert processor.excluded_user_count == 1
+    assert processor.get_stray_keys() == {'federatedID,stray@example.com,': {'mapped b'}}
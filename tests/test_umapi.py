@@ -0,0 +1,461 @@
+import logging
+import threading
+import time
+
+import mock
+import pytest
+import requests
+import requests.adapters
+import umapi_client
+
+from user_sync.connector.umapi import (ActionManager, Commands, RateLimitedAdapter, RateLimiter, UmapiConnector,
+                                       UmapiUserCache)
+from user_sync.error import AssertionException
+
+
+@pytest.fixture(autouse=True)
+def rate_limiters():
+    """Each test starts with no rate limiters, as each run does."""
+    RateLimiter.reset_limiters()
+    yield RateLimiter.limiter_by_host
+    RateLimiter.reset_limiters()
+
+
+class FakeConnection(object):
+    """Records the batches it is asked to execute, optionally failing some of their actions."""
+
+    def __init__(self, delay=0.0, failing_users=(), error=None):
+        self.delay = delay
+        self.failing_users = set(failing_users)
+        self.error = error
+        self.batches = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def execute_multiple(self, actions, immediate=True):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+            self.batches.append(actions)
+        if self.error:
+            raise self.error
+        for action in actions:
+            if action.frame['user'] in self.failing_users:
+                action.report_command_error({'index': 0, 'step': 0, 'errorCode': 'error.test', 'message': 'test'})
+        return 0, len(actions), len(actions)
+
+
+def make_action(user):
+    action = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email=user, requestID=user)
+    action.add_to_groups(groups=['group'])
+    return action
+
+
+def make_manager(connection, max_workers=1):
+    # the fake connection can be shared by the workers
+    return ActionManager(connection, 'org_id', logging.getLogger('test'), max_workers,
+                         connection_factory=lambda: connection)
+
+
+def test_actions_are_batched():
+    connection = FakeConnection()
+    manager = make_manager(connection)
+    for i in range(25):
+        manager.add_action(make_action('user%d@example.com' % i))
+    manager.flush()
+    assert [len(batch) for batch in connection.batches] == [10, 10, 5]
+    assert not manager.has_work()
+    assert manager.get_statistics() == (25, 0)
+
+
+def test_callbacks_and_errors_per_action():
+    connection = FakeConnection(failing_users=['user3@example.com'])
+    manager = make_manager(connection, max_workers=4)
+    results = {}
+
+    def callback(result):
+        results[result['action'].frame['user']] = result['is_success']
+
+    for i in range(30):
+        manager.add_action(make_action('user%d@example.com' % i), callback)
+    manager.flush()
+    assert len(results) == 30
+    assert [user for user, success in results.items() if not success] == ['user3@example.com']
+    assert manager.get_statistics() == (30, 1)
+
+
+def test_batches_sent_concurrently():
+    connection = FakeConnection(delay=0.05)
+    manager = make_manager(connection, max_workers=3)
+    for i in range(60):
+        manager.add_action(make_action('user%d@example.com' % i))
+    manager.flush()
+    assert len(connection.batches) == 6
+    assert 1 < connection.max_active <= 3
+
+
+def test_workers_have_connections_of_their_own():
+    main_connection = FakeConnection()
+    worker_connections = []
+
+    def make_connection():
+        worker_connections.append(FakeConnection(delay=0.05))
+        return worker_connections[-1]
+
+    manager = ActionManager(main_connection, 'org_id', logging.getLogger('test'), 3,
+                            connection_factory=make_connection)
+    for i in range(60):
+        manager.add_action(make_action('user%d@example.com' % i))
+    manager.flush()
+    assert not main_connection.batches
+    assert 1 < len(worker_connections) <= 3
+    assert sum(len(connection.batches) for connection in worker_connections) == 6
+    assert all(connection.max_active == 1 for connection in worker_connections)
+
+
+def test_workers_take_turns_with_a_shared_connection():
+    connection = FakeConnection(delay=0.02)
+    manager = ActionManager(connection, 'org_id', logging.getLogger('test'), 3)
+    for i in range(40):
+        manager.add_action(make_action('user%d@example.com' % i))
+    manager.flush()
+    assert len(connection.batches) == 4
+    assert connection.max_active == 1
+
+
+def test_request_ids_are_unique_across_threads():
+    manager = make_manager(FakeConnection())
+    request_ids = []
+
+    def create_actions():
+        for i in range(200):
+            commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+            commands.add_groups({'group'})
+            request_ids.append(manager.create_action(commands).frame['requestID'])
+
+    threads = [threading.Thread(target=create_actions) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(request_ids)) == 800
+
+
+def test_batch_error_counts_every_action():
+    connection = FakeConnection(error=umapi_client.BatchError([Exception('boom')], 0, 10, 0))
+    manager = make_manager(connection)
+    for i in range(10):
+        manager.add_action(make_action('user%d@example.com' % i))
+    manager.flush()
+    assert manager.get_statistics() == (10, 10)
+
+
+def test_unavailable_server():
+    connection = FakeConnection(error=umapi_client.UnavailableError(3, 30, None))
+    manager = make_manager(connection, max_workers=2)
+    with pytest.raises(AssertionException):
+        for i in range(30):
+            manager.add_action(make_action('user%d@example.com' % i))
+        manager.flush()
+    # the batches still in flight are no longer waited for
+    assert manager.batches_in_flight == 0
+    connection.error = None
+    manager.add_action(make_action('user@example.com'))
+    manager.flush()
+    assert not manager.has_work()
+
+
+def make_connector(**server_options):
+    options = {
+        'server': server_options,
+        'enterprise': {
+            'org_id': 'org_id',
+            'api_key': 'api_key',
+            'client_secret': 'client_secret',
+            'tech_acct': 'tech_acct',
+            'priv_key_data': 'private key data',
+        },
+    }
+    with mock.patch('umapi_client.Connection'):
+        return UmapiConnector('', options)
+
+
+def test_prefetch_users():
+    users = [{'email': 'user%d@example.com' % i} for i in range(450)]
+    connector = make_connector(prefetch_pages=1)
+    with mock.patch('umapi_client.UsersQuery', return_value=users) as query:
+        connector.prefetch_users()
+        assert list(connector.iter_users()) == users
+        assert query.call_count == 1
+        # the prefetcher reads on a connection of its own, leaving the main one free for other queries
+        assert query.call_args[0][0] is not connector.connection
+        # once consumed, users are queried again on demand
+        assert list(connector.iter_users()) == users
+        assert query.call_count == 2
+
+
+def test_prefetch_users_error():
+    connector = make_connector(prefetch_pages=2)
+    with mock.patch('umapi_client.UsersQuery', side_effect=umapi_client.UnavailableError(3, 30, None)):
+        connector.prefetch_users()
+        with pytest.raises(AssertionException):
+            list(connector.iter_users())
+
+
+def test_prefetch_stopped(monkeypatch):
+    users = [{'email': 'user%d@example.com' % i} for i in range(1000)]
+    connector = make_connector(prefetch_pages=1)
+    monkeypatch.setattr(connector, 'prefetch_poll_seconds', 0.01)
+    with mock.patch('umapi_client.UsersQuery', return_value=users):
+        connector.prefetch_users()
+        fetcher = [thread for thread in threading.enumerate() if thread.name == 'umapi-users'][0]
+        # the queue fills up, and nothing reads it
+        while not connector.user_page_queue.full():
+            time.sleep(0.01)
+        connector.stop_prefetch()
+        fetcher.join(5)
+        assert not fetcher.is_alive()
+        assert len(list(connector.iter_users())) == 1000
+
+
+def test_prefetch_disabled():
+    connector = make_connector()
+    with mock.patch('umapi_client.UsersQuery', return_value=[]) as query:
+        connector.prefetch_users()
+        assert query.call_count == 0
+
+
+def make_cache(tmpdir, full_refresh_hours=24):
+    return UmapiUserCache(str(tmpdir.join('users.json')), 'org_id', full_refresh_hours, logging.getLogger('test'))
+
+
+def test_user_cache_tracks_sent_commands(tmpdir):
+    cache = make_cache(tmpdir)
+    assert not cache.is_current()
+    cache.start_refresh()
+    cache.add_user('federatedID,user1@example.com,', {
+        'email': 'user1@example.com', 'username': 'user1@example.com', 'domain': 'example.com',
+        'type': 'federatedID', 'firstname': 'One', 'lastname': 'User', 'country': 'US', 'groups': ['Group A'],
+    })
+    cache.add_user('federatedID,user2@example.com,', {
+        'email': 'user2@example.com', 'username': 'user2@example.com', 'domain': 'example.com',
+        'type': 'federatedID', 'groups': ['Group A'],
+    })
+
+    update = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    update.update_user({'firstname': 'Uno'})
+    update.remove_groups({'group a'})
+    update.add_groups({'group b'})
+    cache.make_callback('federatedID,user1@example.com,', update)({'is_success': True})
+    remove = Commands('federatedID', 'user2@example.com', 'user2@example.com', 'example.com')
+    remove.remove_from_org(False)
+    cache.make_callback('federatedID,user2@example.com,', remove)({'is_success': True})
+    create = Commands('federatedID', 'user3@example.com', 'user3@example.com', 'example.com')
+    create.add_user({'email': 'user3@example.com', 'country': 'DE', 'option': 'ignoreIfAlreadyExists'})
+    create.add_groups({'group a'})
+    cache.make_callback('federatedID,user3@example.com,', create)({'is_success': True})
+    cache.save()
+
+    cache = make_cache(tmpdir)
+    assert cache.is_current()
+    users = {user['email']: user for user in cache.iter_users()}
+    assert sorted(users) == ['user1@example.com', 'user3@example.com']
+    assert users['user1@example.com']['firstname'] == 'Uno'
+    assert users['user1@example.com']['groups'] == ['group b']
+    assert users['user3@example.com']['country'] == 'DE'
+    assert users['user3@example.com']['groups'] == ['group a']
+
+
+def test_user_cache_refresh(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.start_refresh()
+    cache.save()
+    assert make_cache(tmpdir).is_current()
+    assert not make_cache(tmpdir, full_refresh_hours=0).is_current()
+
+    # a failed action means we don't know the user's state any more
+    cache = make_cache(tmpdir)
+    assert cache.is_current()
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_groups({'group'})
+    cache.make_callback('federatedID,user1@example.com,', commands)({'is_success': False})
+    cache.save()
+    assert not make_cache(tmpdir).is_current()
+
+
+def test_user_cache_emptied_by_changes_made_without_reading(tmpdir):
+    cache = make_cache(tmpdir)
+    cache.start_refresh()
+    cache.save()
+
+    # a run (such as a push) that changes users without reading them from the cache or the server
+    cache = make_cache(tmpdir)
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_groups({'group'})
+    cache.make_callback('federatedID,user1@example.com,', commands)({'is_success': True})
+    assert not make_cache(tmpdir).is_current()
+    cache.save()
+    assert not make_cache(tmpdir).is_current()
+
+
+def test_connector_against_stand_in(umapi_stand_in):
+    for i in range(450):
+        umapi_stand_in.add_user(umapi_stand_in.make_user('user%d@example.com' % i, ['Group %d' % (i % 3)]))
+    options = {
+        'server': dict(umapi_stand_in.get_connector_options(), max_workers=2),
+        'enterprise': {
+            'org_id': 'org_id',
+            'api_key': 'api_key',
+            'client_secret': 'client_secret',
+            'tech_acct': 'tech_acct',
+            'priv_key_data': 'private key data',
+        },
+    }
+    connector = UmapiConnector('', options)
+    # requests are only retried by the rate limited adapter, and connectors to the same host share its limiter
+    assert connector.connection.retry_max_attempts == 1
+    assert UmapiConnector('.secondary.org', options).rate_limiter is connector.rate_limiter
+    assert len(list(connector.iter_users())) == 450
+    assert umapi_stand_in.stats['user_pages'] == 3
+    assert sorted(g['name'] for g in connector.iter_user_groups()) == ['Group 0', 'Group 1', 'Group 2']
+
+    # throttled batches are retried after the advised wait
+    umapi_stand_in.throttle_every = 2
+    for i in range(25):
+        commands = Commands('federatedID', 'user%d@example.com' % i, 'user%d@example.com' % i, 'example.com')
+        commands.add_groups({'group 2'})
+        connector.send_commands(commands)
+    commands = Commands('federatedID', 'nobody@example.com', 'nobody@example.com', 'example.com')
+    commands.add_groups({'group 2'})
+    connector.send_commands(commands)
+    connector.get_action_manager().flush()
+    assert connector.get_action_manager().get_statistics() == (26, 1)
+    assert umapi_stand_in.stats['throttled'] > 0
+    assert connector.rate_limiter.get_statistics()[1] == umapi_stand_in.stats['throttled']
+    assert umapi_stand_in.stats['action_batches'] == 3
+    assert umapi_stand_in.users['user3@example.com']['groups'] == ['Group 0', 'Group 2']
+
+
+def test_rate_limiter_adapts_to_throttling():
+    limiter = RateLimiter('limited.example.com', 0, 10, logging.getLogger('test'))
+    for _ in range(10):
+        limiter.acquire()
+    assert limiter.rate is None
+
+    # all callers wait out the advised delay, then go at half the rate they were going
+    limiter.record_response(429, '1', 0.1)
+    assert limiter.rate == 1.0
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start > 0.9
+    for _ in range(10):
+        limiter.record_response(200, None, 0.1)
+    assert 4.5 < limiter.rate < 5
+    limiter.record_response(200, None, 20)
+    assert limiter.rate < 4.5
+    assert limiter.get_statistics() == (11, 1)
+
+    limiter = RateLimiter('limited.example.com', 2, 5, logging.getLogger('test'))
+    assert limiter.max_rate == 2 and limiter.rate == 2 and limiter.slow_response_seconds == 5
+
+
+def test_rate_limiter_shared_by_host(rate_limiters):
+    limiter = RateLimiter.get_limiter('limited.example.com', 2, 5, logging.getLogger('test'))
+    # the stricter of the limits configured for the host applies
+    assert RateLimiter.get_limiter('limited.example.com', 1, 10, logging.getLogger('test')) is limiter
+    assert limiter.max_rate == 1 and limiter.rate == 1 and limiter.slow_response_seconds == 5
+    assert RateLimiter.get_limiter('other.example.com', 0, 0, logging.getLogger('test')) is not limiter
+    # the next run starts afresh
+    RateLimiter.reset_limiters()
+    assert not rate_limiters
+    assert RateLimiter.get_limiter('limited.example.com', 2, 5, logging.getLogger('test')) is not limiter
+
+
+def make_response(status_code, retry_after=None):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content_consumed = True
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+    return response
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    :return: the waits made with time.sleep, which move time.time on instead of waiting
+    """
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    monkeypatch.setattr(time, 'sleep', sleep)
+    return sleeps
+
+
+def send_through_adapter(monkeypatch, outcomes, retries):
+    """
+    Send a request through a RateLimitedAdapter, with each attempt answered by the next of the outcomes
+    (a response, or an exception to raise).
+    :return: the response, and the number of attempts
+    """
+    attempts = []
+
+    def send(adapter, request, **kwargs):
+        outcome = outcomes[len(attempts)]
+        attempts.append(request)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+    adapter = RateLimitedAdapter(RateLimiter('limited.example.com', 0, 10, logging.getLogger('test')), retries)
+    request = requests.Request('GET', 'https://limited.example.com/users').prepare()
+    return adapter.send(request), len(attempts)
+
+
+def test_adapter_retries_throttled_requests_after_one_wait(monkeypatch, fake_clock):
+    response, attempts = send_through_adapter(monkeypatch, [make_response(429, '7'), make_response(200)], 3)
+    assert response.status_code == 200
+    assert attempts == 2
+    # the only wait is the limiter's, for as long as the server advised
+    assert fake_clock == [7.0]
+
+
+def test_adapter_gives_up_after_its_retries(monkeypatch, fake_clock):
+    response, attempts = send_through_adapter(monkeypatch, [make_response(503, '1')] * 3, 2)
+    assert response.status_code == 503
+    assert attempts == 3
+    assert fake_clock == [1.0, 1.0]
+
+
+def test_adapter_retries_failed_connections(monkeypatch, fake_clock):
+    outcomes = [requests.exceptions.ConnectionError('refused'), requests.exceptions.ReadTimeout('slow'),
+                make_response(200)]
+    response, attempts = send_through_adapter(monkeypatch, outcomes, 3)
+    assert response.status_code == 200
+    assert attempts == 3
+    assert len(fake_clock) == 2
+    assert 15 <= fake_clock[0] <= 20 and 30 <= fake_clock[1] <= 35
+    with pytest.raises(requests.exceptions.ConnectionError):
+        send_through_adapter(monkeypatch, [requests.exceptions.ConnectionError('refused')] * 2, 1)
+
+
+def test_adapter_retries_gateway_errors(monkeypatch, fake_clock):
+    # like a 503, a bad gateway or gateway timeout is retried (here with no Retry-After advice)
+    outcomes = [make_response(502), make_response(504), make_response(200)]
+    response, attempts = send_through_adapter(monkeypatch, outcomes, 3)
+    assert response.status_code == 200
+    assert attempts == 3
+    assert fake_clock == [5.0, 5.0]
+    response, attempts = send_through_adapter(monkeypatch, [make_response(500), make_response(200)], 3)
+    assert response.status_code == 500
+    assert attempts == 1
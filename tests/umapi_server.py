@@ -0,0 +1,390 @@
+"""
+A local stand-in for the User Management API, for testing and benchmarking without an Adobe org.
+
+    UMAPI_MOCK=playback python tests/umapi_server.py --users 10000 --latency 0.05 --requests-per-second 25
+
+It speaks enough of the /v2/usermanagement API for umapi_client.Connection to page through users, groups
+and user groups, and to post batches of actions, which are applied to the stand-in's users.  Responses can
+be delayed (to simulate network and server latency) and requests can be throttled with 429 responses and a
+Retry-After header, the way the real service throttles clients.
+
+Point a umapi connector at it with the existing server options:
+
+    server:
+      host: 127.0.0.1:<port>
+      endpoint: /v2/usermanagement
+
+and set UMAPI_MOCK=playback in the environment, which makes umapi_client use http and skip the
+IMS authentication exchange.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, unquote, urlparse
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        status, headers, content = self.server.stand_in.handle(method, self.path, body)
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UmapiStandIn(object):
+    """
+    An in-memory org served over http on a local port.  Users are held in UMAPI form (as returned by a users
+    query) and keyed by their lower-cased user string (username, or email for Adobe IDs).
+
+    Every request counts towards the statistics in self.stats.  If requests_per_second is set, requests over
+    that rate (within any one second) are answered with 429 and a Retry-After of retry_after seconds; if
+    throttle_every is set, every nth request is answered that way regardless of rate.
+    """
+
+    def __init__(self, org_id='org_id', users=(), groups=(), endpoint='/v2/usermanagement', page_size=200,
+                 latency=0.0, requests_per_second=0, throttle_every=0, retry_after=1):
+        """
+        :type org_id: str
+        :param users: UMAPI user dicts to start with
+        :param groups: names of the groups (product profiles and user groups) in the org, in addition to
+        any the users are in
+        :type endpoint: str
+        :param page_size: maximum number of users or groups in a page of query results
+        :param latency: seconds to wait before answering each request
+        :param requests_per_second: requests accepted in any one second before throttling (0 for no limit)
+        :param throttle_every: throttle every nth request (0 for never)
+        :param retry_after: seconds to put in the Retry-After header of throttled responses
+        """
+        self.org_id = org_id
+        self.endpoint = endpoint.rstrip('/')
+        self.page_size = page_size
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.users = {}
+        self.groups = {}
+        for name in groups:
+            self.add_group(name)
+        for user in users:
+            self.add_user(user)
+        self.accepted_times = []
+        self.active = 0
+        self.stats = {
+            'requests': 0,
+            'throttled': 0,
+            'max_concurrent': 0,
+            'user_pages': 0,
+            'group_pages': 0,
+            'user_group_pages': 0,
+            'action_batches': 0,
+            'actions': 0,
+            'action_errors': 0,
+        }
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def make_user(email, groups=(), identity_type='federatedID', username=None, domain=None,
+                  firstname='Given', lastname='Surname', country='US'):
+        return {
+            'email': email,
+            'status': 'active',
+            'username': username or email,
+            'domain': domain or email[email.find('@') + 1:],
+            'firstname': firstname,
+            'lastname': lastname,
+            'country': country,
+            'type': identity_type,
+            'groups': list(groups),
+        }
+
+    @staticmethod
+    def get_user_string(user):
+        return (user['email'] if user['type'] == 'adobeID' else user['username']).lower()
+
+    def add_user(self, user):
+        self.users[self.get_user_string(user)] = user
+        for name in user.get('groups', []):
+            self.add_group(name)
+
+    def add_group(self, name, group_type='USER_GROUP'):
+        if name.lower() not in self.groups:
+            self.groups[name.lower()] = {'groupName': name, 'type': group_type}
+        return self.groups[name.lower()]['groupName']
+
+    def start(self, port=0):
+        """
+        Start serving on a local port (any free one by default).
+        :return: the host (with port) to use as the connector's server.host option
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.stand_in = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='umapi-stand-in')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.get_host()
+
+    def get_host(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def get_connector_options(self):
+        """
+        :return: the server options that point a umapi connector at this stand-in
+        """
+        return {'host': self.get_host(), 'endpoint': self.endpoint}
+
+    def handle(self, method, path, body):
+        """
+        :return: tuple of the http status, a dict of extra headers, and the content to be sent as json
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            throttled = self.is_throttled()
+            if throttled:
+                self.stats['throttled'] += 1
+            else:
+                self.active += 1
+                self.stats['max_concurrent'] = max(self.stats['max_concurrent'], self.active)
+        if throttled:
+            return 429, {'Retry-After': str(self.retry_after)}, {'error_code': '429050', 'message': 'Too many requests'}
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            url = urlparse(path)
+            if not url.path.startswith(self.endpoint + '/'):
+                return 404, {}, {'result': 'error', 'message': 'Unknown endpoint'}
+            route = [unquote(part) for part in url.path[len(self.endpoint) + 1:].split('/')]
+            query = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+            with self.lock:
+                if method == 'GET' and route == ['status']:
+                    return 200, {}, {'state': 'LIVE', 'build': 'stand-in'}
+                if method == 'GET' and len(route) >= 3 and route[0] == 'users' and route[1] == self.org_id:
+                    return self.get_users_page(int(route[2]), route[3] if len(route) > 3 else None)
+                if method == 'GET' and len(route) == 3 and route[0] == 'groups' and route[1] == self.org_id:
+                    return self.get_groups_page(int(route[2]))
+                if method == 'GET' and route == [self.org_id, 'user-groups']:
+                    return self.get_user_groups_page(int(query.get('page', 1)))
+                if method == 'POST' and route == ['action', self.org_id]:
+                    test_only = query.get('testOnly', '').lower() == 'true'
+                    return self.execute_actions(json.loads(body.decode('utf-8')), test_only)
+            return 404, {}, {'result': 'error', 'message': 'Unknown endpoint'}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def is_throttled(self):
+        if self.throttle_every and self.stats['requests'] % self.throttle_every == 0:
+            return True
+        if self.requests_per_second:
+            now = time.time()
+            self.accepted_times = [t for t in self.accepted_times if now - t < 1.0]
+            if len(self.accepted_times) >= self.requests_per_second:
+                return True
+            self.accepted_times.append(now)
+        return False
+
+    def get_page(self, items, page):
+        """
+        :param page: page number, 0-based
+        :return: the items on the page, whether it is the last page, and the paging headers
+        """
+        page_count = max((len(items) + self.page_size - 1) // self.page_size, 1)
+        start = page * self.page_size
+        headers = {
+            'X-Total-Count': str(len(items)),
+            'X-Page-Count': str(page_count),
+            'X-Current-Page': str(page + 1),
+            'X-Page-Size': str(self.page_size),
+        }
+        return items[start:start + self.page_size], page + 1 >= page_count, headers
+
+    def get_users_page(self, page, group_name=None):
+        self.stats['user_pages'] += 1
+        users = sorted(self.users.items())
+        if group_name is not None:
+            if group_name.lower() not in self.groups:
+                return 404, {}, {'result': 'error', 'message': 'Group not found'}
+            users = [(k, u) for k, u in users if group_name.lower() in [g.lower() for g in u['groups']]]
+        users, last_page, headers = self.get_page([u for k, u in users], page)
+        return 200, headers, {'result': 'success', 'users': users, 'lastPage': last_page}
+
+    def get_member_counts(self):
+        counts = dict((key, 0) for key in self.groups)
+        for user in six.itervalues(self.users):
+            for name in user['groups']:
+                counts[name.lower()] = counts.get(name.lower(), 0) + 1
+        return counts
+
+    def get_groups_page(self, page):
+        self.stats['group_pages'] += 1
+        counts = self.get_member_counts()
+        groups = [dict(group, memberCount=counts[key]) for key, group in sorted(self.groups.items())]
+        groups, last_page, headers = self.get_page(groups, page)
+        return 200, headers, {'result': 'success', 'groups': groups, 'lastPage': last_page}
+
+    def get_user_groups_page(self, page):
+        self.stats['user_group_pages'] += 1
+        counts = self.get_member_counts()
+        groups = [{'groupId': i, 'name': group['groupName'], 'type': group['type'], 'userCount': counts[key],
+                   'adminCount': 0}
+                  for i, (key, group) in enumerate(sorted(self.groups.items()))
+                  if group['type'] == 'USER_GROUP']
+        groups, last_page, headers = self.get_page(groups, page - 1)
+        return 200, headers, groups
+
+    def execute_actions(self, actions, test_only):
+        """
+        Apply a batch of actions, reporting the first failing step of each action that fails.
+        In test mode the actions are checked against a copy of the org, which is then thrown away.
+        """
+        self.stats['action_batches'] += 1
+        self.stats['actions'] += len(actions)
+        saved = (dict((key, dict(user, groups=list(user['groups']))) for key, user in self.users.items()),
+                 dict(self.groups)) if test_only else None
+        errors = []
+        for index, action in enumerate(actions):
+            for step, command in enumerate(action.get('do', [])):
+                try:
+                    self.execute_command(action, command)
+                except ValueError as e:
+                    errors.append({'index': index, 'step': step, 'requestID': action.get('requestID'),
+                                   'message': str(e), 'errorCode': 'error.command.failed'})
+                    break
+        if saved is not None:
+            self.users, self.groups = saved
+        self.stats['action_errors'] += len(errors)
+        completed = len(actions) - len(errors)
+        content = {
+            'result': 'success' if not errors else ('partial' if completed else 'error'),
+            'completed': 0 if test_only else completed,
+            'notCompleted': len(errors),
+            'completedInTestMode': completed if test_only else 0,
+        }
+        if errors:
+            content['errors'] = errors
+        return 200, {}, content
+
+    def execute_command(self, action, command):
+        (name, params), = command.items()
+        if 'usergroup' in action:
+            if name == 'createUserGroup':
+                self.add_group(action['usergroup'])
+                return
+            raise ValueError('Unsupported user group command: %s' % name)
+        key = action['user'].lower()
+        user = self.users.get(key)
+        if name in ('addAdobeID', 'createEnterpriseID', 'createFederatedID'):
+            if user is not None:
+                if params.get('option') == 'updateIfAlreadyExists':
+                    self.update_user(user, params)
+                return
+            identity_type = {'addAdobeID': 'adobeID', 'createEnterpriseID': 'enterpriseID',
+                             'createFederatedID': 'federatedID'}[name]
+            email = params.get('email') or action['user']
+            user = self.make_user(email, identity_type=identity_type, username=action['user'],
+                                  domain=action.get('domain'), firstname=params.get('firstname'),
+                                  lastname=params.get('lastname'), country=params.get('country'))
+            self.users[key] = user
+            return
+        if user is None:
+            raise ValueError('User %s not found' % action['user'])
+        if name == 'update':
+            self.update_user(user, params)
+            if params.get('username') and params['username'].lower() != key:
+                self.users[params['username'].lower()] = self.users.pop(key)
+        elif name == 'add':
+            for group_name in params.get('group', []):
+                if group_name.lower() not in self.groups:
+                    raise ValueError('Group %s not found' % group_name)
+                if group_name.lower() not in [g.lower() for g in user['groups']]:
+                    user['groups'].append(self.groups[group_name.lower()]['groupName'])
+        elif name == 'remove':
+            groups = params.get('group', [])
+            if groups == 'all':
+                user['groups'] = []
+            else:
+                removed = set(g.lower() for g in groups)
+                user['groups'] = [g for g in user['groups'] if g.lower() not in removed]
+        elif name == 'removeFromOrg':
+            del self.users[key]
+        else:
+            raise ValueError('Unsupported user command: %s' % name)
+
+    @staticmethod
+    def update_user(user, params):
+        for field in ('email', 'username', 'firstname', 'lastname', 'country'):
+            if params.get(field) is not None:
+                user[field] = params[field]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--org-id', default='org_id')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--requests-per-second', type=int, default=0, help='throttle above this rate')
+    parser.add_argument('--throttle-every', type=int, default=0, help='throttle every nth request')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    group_names = ['Group %d' % j for j in range(args.groups)]
+    users = [UmapiStandIn.make_user('user%d@example.com' % i,
+                                    [group_names[(i + k) % args.groups] for k in range(args.groups_per_user)])
+             for i in range(args.users)]
+    stand_in = UmapiStandIn(args.org_id, users, group_names, page_size=args.page_size, latency=args.latency,
+                            requests_per_second=args.requests_per_second, throttle_every=args.throttle_every,
+                            retry_after=args.retry_after)
+    stand_in.start(args.port)
+    print('Serving org %s with %d users at http://%s%s' %
+          (args.org_id, args.users, stand_in.get_host(), stand_in.endpoint))
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(stand_in.stats, sort_keys=True))
+    except KeyboardInterrupt:
+        stand_in.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -314,6 +314,8 @@ def begin_work(config_loader):
 
     directory_connector.state.additional_group_filters = additional_group_filters
 
+    # the connectors of this run share a rate limiter for each host they talk to
+    user_sync.connector.umapi.RateLimiter.reset_limiters()
     primary_name = '.primary' if secondary_umapi_configs else ''
     umapi_primary_connector = user_sync.connector.umapi.UmapiConnector(primary_name, primary_umapi_config)
     umapi_other_connectors = {}
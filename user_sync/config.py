@@ -515,6 +515,11 @@ class ConfigLoader(object):
                     raise AssertionException(validation_message)
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
+        max_secondary_workers = adobe_config.get_int('max_secondary_workers', True)
+        if max_secondary_workers is not None:
+            if max_secondary_workers < 1:
+                raise AssertionException("max_secondary_workers value must be at least 1")
+            options['max_secondary_workers'] = max_secondary_workers
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
@@ -844,7 +849,12 @@ class ConfigFileLoader:
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
-    SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None)}
+    SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
+                            '/user_cache/path': (False, False, None),
+                            '/incremental_sync/state_path': (False, False, None),
+                            '/group_dn_cache/path': (False, False, None),
+                            '/group_index_cache/path': (False, False, None),
+                            }
 
     @classmethod
     def load_root_config(cls, filename):
@@ -18,14 +18,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import calendar
+import collections
+import re
 import six
 import string
+import sys
+import threading
+import time
 
 import ldap.controls.libldap
 
 import user_sync.config
 import user_sync.connector.helper
 import user_sync.error
+import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from ldap import dn
@@ -61,6 +68,33 @@ class LDAPDirectoryConnector(object):
     name = 'ldap'
 
     expected_result_types = [ldap.RES_SEARCH_RESULT, ldap.RES_SEARCH_ENTRY]
+    # errors reading a single entry (such as a member in another domain, or one we aren't allowed to read),
+    # which are logged and skipped rather than failing the run
+    entry_read_errors = (ldap.REFERRAL, ldap.PARTIAL_RESULTS, ldap.INSUFFICIENT_ACCESS, ldap.UNWILLING_TO_PERFORM,
+                         ldap.INVALID_DN_SYNTAX)
+
+    # the most groups looked for in one search, which keeps filters well within server limits
+    group_lookup_batch_size = 50
+    # the most searches for group members (in two_steps_lookup mode) waiting for results at once
+    member_lookup_pipeline_size = 50
+    # the most searches sharing one connection at once, with async_search
+    max_multiplexed_searches = 10
+    # the most groups whose members (found by search workers) are held in memory at once, waiting to be processed
+    max_held_group_results = 20
+    # LDAP special characters (see http://www.rfc-editor.org/rfc/rfc4515.txt), each mapped to '\' + its hex code
+    ldap_escape_table = dict((ord(c), six.text_type('\\%x') % ord(c)) for c in six.text_type('*()\\&|<>~!:'))
+    ldap_special_chars = re.compile(six.text_type(r'[*()\\&|<>~!:]'))
+
+    # the per-entry attributes that incremental sync can track changes with, each with the
+    # directory-wide attribute (if any) that holds its current high-water mark
+    change_mark_attributes = {
+        'uSNChanged': 'highestCommittedUSN',
+        'modifyTimestamp': None,
+        'entryCSN': 'contextCSN',
+    }
+    # seconds before the latest modifyTimestamp read from which changes are read again on the next run, as
+    # entries changed while the users are being read can be committed with earlier timestamps
+    change_overlap_seconds = 300
 
     def __init__(self, caller_options):
         caller_config = user_sync.config.DictConfig('%s configuration' % self.name, caller_options)
@@ -80,6 +114,15 @@ class LDAPDirectoryConnector(object):
         self.user_given_name_formatter = LDAPValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = LDAPValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = LDAPValueFormatter(options['user_country_code_format'])
+        self.user_value_plan = LDAPValuePlan([
+            self.user_email_formatter,
+            self.user_identity_type_formatter,
+            self.user_username_formatter,
+            self.user_domain_formatter,
+            self.user_given_name_formatter,
+            self.user_surname_formatter,
+            self.user_country_code_formatter,
+        ])
 
         password = caller_config.get_credential('password', options['username'])
         # this check must come after we get the password value
@@ -88,6 +131,45 @@ class LDAPDirectoryConnector(object):
         logger.debug('Connecting to: %s using username: %s', options['host'], options['username'])
         if not options['require_tls_cert']:
             ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+        self.connection = self.connect(options, password)
+        # with more than one search worker, each has a connection of its own, and the main connection is left
+        # to the main thread
+        self.worker_connections = []
+        if options['max_search_workers'] > 1:
+            for _ in range(options['max_search_workers']):
+                self.worker_connections.append(self.connect(options, password))
+        logger.debug('Connected')
+        self.user_by_dn = {}
+        # the filter for a group's users, with the group DN left to fill in (made when first needed)
+        self.group_user_filter_format = None
+        self.additional_group_filters = None
+        # when groups are taken from memberOf: the mapped groups, and their positions in that list by group DN
+        self.mapped_groups = None
+        self.group_indexes_by_dn = None
+        # set when user_by_dn is known to hold every user that matches the all_users_filter
+        self.all_users_known = False
+        self.skipped_dns = set()
+        # member DNs (in two_steps_lookup mode) found not to be users that match the all_users_filter
+        self.non_user_dns = set()
+        # the members listed by each group (and other entry) read in two_steps_lookup mode
+        self.member_dns_by_dn = {}
+        self.member_dns_lock = threading.Lock()
+        if options['incremental_sync']:
+            self.change_attribute = six.text_type(options['incremental_sync']['change_attribute'])
+            self.snapshot_file = user_sync.helper.StateFile(options['incremental_sync']['state_path'], logger)
+        else:
+            self.change_attribute = None
+            self.snapshot_file = None
+        self.max_change_value = None
+        if options['group_dn_cache']:
+            fingerprint = [options['base_dn'], options['group_filter_format']]
+            self.group_dn_cache = GroupDNCache(options['group_dn_cache']['path'], fingerprint,
+                                               options['group_dn_cache']['max_age_hours'], logger)
+        else:
+            self.group_dn_cache = None
+
+    @staticmethod
+    def connect(options, password):
         try:
             # Be careful in Py2!!  We are setting bytes_mode = False, so we must give all attribute names
             # and other protocol-defined strings (such as username) as Unicode.  But the PyYAML parser
@@ -99,10 +181,7 @@ class LDAPDirectoryConnector(object):
             connection.simple_bind_s(six.text_type(options['username']), six.text_type(password))
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
-        self.connection = connection
-        logger.debug('Connected')
-        self.user_by_dn = {}
-        self.additional_group_filters = None
+        return connection
 
     @staticmethod
     def get_options(caller_config):
@@ -114,6 +193,9 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('group_member_filter_format', None)
         builder.set_bool_value('require_tls_cert', False)
         builder.set_dict_value('two_steps_lookup', None)
+        builder.set_bool_value('groups_from_member_of', False)
+        builder.set_dict_value('incremental_sync', None)
+        builder.set_dict_value('group_dn_cache', None)
         builder.set_string_value('string_encoding', 'utf8')
         builder.set_string_value('user_identity_type_format', None)
         builder.set_string_value('user_email_format', six.text_type('{mail}'))
@@ -124,25 +206,49 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('user_country_code_format', six.text_type('{c}'))
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_int_value('max_search_workers', 1)
+        builder.set_bool_value('async_search', False)
         builder.set_string_value('logger_name', LDAPDirectoryConnector.name)
         builder.require_string_value('host')
         builder.require_string_value('username')
         builder.require_string_value('base_dn')
         options = builder.get_options()
+        if options['max_search_workers'] < 1:
+            raise AssertionException('max_search_workers must be at least 1')
         options['two_steps_enabled'] = False
         if options['two_steps_lookup'] is not None:
             ts_config = caller_config.get_dict_config('two_steps_lookup', True)
             ts_builder = user_sync.config.OptionsBuilder(ts_config)
             ts_builder.require_string_value('group_member_attribute_name')
             ts_builder.set_bool_value('nested_group', False)
+            ts_builder.set_bool_value('nested_group_in_chain', False)
             options['two_steps_enabled'] = True
             options['two_steps_lookup'] = ts_builder.get_options()
             if options['group_member_filter_format']:
                 raise AssertionException(
                     "Cannot define both 'group_member_attribute_name' and 'group_member_filter_format' in config")
+            if options['groups_from_member_of']:
+                raise AssertionException("Cannot define both 'two_steps_lookup' and 'groups_from_member_of' in config")
         else:
             if not options['group_member_filter_format']:
                 options['group_member_filter_format'] = six.text_type('(memberOf={group_dn})')
+        if options['incremental_sync'] is not None:
+            is_config = caller_config.get_dict_config('incremental_sync', True)
+            is_builder = user_sync.config.OptionsBuilder(is_config)
+            is_builder.require_string_value('state_path')
+            is_builder.set_string_value('change_attribute', 'uSNChanged')
+            is_builder.set_int_value('full_refresh_hours', 24)
+            options['incremental_sync'] = is_builder.get_options()
+            change_attribute = options['incremental_sync']['change_attribute']
+            if change_attribute not in LDAPDirectoryConnector.change_mark_attributes:
+                raise AssertionException("incremental_sync: change_attribute must be one of: %s" %
+                                         ', '.join(sorted(LDAPDirectoryConnector.change_mark_attributes)))
+        if options['group_dn_cache'] is not None:
+            cache_config = caller_config.get_dict_config('group_dn_cache', True)
+            cache_builder = user_sync.config.OptionsBuilder(cache_config)
+            cache_builder.require_string_value('path')
+            cache_builder.set_int_value('max_age_hours', 24)
+            options['group_dn_cache'] = cache_builder.get_options()
         return options
 
     def load_users_and_groups(self, groups, extended_attributes, all_users):
@@ -151,89 +257,605 @@ class LDAPDirectoryConnector(object):
         :type extended_attributes: list(str)
         :type all_users: bool
         :rtype (bool, iterable(dict))
+        :return: the users, each yielded as soon as it is complete (with all its groups)
         """
         options = self.options
-        user = {}
         base_dn = six.text_type(options['base_dn'])
         all_users_filter = six.text_type(options['all_users_filter'])
-        group_member_filter_format = six.text_type(options['group_member_filter_format'])
-        grouped_user_records = {}
-        if options['two_steps_enabled']:
-            group_member_attribute_name = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
+        self.member_dns_by_dn = {}
+
+        # when memberOf can be trusted, the groups of every user are found in a single pass over all the users
+        single_pass = all_users and options['groups_from_member_of']
+        if single_pass:
+            self.index_mapped_groups(groups)
+
+        # with incremental sync, every user is loaded from the snapshot (and the changes since it was taken)
+        if options['incremental_sync']:
+            self.load_user_snapshot(extended_attributes)
 
-        # save all the users to memory for faster 2-steps lookup or all_users process
-        if all_users:
+        # when all users are requested, read them all first, in the one search that is done for them;
+        # the searches for group members then only need to find the DNs of users that are already known.
+        # If no group searches are needed, each user is complete when read, so it is passed on right away.
+        stream_users = all_users and (single_pass or not groups)
+        streamed = False
+        if all_users and not self.all_users_known:
             try:
-                all_users_records = dict(self.iter_users(base_dn, all_users_filter, extended_attributes))
+                for _, user in self.iter_users(base_dn, all_users_filter, extended_attributes):
+                    if stream_users:
+                        yield user
+                streamed = stream_users
+            except AssertionException:
+                raise
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+            self.all_users_known = True
 
         # for each group that's required, do one search for the users of that group
-        for group in groups:
-            group_users = 0
-            group_dn = self.find_ldap_group_dn(group)
+        # (the searches may run in parallel, but their results are processed here, in the order of the groups)
+        searched_groups = [] if single_pass else groups
+        for group, group_dn, members in self.iter_group_member_searches(searched_groups, extended_attributes):
             if not group_dn:
                 self.logger.warning("No group found for: %s", group)
                 continue
-            group_member_subfilter = self.format_ldap_query_string(group_member_filter_format, group_dn=group_dn)
-            if not group_member_subfilter.startswith('('):
-                group_member_subfilter = six.text_type('(') + group_member_subfilter + six.text_type(')')
-            user_subfilter = all_users_filter
-            if not user_subfilter.startswith('('):
-                user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
-            group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
             group_users = 0
             try:
                 if options['two_steps_enabled']:
-                    for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
-                        # check to make sure user_dn are within the base_dn scope
-                        if self.is_dn_within_base_dn_scope(base_dn, user_dn):
-                            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
-                            result = list(self.iter_users(user_dn, all_users_filter, extended_attributes))
-                            if result:
-                                # iter_users should only return 1 user when doing two_steps lookup.
-                                if len(result) > 1:
-                                    raise AssertionException(
-                                        "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
-                                else:
-                                    user = result[0][1]
-                                    user['groups'].append(group)
-                                    group_users += 1
-                                    grouped_user_records[user_dn] = user
+                    # the members are the DNs listed in the group
+                    member_users = self.iter_member_users(members, all_users_filter, extended_attributes)
                 else:
-                    for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
-                        user['groups'].append(group)
-                        group_users += 1
-                        grouped_user_records[user_dn] = user
+                    # the members are the results of a search for them
+                    member_users = self.iter_users(base_dn, self.format_group_user_filter(group_dn),
+                                                   extended_attributes, search_results=members)
+                for _, user in member_users:
+                    user['groups'].append(group)
+                    group_users += 1
+            except AssertionException:
+                raise
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
             self.logger.debug('Count of users in group "%s": %d', group, group_users)
 
-        # if all users are requested, do an additional search for all of them
-        if all_users:
-            ungrouped_users = 0
-            grouped_users = 0
+        # every user has been read by now, with their groups
+        if all_users and groups:
+            grouped_users = sum(1 for user in six.itervalues(self.user_by_dn) if user['groups'])
+            self.logger.debug('Count of users in any groups: %d', grouped_users)
+            self.logger.debug('Count of users not in any groups: %d', len(self.user_by_dn) - grouped_users)
+
+        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
+        if not streamed:
+            # the snapshot holds every user, but only the members of the groups are wanted without all_users
+            for user in six.itervalues(self.user_by_dn):
+                if all_users or user['groups']:
+                    yield user
+
+    def index_mapped_groups(self, groups):
+        """
+        Find the DN of each mapped group, so users can be given their mapped groups from their memberOf values.
+        :type groups: list(str)
+        """
+        self.mapped_groups = list(groups)
+        self.group_indexes_by_dn = {}
+        group_dn_by_name = self.find_ldap_group_dns(groups)
+        for index, group in enumerate(groups):
+            group_dn = group_dn_by_name.get(group)
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            self.group_indexes_by_dn.setdefault(self.normalize_dn(group_dn), []).append(index)
+
+    def get_mapped_groups(self, record):
+        """
+        :param record: the attributes of a user, including memberOf
+        :return: the mapped groups the user is a direct member of, in the order they are mapped
+        :rtype list(str)
+        """
+        member_dns = LDAPValueFormatter.get_attribute_value(record, six.text_type('memberOf'))
+        if not member_dns:
+            return []
+        if not isinstance(member_dns, list):
+            member_dns = [member_dns]
+        indexes = set()
+        for member_dn in member_dns:
+            indexes.update(self.group_indexes_by_dn.get(self.normalize_dn(member_dn), ()))
+        return [self.mapped_groups[index] for index in sorted(indexes)]
+
+    @staticmethod
+    def normalize_dn(value):
+        """
+        :return: the DN in a form that is the same for every way of writing it
+        :rtype str
+        """
+        try:
+            return dn.dn2str(dn.str2dn(value.lower()))
+        except ldap.DECODING_ERROR:
+            return value.lower()
+
+    def iter_group_member_searches(self, groups, extended_attributes):
+        """
+        Find the members of each group, with up to max_search_workers groups being searched at the same time
+        (each on a worker connection of its own).  With async_search and a single worker, several searches
+        share the main connection instead (see iter_multiplexed_search_results).  Results are yielded in the
+        order of the groups, whatever order the searches finish in, so users are always given their groups in
+        the same order.  Each group's results are held in memory until it is yielded, so the workers stop
+        starting new groups while max_held_group_results of them are held (or being searched).
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :rtype iterable(tuple(str, str, list))
+        :return: for each group, the group, its DN, and its members (see search_group_members)
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        group_dn_by_name = self.find_ldap_group_dns(groups)
+        found_groups = [(group, group_dn_by_name[group]) for group in groups if group in group_dn_by_name]
+        worker_count = min(len(self.worker_connections), len(found_groups))
+        if worker_count <= 1 and self.options['async_search'] and not self.options['two_steps_enabled']:
+            # the searches share the main connection, several at a time
+            attribute_names = self.get_user_search_attribute_names(extended_attributes)
+            searches = ((index, base_dn, self.format_group_user_filter(group_dn), attribute_names)
+                        for index, (group, group_dn) in enumerate(found_groups))
+            multiplexed_results = self.iter_multiplexed_search_results(searches)
             try:
-                for user_dn, user in self.iter_users(all_users_filter, extended_attributes):
-                    if not user['groups']:
-                        ungrouped_users += 1
-                    else:
-                        grouped_users += 1
-                if groups:
-                    self.logger.debug('Count of users in any groups: %d', grouped_users)
-                    self.logger.debug('Count of users not in any groups: %d', ungrouped_users)
+                finished = {}
+                index = 0
+                for group in groups:
+                    if group not in group_dn_by_name:
+                        yield group, None, []
+                        continue
+                    while index not in finished:
+                        finished_index, search_results = next(multiplexed_results)
+                        finished[finished_index] = search_results
+                    yield group, group_dn_by_name[group], finished.pop(index)
+                    index += 1
+            except AssertionException:
+                raise
             except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+                raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+            finally:
+                multiplexed_results.close()
+            return
+        if worker_count <= 1:
+            for group in groups:
+                group_dn = group_dn_by_name.get(group)
+                member_searches = self.search_group_members(group_dn, extended_attributes) if group_dn else []
+                yield group, group_dn, member_searches
+            return
+        pending = six.moves.queue.Queue()
+        for index, (group, group_dn) in enumerate(found_groups):
+            pending.put((index, group_dn))
+        results = six.moves.queue.Queue()
+        stopped = []
+        # groups are taken in order, so the next group to yield is always taken before a slot is needed for it
+        held_slots = threading.Semaphore(max(self.max_held_group_results, worker_count))
 
-        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
-        return six.itervalues(self.user_by_dn)
+        def run_worker(connection):
+            while True:
+                held_slots.acquire()
+                if stopped:
+                    return
+                try:
+                    index, group_dn = pending.get_nowait()
+                except six.moves.queue.Empty:
+                    return
+                try:
+                    results.put((index, self.search_group_members(group_dn, extended_attributes, connection), None))
+                except Exception:
+                    results.put((index, None, sys.exc_info()))
+
+        workers = [threading.Thread(target=run_worker, args=(connection,), name='ldap-search-%d' % (i + 1))
+                   for i, connection in enumerate(self.worker_connections[:worker_count])]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            finished = {}
+            index = 0
+            for group in groups:
+                if group not in group_dn_by_name:
+                    yield group, None, []
+                    continue
+                while index not in finished:
+                    finished_index, result, exc_info = results.get()
+                    finished[finished_index] = (result, exc_info)
+                member_searches, exc_info = finished.pop(index)
+                index += 1
+                held_slots.release()
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                yield group, group_dn_by_name[group], member_searches
+        finally:
+            stopped.append(True)
+            for worker in workers:
+                held_slots.release()
+            for worker in workers:
+                worker.join()
+
+    def search_group_members(self, group_dn, extended_attributes, connection=None):
+        """
+        Find the members of a group, without processing the results (which are all held in memory).
+        :type group_dn: str
+        :type extended_attributes: list(str)
+        :param connection: the connection to search on (the main connection by default)
+        :return: in two_steps_lookup mode, the DNs of the members that are within the base DN (which are read
+        by iter_member_users); otherwise, the results of a search for the members
+        :rtype list
+        """
+        options = self.options
+        base_dn = six.text_type(options['base_dn'])
+        try:
+            if options['two_steps_enabled']:
+                member_attribute = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
+                return [user_dn for user_dn in self.iter_group_member_dns(group_dn, member_attribute,
+                                                                          connection=connection)
+                        if self.is_dn_within_base_dn_scope(base_dn, user_dn)]
+            attribute_names = self.get_user_search_attribute_names(extended_attributes)
+            return list(self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, self.format_group_user_filter(group_dn),
+                                                attribute_names, connection))
+        except AssertionException:
+            raise
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
 
-    def find_ldap_group_dn(self, group):
+    def iter_member_users(self, member_dns, all_users_filter, extended_attributes):
+        """
+        Yield the users (that match the all_users_filter) among the given member DNs.  Members that have already
+        been read, or found not to be users, for an earlier group are not searched for again; the others are
+        read with base searches that are sent member_lookup_pipeline_size at a time, without waiting for each
+        one's result before sending the next.
+        :type member_dns: list(str)
+        :type all_users_filter: str
+        :type extended_attributes: list(str)
+        :rtype iterable(tuple(str, dict))
+        """
+        if not self.all_users_known:
+            unread_dns = [user_dn for user_dn in member_dns
+                          if user_dn not in self.user_by_dn and user_dn not in self.non_user_dns]
+            attribute_names = self.get_user_search_attribute_names(extended_attributes)
+            for user_dn, search_results in self.iter_base_search_results(unread_dns, all_users_filter,
+                                                                         attribute_names):
+                if not any(True for _ in self.iter_users(user_dn, all_users_filter, extended_attributes,
+                                                         search_results=search_results)):
+                    self.non_user_dns.add(user_dn)
+        for user_dn in member_dns:
+            user = self.user_by_dn.get(user_dn)
+            if user is not None:
+                yield user_dn, user
+
+    def iter_base_search_results(self, base_dns, filter_string, attributes, connection=None):
+        """
+        Do a base search of each DN with the filter, keeping up to member_lookup_pipeline_size searches
+        outstanding at once.  DNs that don't exist, or that can't be read (see entry_read_errors), give no
+        results.
+        :type base_dns: list(str)
+        :type filter_string: str
+        :type attributes: list(str)
+        :param connection: the connection to search on (the main connection by default)
+        :rtype iterable(tuple(str, list))
+        :return: each DN, with the results of its search
+        """
+        connection = connection or self.connection
+        pending = collections.deque()
+        base_dn_iter = iter(base_dns)
+        try:
+            while True:
+                for base_dn in base_dn_iter:
+                    msgid = connection.search_ext(base_dn, ldap.SCOPE_BASE, filterstr=filter_string,
+                                                  attrlist=attributes)
+                    pending.append((base_dn, msgid))
+                    if len(pending) >= self.member_lookup_pipeline_size:
+                        break
+                if not pending:
+                    return
+                base_dn, msgid = pending.popleft()
+                try:
+                    result_type, response_data, _rmsgid = connection.result2(msgid)
+                except ldap.NO_SUCH_OBJECT:
+                    self.logger.debug('No object found for member: %s', base_dn)
+                    result_type, response_data = None, None
+                except self.entry_read_errors as e:
+                    self.logger.warning('Error lookup %s : %s', base_dn, e)
+                    result_type, response_data = None, None
+                if result_type in self.expected_result_types and response_data is not None:
+                    yield base_dn, response_data
+                else:
+                    yield base_dn, []
+        finally:
+            # when the results aren't all read (because of an error, or because the caller stopped early)
+            for _, msgid in pending:
+                connection.abandon(msgid)
+
+    def load_user_snapshot(self, extended_attributes):
+        """
+        Fill user_by_dn with every user that matches the all_users_filter, and save them to the snapshot file.
+        If the snapshot is recent enough, and was taken with the same settings, only the entries that have changed
+        since it was taken are read: each is read in full if it is still a user, and dropped if not.  Otherwise
+        all the users are read.  Users deleted from the directory (and users that come into scope without a
+        change to their own entry) are only seen by a full read, unless memberOf values have to be listed for
+        every user anyway (see prune_user_snapshot).
+        :type extended_attributes: list(str)
+        """
+        sync_options = self.options['incremental_sync']
+        base_dn = six.text_type(self.options['base_dn'])
+        all_users_filter = six.text_type(self.options['all_users_filter'])
+        fingerprint = self.get_snapshot_fingerprint(extended_attributes)
+        state = self.snapshot_file.load()
+        now = time.time()
+        # read the high-water mark before searching, so changes made during the search are seen next time
+        server_mark = self.read_change_mark()
+        self.max_change_value = None
+        try:
+            if (state and state.get('fingerprint') == fingerprint and state.get('mark') is not None and
+                    now - state.get('refreshed', 0) < sync_options['full_refresh_hours'] * 3600):
+                self.logger.info('Reading users changed since %s %s', self.change_attribute, state['mark'])
+                refreshed = state['refreshed']
+                old_mark = state['mark']
+                self.user_by_dn = dict((user_dn, user_sync.connector.helper.DirectoryUser(user))
+                                       for user_dn, user in six.iteritems(state['users']))
+                self.skipped_dns = set(state.get('skipped_dns', []))
+                # LDAP has no greater-than filter, so timestamps and CSNs equal to the mark are read again
+                first_change = str(int(old_mark) + 1) if self.change_attribute == 'uSNChanged' else old_mark
+                change_filter = self.format_ldap_query_string(six.text_type('({attr}>={mark})'),
+                                                              attr=self.change_attribute,
+                                                              mark=six.text_type(first_change))
+                # every entry that has changed is dropped, and then read again if it is (still) a user
+                changed_entries = 0
+                for user_dn, _ in self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, change_filter,
+                                                          [six.text_type('1.1')]):
+                    if user_dn is not None:
+                        self.user_by_dn.pop(user_dn, None)
+                        self.skipped_dns.discard(user_dn)
+                        changed_entries += 1
+                changed_filter = (six.text_type('(&') + self.parenthesize(all_users_filter) + change_filter +
+                                  six.text_type(')'))
+                changed_users = 0
+                for _ in self.iter_users(base_dn, changed_filter, extended_attributes, reload=True):
+                    changed_users += 1
+                self.logger.info('Entries changed since the last run: %d, of which users: %d',
+                                 changed_entries, changed_users)
+                if self.additional_group_filters or self.group_indexes_by_dn is not None:
+                    self.prune_user_snapshot(base_dn, all_users_filter, extended_attributes)
+            else:
+                self.logger.info('Reading all users to create a new snapshot')
+                refreshed = now
+                old_mark = None
+                self.user_by_dn = {}
+                self.skipped_dns = set()
+                for _ in self.iter_users(base_dn, all_users_filter, extended_attributes, reload=True):
+                    pass
+        except AssertionException:
+            raise
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+        self.all_users_known = True
+        change_value = self.max_change_value
+        if change_value is not None and self.change_attribute == 'modifyTimestamp':
+            change_value = self.rewind_timestamp(change_value, self.change_overlap_seconds)
+        mark = server_mark or change_value or old_mark
+        self.snapshot_file.save({
+            'fingerprint': fingerprint,
+            'refreshed': refreshed,
+            'mark': mark,
+            'users': dict((user_dn, user.to_dict()) for user_dn, user in six.iteritems(self.user_by_dn)),
+            'skipped_dns': sorted(self.skipped_dns),
+        })
+        # groups are found again on every run (when they come from memberOf, they have just been read)
+        if self.group_indexes_by_dn is None:
+            for user in six.itervalues(self.user_by_dn):
+                user['groups'] = []
+
+    def prune_user_snapshot(self, base_dn, all_users_filter, extended_attributes):
+        """
+        List the DNs and memberOf values of the users that match the all_users_filter, and remove any other
+        users from user_by_dn.  Adding a member to a group doesn't change the member's entry in Active Directory,
+        so when users' groups (or member groups) come from memberOf, this listing is needed on every run to
+        find them; any user that has come into scope without a change to its own entry is read in full.
+        """
+        member_of = six.text_type('memberOf')
+        listed_dns = set()
+        for user_dn, record in self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, all_users_filter,
+                                                       [member_of]):
+            if user_dn is None:
+                continue
+            listed_dns.add(user_dn)
+            user = self.user_by_dn.get(user_dn)
+            if user is not None:
+                if self.additional_group_filters:
+                    user['member_groups'] = self.get_member_groups(record)
+                if self.group_indexes_by_dn is not None:
+                    user['groups'] = self.get_mapped_groups(record)
+        removed_dns = [user_dn for user_dn in self.user_by_dn if user_dn not in listed_dns]
+        for user_dn in removed_dns:
+            del self.user_by_dn[user_dn]
+        self.skipped_dns &= listed_dns
+        self.logger.info('Users removed since the last run: %d', len(removed_dns))
+        new_dns = listed_dns.difference(self.user_by_dn, self.skipped_dns)
+        for user_dn in new_dns:
+            for _ in self.iter_users(user_dn, all_users_filter, extended_attributes, reload=True):
+                pass
+
+    def get_snapshot_fingerprint(self, extended_attributes):
+        """
+        The settings that determine which users are in the snapshot and how their values are built,
+        so that a snapshot taken with different settings is not used.
+        :rtype list
+        """
+        options = self.options
+        fingerprint = [options['base_dn'], options['all_users_filter'], options['string_encoding'],
+                       options['user_identity_type'], self.change_attribute,
+                       bool(self.additional_group_filters), sorted(set(extended_attributes))]
+        fingerprint.extend(options[key] for key in sorted(options) if key.startswith('user_') and key.endswith('_format'))
+        return fingerprint
+
+    def read_change_mark(self):
+        """
+        Read the directory's current high-water mark for the change attribute (such as the highestCommittedUSN
+        of an Active Directory server, or the contextCSN of an OpenLDAP database), or None if there isn't one.
+        Note that in Active Directory, USNs are local to each domain controller: the host must always be
+        the same server for incremental sync to see every change.
+        :rtype str
+        """
+        mark_attribute = self.change_mark_attributes[self.change_attribute]
+        if mark_attribute is None:
+            return None
+        mark_attribute = six.text_type(mark_attribute)
+        try:
+            if mark_attribute == 'contextCSN':
+                mark_dn = self.find_naming_context()
+            else:
+                mark_dn = six.text_type('')
+            result = self.connection.search_s(mark_dn, ldap.SCOPE_BASE, attrlist=[mark_attribute])
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading %s: %s' % (mark_attribute, e))
+        values = LDAPValueFormatter.get_attribute_value(result[0][1], mark_attribute) if result else None
+        if not values:
+            self.logger.warning('No %s found, using the largest %s read instead', mark_attribute, self.change_attribute)
+            return None
+        if not isinstance(values, list):
+            values = [values]
+        return max(values, key=self.change_value_key)
+
+    def find_naming_context(self):
+        """
+        :return: the DN of the naming context (database suffix) that holds the base_dn
+        :rtype str
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        attribute_name = six.text_type('namingContexts')
+        result = self.connection.search_s(six.text_type(''), ldap.SCOPE_BASE, attrlist=[attribute_name])
+        contexts = LDAPValueFormatter.get_attribute_value(result[0][1], attribute_name) if result else None
+        if not isinstance(contexts, list):
+            contexts = [contexts] if contexts else []
+        contexts = [context for context in contexts if self.is_dn_within_base_dn_scope(context, base_dn)]
+        return max(contexts, key=len) if contexts else base_dn
+
+    def change_value_key(self, value):
+        """
+        :return: a sort key that orders values of the change attribute from oldest to newest
+        """
+        if self.change_attribute == 'uSNChanged':
+            return int(value)
+        return value
+
+    def rewind_timestamp(self, value, seconds):
+        """
+        :param value: an LDAP generalized time in UTC (such as 20180102030405.0Z)
+        :return: the generalized time the given number of seconds earlier, or value itself if it can't be read
+        :rtype str
+        """
+        match = re.match(r'^(\d{14})(\.\d+)?Z$', value)
+        if not match:
+            self.logger.warning('Unexpected %s value: %s', self.change_attribute, value)
+            return value
+        timestamp = calendar.timegm(time.strptime(match.group(1), '%Y%m%d%H%M%S')) - seconds
+        return six.text_type(time.strftime('%Y%m%d%H%M%SZ', time.gmtime(timestamp)))
+
+    def note_change_value(self, record):
+        value = LDAPValueFormatter.get_attribute_value(record, self.change_attribute, first_only=True)
+        if value and (self.max_change_value is None or
+                      self.change_value_key(value) > self.change_value_key(self.max_change_value)):
+            self.max_change_value = value
+
+    @staticmethod
+    def parenthesize(filter_string):
+        if not filter_string.startswith('('):
+            filter_string = six.text_type('(') + filter_string + six.text_type(')')
+        return filter_string
+
+    def find_ldap_group_dns(self, groups):
+        """
+        Find the DNs of groups: from the group DN cache (if there is one), and otherwise with searches that
+        each look for up to group_lookup_batch_size groups at once.  Batches need the group_filter_format to
+        match the group name against a single attribute (as in "(&(objectClass=group)(cn={group}))");
+        with any other format, each group is searched for on its own.
+        :type groups: list(str)
+        :return: the DN of each group that was found, by group name
+        :rtype dict(str, str)
+        """
+        group_dn_by_name = self.group_dn_cache.get_dns(groups) if self.group_dn_cache else {}
+        missing_groups = []
+        for group in groups:
+            if group not in group_dn_by_name and group not in missing_groups:
+                missing_groups.append(group)
+        if not missing_groups:
+            return group_dn_by_name
+        name_attribute = self.get_group_name_attribute()
+        found_dn_by_name = {}
+        if name_attribute is None:
+            for group in missing_groups:
+                group_dn = self.find_ldap_group_dn(group)
+                if group_dn:
+                    found_dn_by_name[group] = group_dn
+        else:
+            for start in range(0, len(missing_groups), self.group_lookup_batch_size):
+                batch = missing_groups[start:start + self.group_lookup_batch_size]
+                found_dn_by_name.update(self.find_ldap_group_dn_batch(batch, name_attribute))
+        self.logger.debug('Found the DNs of %d groups with %d searches', len(found_dn_by_name),
+                          len(missing_groups) if name_attribute is None else
+                          (len(missing_groups) - 1) // self.group_lookup_batch_size + 1)
+        if self.group_dn_cache:
+            self.group_dn_cache.add_dns(found_dn_by_name)
+            self.group_dn_cache.save()
+        group_dn_by_name.update(found_dn_by_name)
+        return group_dn_by_name
+
+    def get_group_name_attribute(self):
+        """
+        :return: the attribute that the group_filter_format matches group names against, or None if that
+        isn't a single attribute
+        :rtype str
+        """
+        group_filter_format = six.text_type(self.options['group_filter_format'])
+        if group_filter_format.count('{group}') != 1:
+            return None
+        match = re.search(r'\(([A-Za-z0-9;.-]+)=\{group\}\)', group_filter_format)
+        return six.text_type(match.group(1)) if match else None
+
+    def find_ldap_group_dn_batch(self, groups, name_attribute):
+        """
+        Find the DNs of several groups with a single search.
+        :type groups: list(str)
+        :param name_attribute: the attribute that holds group names
+        :rtype dict(str, str)
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        group_filter_format = six.text_type(self.options['group_filter_format'])
+        # the server compares names without regard to case, as a search for each group would
+        groups_by_key = {}
+        for group in groups:
+            groups_by_key.setdefault(group.lower(), []).append(group)
+        for same_groups in six.itervalues(groups_by_key):
+            if len(same_groups) > 1:
+                self.logger.warning('Groups that differ only in case are the same LDAP group: %s',
+                                    ', '.join(same_groups))
+        group_dn_by_name = {}
+        # an escaped group name can't start with '(', so the format can be parenthesized before it is filled in
+        format_group_filter = self.parenthesize(group_filter_format).format
+        escape = self.escape_ldap_value
+        try:
+            filter_string = six.text_type('(|') + six.text_type('').join(
+                format_group_filter(group=escape(group)) for group in groups) + six.text_type(')')
+            res = self.connection.search_s(base_dn, ldap.SCOPE_SUBTREE, filterstr=filter_string,
+                                           attrlist=[name_attribute])
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group info: %s' % e)
+        for group_dn, attributes in res:
+            if not group_dn:
+                continue
+            names = LDAPValueFormatter.get_attribute_value(attributes, name_attribute) or []
+            if not isinstance(names, list):
+                names = [names]
+            for name in names:
+                for group in groups_by_key.get(name.lower(), ()):
+                    if group_dn_by_name.get(group, group_dn) != group_dn:
+                        raise AssertionException("Multiple LDAP groups found for: %s" % group)
+                    group_dn_by_name[group] = group_dn
+        return group_dn_by_name
+
+    def find_ldap_group_dn(self, group, connection=None):
         """
         :type group: str
+        :param connection: the connection to search on (the main connection by default)
         :rtype str
         """
-        connection = self.connection
+        connection = connection or self.connection
         options = self.options
         base_dn = six.text_type(options['base_dn'])
         group_filter_format = six.text_type(options['group_filter_format'])
@@ -251,59 +873,121 @@ class LDAPDirectoryConnector(object):
                 group_dn = current_tuple[0]
         return group_dn
 
-    def iter_group_member_dns(self, group_dn, member_attribute, searched_dns=None):
+    def iter_group_member_dns(self, group_dn, member_attribute, connection=None):
         """
-        return group memberships dns from specified membership attribute in LDAP group object
-        :type group: str
+        return group memberships dns from specified membership attribute in LDAP group object.
+        With nested_group, the members of member groups are included (as are the member groups themselves),
+        found level by level; the members listed by each group are read at most once per run, however many
+        mapped groups it is nested in.  Members outside the base DN (such as those in other domains) are
+        passed on, but not read in turn.  With nested_group_in_chain, the server does the expansion instead.
+        :type group_dn: str
         :type member_attribute: str
+        :param connection: the connection to search on (the main connection by default)
         :rtype iterable(str)
         """
-        if searched_dns is None:
-            searched_dns = []
-        connection = self.connection
-        nested_group_search = self.options['two_steps_lookup']['nested_group']
+        two_steps_options = self.options['two_steps_lookup']
+        if two_steps_options['nested_group'] and two_steps_options['nested_group_in_chain']:
+            for member_dn in self.find_nested_member_dns_in_chain(group_dn, connection):
+                yield member_dn
+            return
+        base_dn = six.text_type(self.options['base_dn'])
+        searched_dns = {group_dn}
+        level = [group_dn]
+        while level:
+            self.read_member_dns(level, member_attribute, connection)
+            with self.member_dns_lock:
+                listed_dns = [listed_dn for member_dn in level
+                              for listed_dn in self.member_dns_by_dn.get(member_dn, ())]
+            next_level = []
+            for member_dn in listed_dns:
+                if member_dn not in searched_dns:
+                    searched_dns.add(member_dn)
+                    if self.is_dn_within_base_dn_scope(base_dn, member_dn):
+                        next_level.append(member_dn)
+                    yield member_dn
+            level = next_level if two_steps_options['nested_group'] else []
+
+    def read_member_dns(self, dns, member_attribute, connection=None):
+        """
+        Read the members listed by each of the entries with the given DNs (that haven't been read already this
+        run) into member_dns_by_dn.  Entries that aren't groups (or don't exist, or can't be read) list no
+        members.  The search workers share member_dns_by_dn, so it is only used while holding member_dns_lock.
+        :type dns: list(str)
+        :type member_attribute: str
+        """
+        with self.member_dns_lock:
+            unread_dns = [member_dn for member_dn in dns if member_dn not in self.member_dns_by_dn]
         try:
-            result = connection.search_s(group_dn, ldap.SCOPE_SUBTREE, attrlist=[member_attribute])
-            if member_attribute in result[0][1]:
-                for member_dn in result[0][1][member_attribute]:
-                    member_dn = member_dn.decode('utf-8')
-                    # if nested_group search enabled, look up DN and see if group member attribute exist in that object
-                    # This will recurse through until there is no nested group.
-                    if member_dn not in searched_dns:
-                        searched_dns.append(member_dn)
-                        if nested_group_search:
-                            nested_members = self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
-                            for nested_member_dn in nested_members:
-                                yield nested_member_dn
-                        yield member_dn
+            for member_dn, search_results in self.iter_base_search_results(
+                    unread_dns, six.text_type('(objectClass=*)'), [member_attribute], connection):
+                listed_dns = []
+                for _, record in search_results:
+                    for listed_dn in record.get(member_attribute, ()):
+                        listed_dns.append(listed_dn.decode('utf-8'))
+                with self.member_dns_lock:
+                    self.member_dns_by_dn[member_dn] = listed_dns
         except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+
+    def find_nested_member_dns_in_chain(self, group_dn, connection=None):
+        """
+        Find every direct and nested member of a group with the Active Directory matching rule that follows
+        chains of memberOf values (LDAP_MATCHING_RULE_IN_CHAIN).
+        :type group_dn: str
+        :rtype list(str)
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        filter_string = self.format_ldap_query_string(
+            six.text_type('(memberOf:1.2.840.113556.1.4.1941:={group_dn})'), group_dn=group_dn)
+        try:
+            return [member_dn for member_dn, _ in self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, filter_string,
+                                                                          [six.text_type('1.1')], connection)
+                    if member_dn is not None]
+        except self.entry_read_errors as e:
             self.logger.warning('Error lookup %s : %s', group_dn, e)
-            pass
-
-    def iter_users(self, base_dn, users_filter, extended_attributes):
-        user_attribute_names = []
-        user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
-        user_attribute_names.append(six.text_type('memberOf'))
+            return []
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
 
+    def iter_users(self, base_dn, users_filter, extended_attributes, reload=False, search_results=None):
+        """
+        :param reload: if True, read users in full even if they have already been read
+        :param search_results: the results of a search already done for these users, with the attributes
+        from get_user_search_attribute_names (to use instead of searching again)
+        :rtype iterable(tuple(str, dict))
+        """
+        if self.all_users_known and not reload:
+            # we already have every user, so only their DNs are needed
+            if search_results is None:
+                search_results = self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, users_filter,
+                                                         [six.text_type('1.1')])
+            for user_dn, _ in search_results:
+                if user_dn is not None and user_dn in self.user_by_dn:
+                    yield (user_dn, self.user_by_dn[user_dn])
+            return
+
+        user_attribute_names = self.get_user_attribute_names()
         extended_attributes = [six.text_type(attr) for attr in extended_attributes]
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
-        user_attribute_names.extend(extended_attributes)
 
-        result_iter = self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, users_filter, user_attribute_names)
-        for dn, record in result_iter:
+        if search_results is None:
+            search_results = self.iter_search_result(base_dn, ldap.SCOPE_SUBTREE, users_filter,
+                                                     self.get_user_search_attribute_names(extended_attributes))
+        for dn, record in search_results:
             if dn is None:
                 continue
-            if dn in self.user_by_dn:
+            if self.change_attribute:
+                self.note_change_value(record)
+            if reload:
+                self.user_by_dn.pop(dn, None)
+                self.skipped_dns.add(dn)
+            elif dn in self.user_by_dn:
                 yield (dn, self.user_by_dn[dn])
                 continue
 
-            email, last_attribute_name = self.user_email_formatter.generate_value(record)
+            (email_result, identity_type_result, username_result, domain_result, given_name_result, sn_result,
+             c_result) = self.user_value_plan.generate_values(record)
+            email, last_attribute_name = email_result
             email = email.strip() if email else None
             if not email:
                 if last_attribute_name is not None:
@@ -316,7 +1000,7 @@ class LDAPDirectoryConnector(object):
             source_attributes['email'] = email
             user['email'] = email
 
-            identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record)
+            identity_type, last_attribute_name = identity_type_result
             if last_attribute_name and not identity_type:
                 self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
                                     last_attribute_name, dn, self.user_identity_type)
@@ -330,7 +1014,7 @@ class LDAPDirectoryConnector(object):
                     self.logger.warning('Skipping user with dn %s: %s', dn, e)
                     continue
 
-            username, last_attribute_name = self.user_username_formatter.generate_value(record)
+            username, last_attribute_name = username_result
             username = username.strip() if username else None
             source_attributes['username'] = username
             if username:
@@ -341,7 +1025,7 @@ class LDAPDirectoryConnector(object):
                                         last_attribute_name, dn, email)
                 user['username'] = email
 
-            domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
+            domain, last_attribute_name = domain_result
             domain = domain.strip() if domain else None
             source_attributes['domain'] = domain
             if domain:
@@ -351,19 +1035,19 @@ class LDAPDirectoryConnector(object):
             elif last_attribute_name:
                 self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
 
-            given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
+            given_name_value, last_attribute_name = given_name_result
             source_attributes['givenName'] = given_name_value
             if given_name_value is not None:
                 user['firstname'] = given_name_value
             elif last_attribute_name:
                 self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
+            sn_value, last_attribute_name = sn_result
             source_attributes['sn'] = sn_value
             if sn_value is not None:
                 user['lastname'] = sn_value
             elif last_attribute_name:
                 self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
+            c_value, last_attribute_name = c_result
             source_attributes['c'] = c_value
             if c_value is not None:
                 user['country'] = c_value.upper()
@@ -377,13 +1061,39 @@ class LDAPDirectoryConnector(object):
                     extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
                     source_attributes[extended_attribute] = extended_attribute_value
 
-            user['source_attributes'] = source_attributes.copy()
-            if 'groups' not in user:
+            user['source_attributes'] = source_attributes
+            if self.group_indexes_by_dn is not None:
+                user['groups'] = self.get_mapped_groups(record)
+            elif 'groups' not in user:
                 user['groups'] = []
             self.user_by_dn[dn] = user
+            self.skipped_dns.discard(dn)
 
             yield (dn, user)
 
+    def get_user_attribute_names(self):
+        """
+        :return: the names of the attributes that user values are built from
+        :rtype list(str)
+        """
+        user_attribute_names = list(self.user_value_plan.get_attribute_names())
+        user_attribute_names.append(six.text_type('memberOf'))
+        return user_attribute_names
+
+    def get_user_search_attribute_names(self, extended_attributes):
+        """
+        :return: the attributes to read when searching for users (just the DNs, if every user is already known)
+        :rtype list(str)
+        """
+        if self.all_users_known:
+            return [six.text_type('1.1')]
+        user_attribute_names = self.get_user_attribute_names()
+        extended_attributes = [six.text_type(attr) for attr in extended_attributes]
+        user_attribute_names.extend(set(extended_attributes) - set(user_attribute_names))
+        if self.change_attribute:
+            user_attribute_names.append(self.change_attribute)
+        return user_attribute_names
+
     def get_member_groups(self, user):
         """
         Get a list of member group common names for user
@@ -414,12 +1124,17 @@ class LDAPDirectoryConnector(object):
                     return rdn_part[1]
         return None
 
-    def iter_search_result(self, base_dn, scope, filter_string, attributes):
+    def iter_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
         """
         type: filter_string: str
         type: attributes: list(str)
+        :param connection: the connection to search on (the main connection by default)
         """
-        connection = self.connection
+        if self.options['async_search']:
+            for item in self.iter_async_search_result(base_dn, scope, filter_string, attributes, connection):
+                yield item
+            return
+        connection = connection or self.connection
         search_page_size = self.options['search_page_size']
 
         msgid = None
@@ -462,6 +1177,112 @@ class LDAPDirectoryConnector(object):
                 connection.abandon(msgid)
             raise
 
+    def iter_async_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
+        """
+        Like iter_search_result, but entries are yielded one by one as they arrive, while the server is still
+        sending the rest of the page, and the next page is requested as soon as the last one is complete.
+        """
+        connection = connection or self.connection
+        page_control = self.make_page_control()
+        serverctrls = [page_control] if page_control else None
+        msgid = connection.search_ext(base_dn, scope, filterstr=filter_string, attrlist=attributes,
+                                      serverctrls=serverctrls)
+        try:
+            while msgid is not None:
+                result_type, response_data, _rmsgid, response_controls = connection.result3(msgid, all=0)
+                if result_type == ldap.RES_SEARCH_ENTRY:
+                    for item in response_data:
+                        yield item
+                elif result_type == ldap.RES_SEARCH_RESULT:
+                    msgid = None
+                    if page_control and self.get_next_page_cookie(page_control, response_controls):
+                        msgid = connection.search_ext(base_dn, scope, filterstr=filter_string,
+                                                      attrlist=attributes, serverctrls=serverctrls)
+        finally:
+            if msgid is not None:
+                connection.abandon(msgid)
+
+    def iter_multiplexed_search_results(self, searches, connection=None):
+        """
+        Do several subtree searches at once on one connection (up to max_multiplexed_searches of them),
+        each paged on its own, and collect the results of each as they arrive from the server.
+        :param searches: iterable of tuples (key, base_dn, filter_string, attributes)
+        :return: for each search, in the order they complete, its key and its results
+        :rtype iterable(tuple(object, list))
+        """
+        connection = connection or self.connection
+        search_by_msgid = {}
+        search_iter = iter(searches)
+
+        def send(search):
+            serverctrls = [search['page_control']] if search['page_control'] else None
+            msgid = connection.search_ext(search['base_dn'], ldap.SCOPE_SUBTREE, filterstr=search['filter_string'],
+                                          attrlist=search['attributes'], serverctrls=serverctrls)
+            search_by_msgid[msgid] = search
+
+        try:
+            while True:
+                while len(search_by_msgid) < self.max_multiplexed_searches:
+                    next_search = next(search_iter, None)
+                    if next_search is None:
+                        break
+                    key, base_dn, filter_string, attributes = next_search
+                    send({'key': key, 'base_dn': base_dn, 'filter_string': filter_string, 'attributes': attributes,
+                          'page_control': self.make_page_control(), 'results': []})
+                if not search_by_msgid:
+                    return
+                result_type, response_data, msgid, response_controls = connection.result3(ldap.RES_ANY, all=0)
+                search = search_by_msgid.get(msgid)
+                if search is None:
+                    continue
+                if result_type == ldap.RES_SEARCH_ENTRY:
+                    search['results'].extend(response_data)
+                elif result_type == ldap.RES_SEARCH_RESULT:
+                    del search_by_msgid[msgid]
+                    if search['page_control'] and self.get_next_page_cookie(search['page_control'],
+                                                                            response_controls):
+                        send(search)
+                    else:
+                        yield search['key'], search['results']
+        finally:
+            for msgid in search_by_msgid:
+                connection.abandon(msgid)
+
+    def make_page_control(self):
+        """
+        :return: a control that asks for the first page of results, or None if results are not paged
+        """
+        search_page_size = self.options['search_page_size']
+        if search_page_size == 0:
+            return None
+        return ldap.controls.libldap.SimplePagedResultsControl(True, size=search_page_size, cookie='')
+
+    def get_next_page_cookie(self, page_control, response_controls):
+        """
+        Update the page control from the controls of a response, to ask for the next page.
+        :return: the cookie for the next page, which is empty after the last page
+        """
+        pctrls = [c for c in response_controls or []
+                  if c.controlType == ldap.controls.libldap.SimplePagedResultsControl.controlType]
+        if not pctrls:
+            self.logger.warn('Server ignored RFC 2696 control.')
+            return None
+        page_control.cookie = pctrls[0].cookie
+        return page_control.cookie
+
+    @staticmethod
+    def escape_ldap_value(value):
+        """
+        Escape the LDAP special characters in a string, each as '\\' + its hex code.
+        :type value: str
+        :rtype str
+        """
+        value = six.text_type(value)
+        # most values have nothing to escape, and finding that out is much quicker than translating them
+        if LDAPDirectoryConnector.ldap_special_chars.search(value) is None:
+            return value
+        return value.translate(LDAPDirectoryConnector.ldap_escape_table)
+
     @staticmethod
     def format_ldap_query_string(query, **kwargs):
         """
@@ -471,39 +1292,24 @@ class LDAPDirectoryConnector(object):
         :param kwargs:
         :return:
         """
-        # See http://www.rfc-editor.org/rfc/rfc4515.txt
-        escape_chars = six.text_type('*()\\&|<>~!:')
-        escaped_args = {}
         # kwargs is a dict that would normally be passed to string.format
-        for k, v in six.iteritems(kwargs):
-            # LDAP special characters are escaped in the general format '\' + hex(char)
-            # we need to run through the string char by char and if the char exists in
-            # the escape_char list, get the ord of it (decimal ascii value), convert it to hex, and
-            # replace the '0x' with '\'
-            escaped_list = []
-            for c in v:
-                if c in escape_chars:
-                    replace = six.text_type(hex(ord(c))).replace('0x', '\\')
-                    escaped_list.append(replace)
-                else:
-                    escaped_list.append(c)
-            escaped_args[k] = six.text_type('').join(escaped_list)
-        return query.format(**escaped_args)
+        escape = LDAPDirectoryConnector.escape_ldap_value
+        return query.format(**dict((k, escape(v)) for k, v in six.iteritems(kwargs)))
 
     def format_group_user_filter(self, group_dn):
         """
          :type group_dn: str
          :rtype str
          """
-        group_member_subfilter = self.format_ldap_query_string(self.options['group_member_filter_format'],
-                                                               group_dn=group_dn)
-        if not group_member_subfilter.startswith('('):
-            group_member_subfilter = six.text_type('(') + group_member_subfilter + six.text_type(')')
-        user_subfilter = self.options['all_users_filter']
-        if not user_subfilter.startswith('('):
-            user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
-        group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
-        return group_user_filter
+        if self.group_user_filter_format is None:
+            # an escaped DN can't start with '(', so the member filter format can be parenthesized as it is,
+            # and the users filter is put in with its braces doubled so they aren't taken as fields
+            group_member_filter_format = six.text_type(self.options['group_member_filter_format'])
+            user_subfilter = self.parenthesize(six.text_type(self.options['all_users_filter']))
+            self.group_user_filter_format = (six.text_type('(&') + self.parenthesize(group_member_filter_format) +
+                                             user_subfilter.replace('{', '{{').replace('}', '}}') +
+                                             six.text_type(')'))
+        return self.group_user_filter_format.format(group_dn=self.escape_ldap_value(group_dn))
 
     @staticmethod
     def is_dn_within_base_dn_scope(base_dn, dn):
@@ -519,6 +1325,69 @@ class LDAPDirectoryConnector(object):
             return True
         return False
 
+class GroupDNCache(object):
+    """
+    A file holding the DNs found for group names, so that groups don't have to be looked up on every run.
+    Each DN is used for max_age_hours after it was found; a group that is renamed or moved in that time
+    keeps its old DN (and so looks empty) until then.  Groups that were not found are not cached.
+    """
+    version = 1
+
+    def __init__(self, path, fingerprint, max_age_hours, logger):
+        """
+        :type path: str
+        :param fingerprint: the settings that group DNs were found with, which must match for the cache to be used
+        :type max_age_hours: int
+        :type logger: logging.Logger
+        """
+        self.state_file = user_sync.helper.StateFile(path, logger)
+        self.fingerprint = fingerprint
+        self.max_age = max_age_hours * 3600
+        self.logger = logger
+        self.entry_by_name = None
+
+    def load(self):
+        if self.entry_by_name is not None:
+            return
+        self.entry_by_name = {}
+        state = self.state_file.load()
+        if not state:
+            return
+        if state.get('version') != self.version or state.get('fingerprint') != self.fingerprint:
+            self.logger.info("Ignoring group DN cache '%s': it was made with other settings", self.state_file.path)
+            return
+        now = time.time()
+        for name, entry in six.iteritems(state.get('groups', {})):
+            if now - entry['found'] < self.max_age:
+                self.entry_by_name[name] = entry
+
+    def get_dns(self, groups):
+        """
+        :type groups: list(str)
+        :return: the cached DNs of the groups, by group name
+        :rtype dict(str, str)
+        """
+        self.load()
+        return dict((group, self.entry_by_name[group]['dn']) for group in groups if group in self.entry_by_name)
+
+    def add_dns(self, group_dn_by_name):
+        """
+        :type group_dn_by_name: dict(str, str)
+        """
+        self.load()
+        now = time.time()
+        for name, group_dn in six.iteritems(group_dn_by_name):
+            self.entry_by_name[name] = {'dn': group_dn, 'found': now}
+
+    def save(self):
+        self.load()
+        self.state_file.save({
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'groups': self.entry_by_name,
+        })
+
+
 class LDAPValueFormatter(object):
     encoding = 'utf8'
 
@@ -534,6 +1403,7 @@ class LDAPValueFormatter(object):
             attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
         self.string_format = string_format
         self.attribute_names = attribute_names
+        self.make_value = self.compile(string_format, attribute_names)
 
     def get_attribute_names(self):
         """
@@ -546,19 +1416,40 @@ class LDAPValueFormatter(object):
         :type record: dict
         :rtype (unicode, unicode)
         """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_attribute_value(record, attribute_name, first_only=True)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
+        values = {}
+        for attribute_name in self.attribute_names:
+            value = self.get_attribute_value(record, attribute_name, first_only=True)
+            if value is None:
+                break
+            values[attribute_name] = value
+        return self.make_value(values)
+
+    @staticmethod
+    def compile(string_format, attribute_names):
+        """
+        Make the function that generates a value from the decoded (first) values of a record's attributes.
+        A format that is just one attribute gives that attribute's value, without formatting.
+        :type string_format: unicode
+        :type attribute_names: list(unicode)
+        :return: a function from a dict of attribute values (by name) to the same pair as generate_value:
+        the value (None if an attribute is missing), and the missing attribute or else the last one used
+        """
+        if string_format is None:
+            return lambda values: (None, None)
+        attribute_names = tuple(attribute_names)
+        if not attribute_names:
+            return lambda values: (string_format.format(), None)
+        last_attribute_name = attribute_names[-1]
+        if list(string.Formatter().parse(string_format)) == [('', last_attribute_name, '', None)]:
+            return lambda values: (values.get(last_attribute_name), last_attribute_name)
+        format_value = string_format.format
+
+        def make_value(values):
+            for attribute_name in attribute_names:
+                if attribute_name not in values:
+                    return None, attribute_name
+            return format_value(**values), last_attribute_name
+        return make_value
 
     @classmethod
     def get_attribute_value(cls, attributes, attribute_name, first_only=False):
@@ -578,3 +1469,53 @@ class LDAPValueFormatter(object):
             except UnicodeError as e:
                 raise AssertionException("Encoding error in value of attribute '%s': %s" % (attribute_name, e))
         return None
+
+
+class LDAPValuePlan(object):
+    """
+    Generates the values of several formatters from each record at once.  The attributes the formatters use
+    are listed once, and each is decoded at most once per record, however many of the formatters use it.
+    As with generate_value, a formatter stops at its first missing attribute, so the attributes after it
+    are only decoded if another formatter uses them.
+    """
+
+    def __init__(self, formatters):
+        """
+        :type formatters: list(LDAPValueFormatter)
+        """
+        attribute_names = []
+        for formatter in formatters:
+            for attribute_name in formatter.get_attribute_names():
+                if attribute_name not in attribute_names:
+                    attribute_names.append(attribute_name)
+        self.attribute_names = attribute_names
+        self.formatter_plans = [(tuple(formatter.get_attribute_names()), formatter.make_value)
+                                for formatter in formatters]
+
+    def get_attribute_names(self):
+        """
+        :rtype list(str)
+        """
+        return self.attribute_names
+
+    def generate_values(self, record):
+        """
+        :type record: dict
+        :return: for each formatter, in order, what its generate_value would give for the record
+        :rtype list(tuple(unicode, unicode))
+        """
+        decoded_values = {}
+        results = []
+        for attribute_names, make_value in self.formatter_plans:
+            values = {}
+            for attribute_name in attribute_names:
+                try:
+                    value = decoded_values[attribute_name]
+                except KeyError:
+                    value = decoded_values[attribute_name] = LDAPValueFormatter.get_attribute_value(
+                        record, attribute_name, first_only=True)
+                if value is None:
+                    break
+                values[attribute_name] = value
+            results.append(make_value(values))
+        return results
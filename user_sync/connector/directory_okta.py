@@ -18,7 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ast
+import sys
+import threading
+import time
+
 import okta
+import requests
+import requests.adapters
 import six
 import string
 from okta.framework.OktaError import OktaError
@@ -59,6 +66,17 @@ def connector_load_users_and_groups(state, groups=None, extended_attributes=None
 
 class OktaDirectoryConnector(object):
     name = 'okta'
+    # groups to ask for at a time when indexing them (the most Okta allows)
+    group_page_size = 10000
+    # System Log events to ask for at a time
+    event_page_size = 1000
+    # the System Log events that change the members of the groups in an incremental_sync snapshot
+    member_change_events = ('group.user_membership.add', 'group.user_membership.remove',
+                            'user.lifecycle.delete.completed', 'group.lifecycle.delete')
+    # seconds before the time of the last run from which changes are read again, as events can be logged
+    # a little after they are published, and the clocks of Okta and this machine can differ
+    change_overlap_seconds = 300
+    snapshot_version = 1
 
     def __init__(self, caller_options):
         caller_config = user_sync.config.DictConfig('%s configuration' % self.name, caller_options)
@@ -76,11 +94,30 @@ class OktaDirectoryConnector(object):
         builder.set_string_value('user_surname_format', six.text_type('{lastName}'))
         builder.set_string_value('user_country_code_format', six.text_type('{countryCode}'))
         builder.set_string_value('user_identity_type', None)
+        builder.set_int_value('search_page_size', 200)
+        builder.set_int_value('max_search_workers', 4)
+        builder.set_dict_value('group_index_cache', None)
+        builder.set_dict_value('incremental_sync', None)
         builder.set_string_value('logger_name', self.name)
         host = builder.require_string_value('host')
         api_token = builder.require_string_value('api_token')
 
         options = builder.get_options()
+        if options['max_search_workers'] < 1:
+            raise AssertionException('max_search_workers must be at least 1')
+        if options['group_index_cache'] is not None:
+            cache_config = caller_config.get_dict_config('group_index_cache', True)
+            cache_builder = user_sync.config.OptionsBuilder(cache_config)
+            cache_builder.require_string_value('path')
+            cache_builder.set_int_value('max_age_hours', 24)
+            options['group_index_cache'] = cache_builder.get_options()
+        if options['incremental_sync'] is not None:
+            is_config = caller_config.get_dict_config('incremental_sync', True)
+            is_builder = user_sync.config.OptionsBuilder(is_config)
+            is_builder.require_string_value('state_path')
+            is_builder.set_int_value('full_refresh_hours', 24)
+            options['incremental_sync'] = is_builder.get_options()
+        self.user_filter = OktaUserFilter(options['all_users_filter'])
 
         OKTAValueFormatter.encoding = options['string_encoding']
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
@@ -91,9 +128,16 @@ class OktaDirectoryConnector(object):
         self.user_given_name_formatter = OKTAValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = OKTAValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = OKTAValueFormatter(options['user_country_code_format'])
+        self.user_value_plan = OKTAValuePlan([
+            self.user_email_formatter,
+            self.user_username_formatter,
+            self.user_domain_formatter,
+            self.user_given_name_formatter,
+            self.user_surname_formatter,
+            self.user_country_code_formatter,
+        ])
 
         self.users_client = None
-        self.groups_client = None
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
         self.options = options
@@ -105,6 +149,26 @@ class OktaDirectoryConnector(object):
             host = "https://" + host
 
         self.user_by_uid = {}
+        # the record made of each group member, or None if it didn't match the all_users_filter, by id
+        self.member_record_by_uid = {}
+        # search workers filter the members they read, so take turns with member_record_by_uid
+        self.member_records_lock = threading.Lock()
+        # the ids of the org's groups, by name (read when first needed)
+        self.group_id_by_name = None
+        # whether the index was brought up to date from the group_index_cache, rather than read in full
+        self.group_index_is_partial = False
+        # search workers that find a deleted group take turns to read the index again
+        self.group_index_lock = threading.Lock()
+        if options['group_index_cache']:
+            self.group_index_cache = OktaGroupIndexCache(options['group_index_cache']['path'], [host],
+                                                         options['group_index_cache']['max_age_hours'], logger)
+        else:
+            self.group_index_cache = None
+        if options['incremental_sync']:
+            self.snapshot_file = user_sync.helper.StateFile(options['incremental_sync']['state_path'], logger)
+            self.snapshot_fingerprint = [host]
+        else:
+            self.snapshot_file = None
 
         logger.debug('%s initialized with options: %s', self.name, options)
 
@@ -112,9 +176,10 @@ class OktaDirectoryConnector(object):
 
         try:
             self.users_client = okta.UsersClient(host, api_token)
-            self.groups_client = okta.UserGroupsClient(host, api_token)
         except OktaError as e:
             raise AssertionException("Error connecting to Okta: %s" % e)
+        # group members are read over a session of our own, shared by the search workers
+        self.api_client = OktaApiClient(host, api_token, options['max_search_workers'], logger)
 
         logger.info('Connected')
 
@@ -128,64 +193,435 @@ class OktaDirectoryConnector(object):
         if all_users:
             raise AssertionException("Okta connector has no notion of all users, please specify a --users group")
 
-        options = self.options
-        all_users_filter = options['all_users_filter']
+        extended_attributes = self.get_extended_attributes(extended_attributes)
 
         self.logger.info('Loading users...')
         self.user_by_uid = user_by_uid = {}
+        self.member_record_by_uid = {}
+        skipped_uids = set()
 
-        for group in groups:
+        # the members of several groups may be read at the same time, but they are processed here,
+        # in the order of the groups
+        if self.snapshot_file:
+            group_member_records = self.load_member_snapshot(groups)
+        else:
+            group_member_records = self.iter_group_member_records(groups)
+        for group, members in group_member_records:
+            if members is None:
+                self.logger.warning("No group found for: %s", group)
+                continue
             total_group_members = 0
             total_group_users = 0
-            for user in self.iter_group_members(group, all_users_filter, extended_attributes):
+            for member in members:
                 total_group_members += 1
-
-                uid = user.get('uid')
-                if user and uid:
-                    if uid not in user_by_uid:
-                        user_by_uid[uid] = user
-                    total_group_users += 1
-                    user_groups = user_by_uid[uid]['groups']
-                    if group not in user_groups:
-                        user_groups.append(group)
+                # a user in several groups is converted once, when it is first read
+                uid = member.id
+                user = user_by_uid.get(uid)
+                if user is None:
+                    if uid in skipped_uids:
+                        continue
+                    user = self.convert_user(member, extended_attributes)
+                    if not user:
+                        skipped_uids.add(uid)
+                        continue
+                    user_by_uid[uid] = user
+                total_group_users += 1
+                user_groups = user['groups']
+                if group not in user_groups:
+                    user_groups.append(group)
 
             self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
 
         return six.itervalues(user_by_uid)
 
-    def find_group(self, group):
+    def iter_group_member_records(self, groups):
         """
+        Read the members of each group, with up to max_search_workers groups being read at the same time.
+        Results are yielded in the order of the groups, whatever order they are read in.
+        :type groups: list(str)
+        :rtype iterable(tuple(str, list))
+        :return: for each group, the group and the records of its members that match the all_users_filter (see
+        filter_members), or None if there is no such group
+        """
+        group_id_by_name = self.find_group_ids(groups)
+
+        def read_members(group):
+            return self.read_named_group_members(group, filtered=True)[1] if group in group_id_by_name else None
+
+        return self.iter_group_reads(read_members, groups, len(group_id_by_name))
+
+    def iter_group_reads(self, read, groups, read_count):
+        """
+        Call read for each group, on up to max_search_workers threads, yielding the results in the order of
+        the groups, whatever order they are read in.
+        :param read: function from a group to what is read for it
+        :type groups: list
+        :param read_count: how many of the groups need to be read from Okta
+        :rtype iterable(tuple(object, object))
+        """
+        worker_count = min(self.options['max_search_workers'], read_count)
+        if worker_count <= 1:
+            for group in groups:
+                yield group, read(group)
+            return
+        pending = six.moves.queue.Queue()
+        for index, group in enumerate(groups):
+            pending.put((index, group))
+        results = six.moves.queue.Queue()
+        stopped = []
+
+        def run_worker():
+            while not stopped:
+                try:
+                    index, group = pending.get_nowait()
+                except six.moves.queue.Empty:
+                    return
+                try:
+                    results.put((index, read(group), None))
+                except Exception:
+                    results.put((index, None, sys.exc_info()))
+
+        workers = [threading.Thread(target=run_worker, name='okta-search-%d' % (i + 1)) for i in range(worker_count)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            finished = {}
+            for index, group in enumerate(groups):
+                while index not in finished:
+                    finished_index, result, exc_info = results.get()
+                    finished[finished_index] = (result, exc_info)
+                result, exc_info = finished.pop(index)
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                yield group, result
+        finally:
+            stopped.append(True)
+            for worker in workers:
+                worker.join()
+
+    def read_named_group_members(self, group, filtered=False):
+        """
+        Read the members of a group, found by name in the group index.  If the index was brought up to date
+        from the group_index_cache, and the group's id in it turns out to be of a deleted group (one that may
+        have been made again, with the same name, since the index was cached), the index is read again in full
+        and the group's members read under the id found there.
         :type group: str
-        :rtype UserGroup
+        :type filtered: bool
+        :return: the group's id and members (see read_group_members), or None for both if there is no such group
+        :rtype (str, list)
+        """
+        group_id_by_name = self.get_group_index()
+        group_id = group_id_by_name.get(group.strip())
+        if group_id is None:
+            return None, None
+        members = self.read_group_members(group_id, filtered)
+        if members is None and self.reread_group_index(group_id_by_name):
+            return self.read_named_group_members(group, filtered)
+        return (group_id, members) if members is not None else (None, None)
+
+    def read_group_members(self, group_id, filtered=False):
+        """
+        :type group_id: str
+        :param filtered: True to filter each page of members as it is read (see filter_members)
+        :return: the group's members (all of them, as Okta returns them, or the records of those that match
+        the all_users_filter), or None if there is no such group
+        :rtype list
         """
-        group = group.strip()
-        options = self.options
-        group_filter_format = options['group_filter_format']
+        members = []
         try:
-            results = self.groups_client.get_groups(query=group_filter_format.format(group=group))
-        except KeyError as e:
-            raise AssertionException("Bad format key in group query (%s): %s" % (group_filter_format, e))
-        except OktaError as e:
-            self.logger.warning("Unable to query group")
-            raise AssertionException("Okta error querying for group: %s" % e)
+            for page in self.api_client.iter_pages('/groups/%s/users' % group_id,
+                                                   {'limit': self.options['search_page_size']}):
+                members.extend(self.filter_members(page) if filtered else page)
+        except OktaApiError as e:
+            if e.status_code != 404:
+                raise
+            # the group was deleted since it was indexed
+            if self.group_index_cache:
+                self.group_index_cache.clear()
+            return None
+        except AssertionException:
+            raise
+        except Exception as e:
+            self.logger.warning("Unable to get_group_users")
+            raise AssertionException("Okta error querying for group users: %s" % e)
+        return members
 
-        if results is None:
-            self.logger.warning("No group found for: %s", group)
+    def filter_members(self, members):
+        """
+        Make records of the members that match the all_users_filter.  Each user is made into a record, and
+        filtered, once per run (by whichever search worker reads it first), however many groups it is in.
+        :type members: iterable(dict)
+        :rtype list(OktaRecord)
+        """
+        records = []
+        for member in members:
+            uid = member['id']
+            with self.member_records_lock:
+                known = uid in self.member_record_by_uid
+                record = self.member_record_by_uid.get(uid)
+            if not known:
+                record = OktaRecord(member)
+                if not self.user_filter.matches(record):
+                    record = None
+                with self.member_records_lock:
+                    record = self.member_record_by_uid.setdefault(uid, record)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def load_member_snapshot(self, groups):
+        """
+        Find the members of each group in the snapshot of the mapped groups' members that is kept in the
+        state_path file, brought up to date with the changes since the last run: the users whose lastUpdated
+        time is later, and the membership changes (and user and group deletions) in the System Log.  Groups
+        that aren't in the snapshot are read in full, as are all groups when the snapshot is full_refresh_hours
+        old or was taken with other settings.
+        :type groups: list(str)
+        :rtype list(tuple(str, list))
+        :return: as for iter_group_member_records
+        """
+        sync_options = self.options['incremental_sync']
+        group_id_by_name = self.find_group_ids(groups)
+        state = self.snapshot_file.load()
+        now = time.time()
+        if (state and state.get('version') == self.snapshot_version and
+                state.get('fingerprint') == self.snapshot_fingerprint and state.get('mark') is not None and
+                now - state.get('refreshed', 0) < sync_options['full_refresh_hours'] * 3600):
+            refreshed = state['refreshed']
+            user_by_id = state['users']
+            member_ids_by_group_id = dict((group_id, set(member_ids))
+                                          for group_id, member_ids in six.iteritems(state['members']))
+            self.read_member_changes(state['mark'] - self.change_overlap_seconds, now, user_by_id,
+                                     member_ids_by_group_id)
         else:
-            for result in results:
-                if result.profile.name == group:
-                    return result
+            self.logger.info('Reading all group members to create a new snapshot')
+            refreshed = now
+            user_by_id = {}
+            member_ids_by_group_id = {}
 
-        return None
+        # only the mapped groups, and their members, are kept in the snapshot
+        mapped_group_ids = []
+        for group in groups:
+            group_id = group_id_by_name.get(group)
+            if group_id is not None and group_id not in mapped_group_ids:
+                mapped_group_ids.append(group_id)
+        member_ids_by_group_id = dict((group_id, member_ids)
+                                      for group_id, member_ids in six.iteritems(member_ids_by_group_id)
+                                      if group_id in mapped_group_ids)
+        new_groups = []
+        new_group_ids = set()
+        for group in groups:
+            group_id = group_id_by_name.get(group)
+            if group_id is not None and group_id not in member_ids_by_group_id and group_id not in new_group_ids:
+                new_groups.append(group)
+                new_group_ids.add(group_id)
+        if new_groups:
+            self.logger.info('Reading all members of %d groups', len(new_groups))
+        for group, (group_id, members) in self.iter_group_reads(self.read_named_group_members, new_groups,
+                                                                len(new_groups)):
+            if members is not None:
+                member_ids_by_group_id[group_id] = set(member['id'] for member in members)
+                for member in members:
+                    user_by_id[member['id']] = member
+        if new_groups:
+            # a group read under a new id (after the index was read again) is found under it from now on
+            group_id_by_name = self.find_group_ids(groups)
+        member_ids = set()
+        for group_member_ids in six.itervalues(member_ids_by_group_id):
+            member_ids.update(group_member_ids)
+        user_by_id = dict((user_id, user) for user_id, user in six.iteritems(user_by_id) if user_id in member_ids)
+        self.snapshot_file.save({
+            'version': self.snapshot_version,
+            'fingerprint': self.snapshot_fingerprint,
+            'refreshed': refreshed,
+            'mark': now,
+            'users': user_by_id,
+            'members': dict((group_id, sorted(group_member_ids))
+                            for group_id, group_member_ids in six.iteritems(member_ids_by_group_id)),
+        })
+
+        group_member_records = []
+        for group in groups:
+            group_member_ids = member_ids_by_group_id.get(group_id_by_name.get(group))
+            if group_member_ids is None:
+                group_member_records.append((group, None))
+            else:
+                group_member_records.append((group, self.filter_members(
+                    user_by_id[user_id] for user_id in sorted(group_member_ids) if user_id in user_by_id)))
+        return group_member_records
 
-    def iter_group_members(self, group, filter_string, extended_attributes):
+    def read_member_changes(self, since, until, user_by_id, member_ids_by_group_id):
         """
-        :type group: str
-        :type filter_string: str
-        :type extended_attributes: list
-        :rtype iterator(str, str)
+        Apply the changes to group members and users made between two times to a snapshot.  Membership changes
+        are replayed in the order they were logged, so changes that were already in the snapshot can safely be
+        replayed again.
+        :type since: float
+        :type until: float
+        :param user_by_id: the users in the snapshot (as Okta returns them), by id
+        :param member_ids_by_group_id: the set of member ids of each group in the snapshot, by group id
         """
+        since_time = self.format_time(since)
+        self.logger.info('Reading changes to group members and users since %s', since_time)
+        params = {
+            'since': since_time,
+            'until': self.format_time(until),
+            'filter': ' or '.join('eventType eq "%s"' % event_type for event_type in self.member_change_events),
+            'limit': self.event_page_size,
+        }
+        event_count = 0
+        changed_count = 0
+        try:
+            for page in self.api_client.iter_pages('/logs', params):
+                for event in page:
+                    if (event.get('outcome') or {}).get('result') != 'SUCCESS':
+                        continue
+                    event_count += 1
+                    targets = event.get('target') or []
+                    user_ids = [target['id'] for target in targets if target.get('type') == 'User']
+                    group_ids = [target['id'] for target in targets if target.get('type') == 'UserGroup']
+                    event_type = event.get('eventType')
+                    if event_type == 'group.lifecycle.delete':
+                        for group_id in group_ids:
+                            member_ids_by_group_id.pop(group_id, None)
+                    elif event_type == 'user.lifecycle.delete.completed':
+                        for group_member_ids in six.itervalues(member_ids_by_group_id):
+                            group_member_ids.difference_update(user_ids)
+                    else:
+                        for group_id in group_ids:
+                            group_member_ids = member_ids_by_group_id.get(group_id)
+                            if group_member_ids is None:
+                                continue
+                            if event_type == 'group.user_membership.add':
+                                group_member_ids.update(user_ids)
+                            else:
+                                group_member_ids.difference_update(user_ids)
+            member_ids = set()
+            for group_member_ids in six.itervalues(member_ids_by_group_id):
+                member_ids.update(group_member_ids)
 
+            # a membership change doesn't update the user, so new members that weren't already in the
+            # snapshot are read one by one (if they weren't changed themselves)
+            for page in self.api_client.iter_pages('/users', {'search': 'lastUpdated gt "%s"' % since_time,
+                                                              'limit': self.options['search_page_size']}):
+                for user in page:
+                    if user['id'] in member_ids:
+                        user_by_id[user['id']] = user
+                        changed_count += 1
+            for user_id in member_ids.difference(user_by_id):
+                try:
+                    user_by_id[user_id] = self.api_client.get(self.api_client.base_url + '/users/%s' % user_id).json()
+                except OktaApiError as e:
+                    if e.status_code != 404:
+                        raise
+        except AssertionException:
+            raise
+        except Exception as e:
+            self.logger.warning("Unable to read changes")
+            raise AssertionException("Okta error reading changes to group members: %s" % e)
+        for group_member_ids in six.itervalues(member_ids_by_group_id):
+            group_member_ids.intersection_update(user_by_id)
+        self.logger.info('Membership changes since the last run: %d, changed users: %d', event_count,
+                         changed_count)
+
+    @staticmethod
+    def format_time(timestamp):
+        """
+        :type timestamp: float
+        :return: the time in the form Okta uses, such as 2018-01-01T00:00:00.000Z
+        :rtype str
+        """
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.%03dZ' % (timestamp * 1000 % 1000)
+
+    def find_group_ids(self, groups):
+        """
+        :type groups: list(str)
+        :return: the ids of the groups that exist, by group name
+        :rtype dict(str, str)
+        """
+        group_id_by_name = self.get_group_index()
+        group_ids = {}
+        for group in groups:
+            group_id = group_id_by_name.get(group.strip())
+            if group_id is not None:
+                group_ids[group] = group_id
+        return group_ids
+
+    def get_group_index(self, use_cache=True):
+        """
+        Page through all the org's groups, once per run, for their ids by name.  With a group_index_cache,
+        the index is kept from one run to the next, and only the groups updated (or renamed) since the
+        last run are read, until the index is max_age_hours old and is read in full again.  A group read
+        replaces a cached group with the same name (which must have been deleted since), but where several
+        groups read have the same name, the first one read is used.
+        :param use_cache: False to read the index in full, whatever is in the group_index_cache
+        :rtype dict(str, str)
+        """
+        if self.group_id_by_name is not None:
+            return self.group_id_by_name
+        if self.group_index_cache and use_cache:
+            group_id_by_name, mark = self.group_index_cache.load()
+        else:
+            if self.group_index_cache:
+                self.group_index_cache.start_refresh()
+            group_id_by_name, mark = {}, None
+        self.group_index_is_partial = mark is not None
+        params = {'limit': self.group_page_size}
+        if mark is not None:
+            params['filter'] = 'lastUpdated gt "%s"' % mark
+        name_by_id = dict((group_id, name) for name, group_id in six.iteritems(group_id_by_name))
+        read_names = set()
+        read_count = 0
+        try:
+            for page in self.api_client.iter_pages('/groups', params):
+                for group in page:
+                    read_count += 1
+                    group_id = group['id']
+                    name = group['profile']['name']
+                    old_name = name_by_id.get(group_id)
+                    if old_name is not None and old_name != name and group_id_by_name.get(old_name) == group_id:
+                        del group_id_by_name[old_name]
+                    name_by_id[group_id] = name
+                    if name not in read_names:
+                        read_names.add(name)
+                        group_id_by_name[name] = group_id
+                    if mark is None or group['lastUpdated'] > mark:
+                        mark = group['lastUpdated']
+        except AssertionException:
+            raise
+        except Exception as e:
+            self.logger.warning("Unable to list groups")
+            raise AssertionException("Okta error listing groups: %s" % e)
+        self.logger.debug('Read %d groups for an index of %d group names', read_count, len(group_id_by_name))
+        if self.group_index_cache:
+            self.group_index_cache.save(group_id_by_name, mark)
+        self.group_id_by_name = group_id_by_name
+        return group_id_by_name
+
+    def reread_group_index(self, group_id_by_name):
+        """
+        Read the group index in full, in place of one that was partly read from the group_index_cache, once a
+        group in it is found to be deleted.  The index is read again at most once per run, however many search
+        workers find deleted groups.
+        :param group_id_by_name: the index the deleted group was found in
+        :return: True if the index has been read in full since group_id_by_name was read from the cache
+        :rtype bool
+        """
+        with self.group_index_lock:
+            if self.group_id_by_name is group_id_by_name:
+                if not self.group_index_is_partial:
+                    return False
+                self.logger.info('A group in the group index cache has been deleted; reading all groups')
+                self.group_id_by_name = None
+                self.get_group_index(use_cache=False)
+            return True
+
+    def get_extended_attributes(self, extended_attributes):
+        """
+        :type extended_attributes: list(str)
+        :return: the extended attributes that aren't already used by the user formats
+        :rtype list(str)
+        """
         user_attribute_names = []
         user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
@@ -194,31 +630,15 @@ class OktaDirectoryConnector(object):
         user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
-        extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
-        user_attribute_names.extend(extended_attributes)
-
-        res_group = self.find_group(group)
-        if res_group:
-            try:
-                attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
-                members = self.groups_client.get_group_all_users(res_group.id, attr_dict)
-            except OktaError as e:
-                self.logger.warning("Unable to get_group_users")
-                raise AssertionException("Okta error querying for group users: %s" % e)
-            # Filtering users based all_users_filter query in config
-            for member in self.filter_users(members, filter_string):
-                user = self.convert_user(member, extended_attributes)
-                if not user:
-                    continue
-                yield (user)
-        else:
-            self.logger.warning("No group found for: %s", group)
+        return list(set(extended_attributes) - set(user_attribute_names))
 
     def convert_user(self, record, extended_attributes):
 
         source_attributes = {}
         source_attributes['login'] = login = OKTAValueFormatter.get_profile_value(record,'login')
-        email, last_attribute_name = self.user_email_formatter.generate_value(record)
+        (email_result, username_result, domain_result, given_name_result, sn_result,
+         c_result) = self.user_value_plan.generate_values(record)
+        email, last_attribute_name = email_result
         email = email.strip() if email else None
         if not email:
             if last_attribute_name is not None:
@@ -241,7 +661,7 @@ class OktaDirectoryConnector(object):
 
 
 
-        username, last_attribute_name = self.user_username_formatter.generate_value(record)
+        username, last_attribute_name = username_result
         username = username.strip() if username else None
         source_attributes['username'] = username
         if username:
@@ -252,7 +672,7 @@ class OktaDirectoryConnector(object):
                                     last_attribute_name, login, email)
             user['username'] = email
 
-        domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
+        domain, last_attribute_name = domain_result
         domain = domain.strip() if domain else None
         source_attributes['domain'] = domain
         if domain:
@@ -262,19 +682,19 @@ class OktaDirectoryConnector(object):
         elif last_attribute_name:
             self.logger.warning('No domain attribute (%s) for user with login: %s', last_attribute_name, login)
 
-        first_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
+        first_name_value, last_attribute_name = given_name_result
         source_attributes['firstName'] = first_name_value
         if first_name_value is not None:
             user['firstname'] = first_name_value
         elif last_attribute_name:
             self.logger.warning('No given name attribute (%s) for user with login: %s', last_attribute_name, login)
-        last_name_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
+        last_name_value, last_attribute_name = sn_result
         source_attributes['lastName'] = last_name_value
         if last_name_value is not None:
             user['lastname'] = last_name_value
         elif last_attribute_name:
             self.logger.warning('No last name attribute (%s) for user with login: %s', last_attribute_name, login)
-        country_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
+        country_value, last_attribute_name = c_result
         source_attributes['c'] = country_value
         if country_value is not None:
             user['country'] = country_value.upper()
@@ -286,7 +706,7 @@ class OktaDirectoryConnector(object):
                 extended_attribute_value = OKTAValueFormatter.get_profile_value(record, extended_attribute)
                 source_attributes[extended_attribute] = extended_attribute_value
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_search_result(self, filter_string, attributes):
@@ -308,13 +728,297 @@ class OktaDirectoryConnector(object):
             raise AssertionException("Okta error querying for users: %s" % e)
         return users
 
-    def filter_users(self, users, filter_string):
+
+class OktaApiError(AssertionException):
+    """
+    An error response from the Okta API.
+    """
+
+    def __init__(self, status_code, message):
+        super(OktaApiError, self).__init__(message)
+        self.status_code = status_code
+
+
+class OktaGroupIndexCache(object):
+    """
+    A file holding the index of the org's group ids by name, with the latest lastUpdated time of the groups
+    read into it, so that each run only has to read the groups updated since.  A group that is deleted is
+    only noticed when its members are read, which has the index read in full again (or, if it already was
+    this run, empties the cache for the next run).  The index is read in full again once it is max_age_hours
+    old.
+    """
+    version = 1
+
+    def __init__(self, path, fingerprint, max_age_hours, logger):
+        """
+        :type path: str
+        :param fingerprint: the settings that the index was read with, which must match for the cache to be used
+        :type max_age_hours: int
+        :type logger: logging.Logger
+        """
+        self.state_file = user_sync.helper.StateFile(path, logger)
+        self.fingerprint = fingerprint
+        self.max_age = max_age_hours * 3600
+        self.logger = logger
+        self.refreshed = None
+        # groups may be found to be deleted by several search workers at once
+        self.lock = threading.Lock()
+        self.cleared = False
+
+    def load(self):
+        """
+        :return: the cached ids of the groups by name, and the lastUpdated time they are current as of; or
+        an empty index and None if the cache is missing, was made with other settings, or is too old
+        :rtype (dict(str, str), str)
+        """
+        self.refreshed = time.time()
+        state = self.state_file.load()
+        if not state:
+            return {}, None
+        if state.get('version') != self.version or state.get('fingerprint') != self.fingerprint:
+            self.logger.info("Ignoring group index cache '%s': it was made with other settings", self.state_file.path)
+            return {}, None
+        if not state.get('mark') or self.refreshed - state.get('refreshed', 0) >= self.max_age:
+            self.logger.info("Group index cache '%s' is out of date; reading all groups", self.state_file.path)
+            return {}, None
+        self.refreshed = state['refreshed']
+        return dict(state.get('groups', {})), state['mark']
+
+    def start_refresh(self):
+        """
+        Start over with an index that is read in full, whatever is in the cache.
+        """
+        self.refreshed = time.time()
+
+    def save(self, group_id_by_name, mark):
+        """
+        :type group_id_by_name: dict(str, str)
+        :param mark: the latest lastUpdated time of the groups read
+        :type mark: str
+        """
+        with self.lock:
+            self.cleared = False
+        self.state_file.save({
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'refreshed': self.refreshed,
+            'mark': mark,
+            'groups': group_id_by_name,
+        })
+
+    def clear(self):
+        """
+        Have the index read in full on the next run.
+        """
+        with self.lock:
+            if not self.cleared:
+                self.cleared = True
+                self.state_file.save({'version': self.version, 'fingerprint': self.fingerprint})
+
+
+class OktaApiClient(object):
+    """
+    Reads from the Okta API over one keep-alive session, which can be shared by several threads (with up to
+    max_connections of them sending requests at the same time).  Okta tells us, in the X-Rate-Limit headers
+    of each response, how many requests are left before its rate limit resets; when only reserved_requests
+    are left, further requests are held back until the reset, rather than sent to be refused.
+    """
+
+    # requests left for anyone else using the org's API at the same time
+    reserved_requests = 2
+    # the most times a request is sent if it is refused for exceeding the rate limit
+    max_attempts = 4
+    # seconds to wait for a rate limit reset that Okta didn't give a time for
+    default_reset_wait = 5
+    request_timeout = 120
+
+    def __init__(self, host, api_token, max_connections, logger):
+        """
+        :type host: str
+        :type api_token: str
+        :type max_connections: int
+        :type logger: logging.Logger
+        """
+        self.base_url = host.rstrip('/') + '/api/v1'
+        self.logger = logger
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': 'SSWS ' + api_token,
+        })
+        self.lock = threading.Lock()
+        # what the latest response said about the rate limit (None if not known)
+        self.remaining = None
+        self.reset_time = 0
+        self.request_count = 0
+        self.wait_count = 0
+
+    def iter_pages(self, path, params=None):
+        """
+        Get a list of objects, following the "next" links of each page to the next.
+        :param path: the path of the list (after /api/v1)
+        :type params: dict
+        :rtype iterable(list(dict))
+        """
+        url = self.base_url + path
+        while url:
+            response = self.get(url, params)
+            yield response.json()
+            url = response.links.get('next', {}).get('url')
+            params = None
+
+    def get(self, url, params=None):
+        """
+        :type url: str
+        :type params: dict
+        :rtype requests.Response
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.acquire()
+            response = self.session.get(url, params=params, timeout=self.request_timeout)
+            self.record_response(response)
+            if response.status_code != 429 or attempt == self.max_attempts:
+                break
+            self.logger.warning('Okta rate limit exceeded (attempt %d of %d)', attempt, self.max_attempts)
+        if response.status_code != 200:
+            try:
+                summary = response.json().get('errorSummary')
+            except ValueError:
+                summary = None
+            raise OktaApiError(response.status_code, 'Okta error %d from %s: %s' % (response.status_code, url,
+                                                                                  summary or response.reason))
+        return response
+
+    def acquire(self):
+        """
+        Wait, if need be, until a request can be sent without going over the rate limit.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now >= self.reset_time:
+                    self.remaining = None
+                if self.remaining is None or self.remaining > self.reserved_requests:
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    self.request_count += 1
+                    return
+                wait = self.reset_time - now
+                self.wait_count += 1
+            self.logger.info('Okta rate limit nearly reached; waiting %.1f seconds for it to reset', wait)
+            time.sleep(wait)
+
+    def record_response(self, response):
+        """
+        Note what the rate limit headers of a response say.  Responses may arrive in any order, so the count of
+        remaining requests is only ever lowered within the same rate limit window.
+        :type response: requests.Response
+        """
         try:
-            return list(filter(lambda user: eval(filter_string), users))
-        except SyntaxError as e:
+            remaining = int(response.headers['X-Rate-Limit-Remaining'])
+            reset_time = float(response.headers['X-Rate-Limit-Reset'])
+        except (KeyError, ValueError):
+            remaining = reset_time = None
+        with self.lock:
+            if response.status_code == 429:
+                self.remaining = 0
+                self.reset_time = max(self.reset_time, reset_time or time.time() + self.default_reset_wait)
+            elif reset_time is not None:
+                if reset_time > self.reset_time:
+                    self.reset_time = reset_time
+                    self.remaining = remaining
+                elif reset_time == self.reset_time and self.remaining is not None:
+                    self.remaining = min(self.remaining, remaining)
+
+    def get_statistics(self):
+        """Return the count of requests made so far, and how many times a request had to wait."""
+        return self.request_count, self.wait_count
+
+
+class OktaUserFilter(object):
+    """
+    The all_users_filter, which is a Python expression about a user (such as 'user.status == "ACTIVE"'),
+    parsed and compiled once.  Only a safe subset of Python is allowed: comparisons, boolean operators,
+    literals, the attributes of the user (and of its attributes, such as user.profile.countryCode), and a
+    few string methods and builtins.
+    """
+
+    literal_types = tuple(getattr(ast, name) for name in ('Constant', 'Str', 'Bytes', 'Num', 'NameConstant')
+                          if hasattr(ast, name))
+    operator_types = (ast.And, ast.Or, ast.Not, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+                      ast.In, ast.NotIn, ast.Is, ast.IsNot)
+    container_types = (ast.Tuple, ast.List, ast.Set)
+    method_names = frozenset(['startswith', 'endswith', 'lower', 'upper', 'strip', 'split'])
+    builtins = {'len': len, 'str': six.text_type, 'int': int, 'True': True, 'False': False, 'None': None}
+
+    def __init__(self, filter_string):
+        """
+        :type filter_string: str
+        """
+        self.filter_string = filter_string
+        try:
+            tree = ast.parse(filter_string.strip(), mode='eval')
+        except SyntaxError:
             raise AssertionException("Invalid syntax in predicate (%s): cannot evaluate" % filter_string)
+        for node in ast.walk(tree.body):
+            self.check_node(node)
+        self.code = compile(tree, '<all_users_filter>', 'eval')
+        self.namespace = {'__builtins__': self.builtins}
+
+    def check_node(self, node):
+        """
+        :type node: ast.AST
+        """
+        if isinstance(node, ast.Name):
+            allowed = node.id == 'user' or node.id in self.builtins
+        elif isinstance(node, ast.Attribute):
+            allowed = not node.attr.startswith('_')
+        elif isinstance(node, ast.Call):
+            func = node.func
+            allowed = ((isinstance(func, ast.Name) and func.id in self.builtins) or
+                       (isinstance(func, ast.Attribute) and func.attr in self.method_names)) and \
+                not getattr(node, 'keywords', None) and \
+                not getattr(node, 'starargs', None) and not getattr(node, 'kwargs', None)
+        else:
+            allowed = isinstance(node, (ast.Expression, ast.BoolOp, ast.UnaryOp, ast.Compare, ast.Load) +
+                                 self.literal_types + self.operator_types + self.container_types)
+        if not allowed:
+            raise AssertionException("Predicate (%s) uses %s, which is not allowed" %
+                                     (self.filter_string, type(node).__name__))
+
+    def matches(self, user):
+        """
+        :type user: OktaRecord
+        :rtype bool
+        """
+        try:
+            return bool(eval(self.code, self.namespace, {'user': user}))
         except Exception as e:
-            raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+            raise AssertionException("Error filtering with predicate (%s): %s" % (self.filter_string, e))
+
+
+class OktaRecord(object):
+    """
+    An object read from the Okta API, with an attribute for each of its values (and a record of its own for
+    each value that is an object, such as a user's profile), as the Okta SDK's models have.  Attributes
+    that the object doesn't have are None, so filters and formats can refer to any profile attribute.
+    """
+
+    def __init__(self, values):
+        """
+        :type values: dict
+        """
+        for name, value in six.iteritems(values):
+            setattr(self, name, OktaRecord(value) if isinstance(value, dict) else value)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
 
 
 class OKTAValueFormatter(object):
@@ -332,6 +1036,7 @@ class OKTAValueFormatter(object):
             attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
         self.string_format = string_format
         self.attribute_names = attribute_names
+        self.make_value = self.compile(string_format, attribute_names)
 
     def get_attribute_names(self):
         """
@@ -354,19 +1059,45 @@ class OKTAValueFormatter(object):
         :type record: dict
         :rtype (unicode, unicode)
         """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_profile_value(record, attribute_name)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
+        values = {}
+        for attribute_name in self.attribute_names:
+            value = self.get_profile_value(record, attribute_name)
+            if value is None:
+                break
+            values[attribute_name] = value
+        return self.make_value(values)
+
+    @staticmethod
+    def compile(string_format, attribute_names):
+        """
+        Make the function that generates a value from the (non-empty) values of a user's profile attributes.
+        A format that is just one attribute gives that attribute's value as a string, without formatting.
+        :type string_format: unicode
+        :type attribute_names: list(unicode)
+        :return: a function from a dict of attribute values (by name) to the same pair as generate_value:
+        the value (None if an attribute is missing), and the missing attribute or else the last one used
+        """
+        if string_format is None:
+            return lambda values: (None, None)
+        attribute_names = tuple(attribute_names)
+        if not attribute_names:
+            return lambda values: (string_format.format(), None)
+        last_attribute_name = attribute_names[-1]
+        if list(string.Formatter().parse(string_format)) == [('', last_attribute_name, '', None)]:
+            def make_single_value(values):
+                value = values.get(last_attribute_name)
+                if value is not None and not isinstance(value, six.text_type):
+                    value = six.text_type(value)
+                return value, last_attribute_name
+            return make_single_value
+        format_value = string_format.format
+
+        def make_value(values):
+            for attribute_name in attribute_names:
+                if attribute_name not in values:
+                    return None, attribute_name
+            return format_value(**values), last_attribute_name
+        return make_value
 
     @classmethod
     def get_profile_value(cls, record, attribute_name):
@@ -383,3 +1114,42 @@ class OKTAValueFormatter(object):
                 except UnicodeError as e:
                     raise AssertionException("Encoding error in value of attribute '%s': %s" % (attribute_name, e))
         return None
+
+
+class OKTAValuePlan(object):
+    """
+    Generates the values of several formatters from each user at once.  The profile attributes the formatters
+    use are listed once, and each is read once per user, however many of the formatters use it.
+    """
+
+    def __init__(self, formatters):
+        """
+        :type formatters: list(OKTAValueFormatter)
+        """
+        attribute_names = []
+        for formatter in formatters:
+            for attribute_name in formatter.get_attribute_names():
+                if attribute_name not in attribute_names:
+                    attribute_names.append(attribute_name)
+        self.attribute_names = attribute_names
+        self.value_makers = [formatter.make_value for formatter in formatters]
+
+    def get_attribute_names(self):
+        """
+        :rtype list(str)
+        """
+        return self.attribute_names
+
+    def generate_values(self, record):
+        """
+        :type record: OktaRecord
+        :return: for each formatter, in order, what its generate_value would give for the user
+        :rtype list(tuple(unicode, unicode))
+        """
+        profile = record.profile
+        values = {}
+        for attribute_name in self.attribute_names:
+            value = getattr(profile, attribute_name, None)
+            if value:
+                values[attribute_name] = value
+        return [make_value(values) for make_value in self.value_makers]
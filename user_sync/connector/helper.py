@@ -33,17 +33,137 @@ def create_logger(options):
 
 def create_blank_user():
     """
-    :rtype dict
+    :rtype DirectoryUser
     """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    user = DirectoryUser()
+    user.identity_type = None
+    user.username = None
+    user.domain = None
+    user.firstname = None
+    user.lastname = None
+    user.email = None
+    user.groups = []
+    user.country = None
     return user
 
+
+class DirectoryUser(object):
+    """
+    A user read from a directory.  The fields are kept in slots, which takes a fraction of
+    the memory of a dict per user, but the user can be used just like a dict of those fields.
+    Fields that haven't been set behave like missing keys, and keys that aren't fields are
+    kept in a dict of their own (which is only created if needed).  Every key the connectors
+    set is a field, so that dict is only made for keys added by an after-mapping hook.
+    Most of the memory that remains per user is in the values themselves: the attribute
+    strings, and the source_attributes dict (which hooks are given as a dict).
+    """
+    __slots__ = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+                 'member_groups', 'source_attributes', 'uid', '_extra')
+
+    fields = __slots__[:-1]
+    field_set = frozenset(fields)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        try:
+            if key in self.field_set:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in self.field_set:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.field_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in self.fields:
+            if hasattr(self, field):
+                yield field
+        if self._extra:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, (DirectoryUser, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            items = other.items() if hasattr(other, 'items') else other
+            for key, value in items:
+                self[key] = value
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        return DirectoryUser(self)
+
+    def to_dict(self):
+        """
+        :rtype dict
+        """
+        return dict(self.items())
+
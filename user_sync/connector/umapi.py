@@ -18,11 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import email.utils
+import itertools
 import json
 import logging
+import random
+import threading
+import time
 # import helper
 
 import jwt
+import requests
+import requests.adapters
 import six
 import umapi_client
 from Crypto.PublicKey import RSA
@@ -42,6 +49,11 @@ except:
 
 
 class UmapiConnector(object):
+    # the number of users in each prefetched page, which matches the UMAPI server page size
+    prefetch_page_size = 200
+    # how often a prefetcher waiting for room in its queue checks whether it has been stopped
+    prefetch_poll_seconds = 0.5
+
     def __init__(self, name, caller_options):
         """
         :type name: str
@@ -62,8 +74,21 @@ class UmapiConnector(object):
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_int_value('max_workers', 1)
+        server_builder.set_int_value('prefetch_pages', 0)
+        server_builder.set_int_value('requests_per_second', 0)
+        server_builder.set_int_value('slow_response_seconds', 10)
         options['server'] = server_options = server_builder.get_options()
 
+        cache_config = caller_config.get_dict_config('user_cache', True)
+        if cache_config:
+            cache_builder = user_sync.config.OptionsBuilder(cache_config)
+            cache_builder.require_string_value('path')
+            cache_builder.set_int_value('full_refresh_hours', 24)
+            options['user_cache'] = cache_builder.get_options()
+        else:
+            options['user_cache'] = None
+
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = user_sync.config.OptionsBuilder(enterprise_config)
         enterprise_builder.require_string_value('org_id')
@@ -73,6 +98,8 @@ class UmapiConnector(object):
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         if server_config:
             server_config.report_unused_values(logger)
+        if cache_config:
+            cache_config.report_unused_values(logger)
         logger.debug('UMAPI initialized with options: %s', options)
 
         ims_host = server_options['ims_host']
@@ -113,24 +140,61 @@ class UmapiConnector(object):
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
+        # pace requests to this host with the limiter shared by every connector of the run that talks to it
+        self.rate_limiter = RateLimiter.get_limiter(server_options['host'], server_options['requests_per_second'],
+                                                    server_options['slow_response_seconds'], logger)
+        self.connection_options = {
+            'org_id': org_id,
+            'ims_host': ims_host,
+            'ims_endpoint_jwt': server_options['ims_endpoint_jwt'],
+            'user_management_endpoint': um_endpoint,
+            'test_mode': options['test_mode'],
+            'user_agent': "user-sync/" + app_version,
+            'logger': self.logger,
+            'timeout_seconds': float(server_options['timeout']),
+            # requests are retried by the RateLimitedAdapter, which waits for the rate limiter instead
+            'retry_max_attempts': 1,
+        }
         try:
-            self.connection = connection = umapi_client.Connection(
-                org_id=org_id,
-                auth_dict=auth_dict,
-                ims_host=ims_host,
-                ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
-                user_management_endpoint=um_endpoint,
-                test_mode=options['test_mode'],
-                user_agent="user-sync/" + app_version,
-                logger=self.logger,
-                timeout_seconds=float(server_options['timeout']),
-                retry_max_attempts=server_options['retries'] + 1,
-            )
+            self.connection = connection = self.make_connection(auth_dict=auth_dict)
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
-        # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        # wrap the connection in an action manager, whose workers each send batches on a connection of their own
+        self.action_manager = ActionManager(connection, org_id, logger, server_options['max_workers'],
+                                            connection_factory=self.make_worker_connection)
+        self.user_page_queue = None
+        self.prefetch_stopped = None
+        if options['user_cache']:
+            self.user_cache = UmapiUserCache(options['user_cache']['path'], org_id,
+                                             options['user_cache']['full_refresh_hours'], logger)
+        else:
+            self.user_cache = None
+
+    def make_connection(self, **auth):
+        """
+        :param auth: either auth_dict, to authorize a new connection, or auth, to share the authorization of another
+        :rtype umapi_client.Connection
+        """
+        connection_options = dict(self.connection_options)
+        connection_options.update(auth)
+        connection = umapi_client.Connection(**connection_options)
+        adapter = RateLimitedAdapter(self.rate_limiter, self.options['server']['retries'])
+        for scheme in ('https://', 'http://'):
+            connection.session.mount(scheme + self.options['server']['host'], adapter)
+        return connection
+
+    def make_worker_connection(self):
+        """
+        A umapi_client.Connection keeps a queue of unsent actions and counts of what it has sent, so it can't be
+        shared by threads: each action manager worker (and the user prefetcher) has a connection of its own, with
+        the same authorization.
+        :rtype umapi_client.Connection
+        """
+        try:
+            return self.make_connection(auth=self.connection.auth)
+        except Exception as e:
+            raise AssertionException("Connection to org %s failed: %s" % (self.org_id, e))
 
     def get_users(self):
         return list(self.iter_users())
@@ -138,7 +202,11 @@ class UmapiConnector(object):
     def iter_users(self):
         users = {}
         try:
-            for u in umapi_client.UsersQuery(self.connection):
+            if self.user_page_queue is not None:
+                user_iter = self.iter_prefetched_users()
+            else:
+                user_iter = umapi_client.UsersQuery(self.connection)
+            for u in user_iter:
                 email = u['email']
                 if not (email in users):
                     users[email] = u
@@ -146,6 +214,79 @@ class UmapiConnector(object):
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def prefetch_users(self):
+        """
+        If the prefetch_pages option is set, start reading users in a background thread, on a connection
+        of its own, so that the next call to iter_users is served from pages that have already been fetched.
+        At most prefetch_pages pages are held waiting to be consumed; if they won't be, call stop_prefetch.
+        """
+        max_pages = self.options['server']['prefetch_pages']
+        if max_pages <= 0 or self.user_page_queue is not None:
+            return
+        if self.user_cache is not None and self.user_cache.is_current():
+            # users will be read from the cache, not the server
+            return
+        # the main connection is used by other queries (and group creation) while users are being read
+        connection = self.make_worker_connection()
+        self.logger.debug('%s: prefetching users (up to %d pages ahead)', self.name, max_pages)
+        self.user_page_queue = six.moves.queue.Queue(max_pages)
+        self.prefetch_stopped = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_user_pages,
+                                   args=(connection, self.user_page_queue, self.prefetch_stopped),
+                                   name=self.name + '-users')
+        fetcher.daemon = True
+        fetcher.start()
+
+    def stop_prefetch(self):
+        """
+        Stop the reading of users started by prefetch_users, so that pages which won't be consumed don't leave
+        the background thread waiting for room in the queue.
+        """
+        if self.prefetch_stopped is not None:
+            self.prefetch_stopped.set()
+            self.prefetch_stopped = None
+            self.user_page_queue = None
+
+    def _fetch_user_pages(self, connection, page_queue, stopped):
+        """
+        Put pages (lists) of users on the queue, followed by None when all users have been read.
+        If the query fails, the exception is put on the queue in place of the remaining pages.
+        Once stopped is set, nothing more is read or put on the queue.
+        """
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    page_queue.put(item, timeout=self.prefetch_poll_seconds)
+                    return True
+                except six.moves.queue.Full:
+                    pass
+            return False
+
+        try:
+            page = []
+            for u in umapi_client.UsersQuery(connection):
+                page.append(u)
+                if len(page) >= self.prefetch_page_size:
+                    if not put(page):
+                        return
+                    page = []
+            if page and not put(page):
+                return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def iter_prefetched_users(self):
+        page_queue, self.user_page_queue = self.user_page_queue, None
+        while True:
+            page = page_queue.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            for u in page:
+                yield u
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -170,23 +311,226 @@ class UmapiConnector(object):
         if name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
-            return self.connection.execute_single(group)
+            return self.connection.execute_single(group, immediate=True)
 
     def get_action_manager(self):
         return self.action_manager
 
-    def send_commands(self, commands, callback=None):
+    def get_user_cache(self):
+        """
+        :rtype UmapiUserCache or None
+        """
+        return self.user_cache
+
+    def save_user_cache(self):
+        if self.user_cache is not None:
+            self.user_cache.save()
+
+    def send_commands(self, commands, callback=None, user_key=None):
         """
         :type commands: Commands
         :type callback: callable(dict)
+        :param user_key: key of the target user, used to keep the user cache (if any) up to date
         """
         if len(commands) > 0:
             action_manager = self.get_action_manager()
             action = action_manager.create_action(commands)
             if action is not None:
+                if user_key is not None and self.user_cache is not None and not self.options['test_mode']:
+                    callback = self.user_cache.make_callback(user_key, commands, callback)
                 action_manager.add_action(action, callback)
 
 
+class UmapiUserCache(object):
+    """
+    A file holding the users of an org (by user key) as of the last time they were all read from the server,
+    updated with every change that User Sync has successfully made to them since then.  As long as the last
+    full read is less than full_refresh_hours old, users are served from the cache instead of the server.
+    Changes made to the org by anyone else (such as in the Admin Console) are not seen until the next full read,
+    so the refresh interval bounds how stale the cache can be.
+    """
+    version = 1
+
+    def __init__(self, path, org_id, full_refresh_hours, logger):
+        """
+        :type path: str
+        :type org_id: str
+        :type full_refresh_hours: int
+        :type logger: logging.Logger
+        """
+        self.state_file = user_sync.helper.StateFile(path, logger)
+        self.org_id = org_id
+        self.max_age = full_refresh_hours * 3600
+        self.logger = logger
+        self.loaded = False
+        self.refreshed = None
+        self.user_by_key = None
+        self.cleared = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        state = self.state_file.load()
+        if not state:
+            return
+        if state.get('version') != self.version or state.get('org_id') != self.org_id:
+            self.logger.info("Ignoring user cache '%s': it is not a cache of this org", self.state_file.path)
+            return
+        self.refreshed = state.get('refreshed')
+        self.user_by_key = state.get('users')
+
+    def is_current(self):
+        """
+        :return: True if the cache holds a full read of the users that is recent enough to use
+        """
+        self.load()
+        return (self.user_by_key is not None and self.refreshed is not None and
+                time.time() - self.refreshed < self.max_age)
+
+    def iter_users(self):
+        """
+        Yield copies of the cached users, so callers are free to modify them.
+        """
+        self.logger.info("Reading users from cache (last refreshed from server %s)",
+                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.refreshed)))
+        for user in six.itervalues(self.user_by_key):
+            yield self.copy_user(user)
+
+    def start_refresh(self):
+        """
+        Start over with an empty cache, which is then filled with add_user as users are read from the server.
+        """
+        self.loaded = True
+        self.refreshed = time.time()
+        self.user_by_key = {}
+
+    def add_user(self, user_key, user):
+        """
+        :type user_key: str
+        :type user: dict
+        """
+        self.user_by_key[user_key] = self.copy_user(user)
+
+    def invalidate(self):
+        """
+        Force a full read of the users on the next run.  If the users weren't read in this run, so the cache
+        won't be saved, the cache file is emptied at once.
+        """
+        self.refreshed = None
+        if self.user_by_key is None and not self.cleared:
+            self.cleared = True
+            self.logger.debug("Emptying user cache '%s': users were changed without being read",
+                              self.state_file.path)
+            self.state_file.save({'version': self.version, 'org_id': self.org_id})
+
+    def make_callback(self, user_key, commands, callback=None):
+        """
+        :return: an action callback that applies the commands to the cache if they succeed, then calls callback
+        """
+        def apply_if_successful(result):
+            if result['is_success']:
+                self.apply_commands(user_key, commands)
+            else:
+                # we don't know which of the commands took effect
+                self.invalidate()
+            if callable(callback):
+                callback(result)
+        return apply_if_successful
+
+    def apply_commands(self, user_key, commands):
+        """
+        Make the same changes to the cached user that the commands made on the server.
+        :type user_key: str
+        :type commands: Commands
+        """
+        if self.user_by_key is None:
+            # users were never read in this run, so the cache can't be kept up to date
+            self.invalidate()
+            return
+        user = self.user_by_key.get(user_key)
+        for command_name, params in commands.do_list:
+            if command_name == 'create':
+                if user is None or params.get('on_conflict') == umapi_client.IfAlreadyExistsOptions.updateIfAlreadyExists:
+                    user = self.make_user(user_key, commands, user)
+                    self.update_user(user, params)
+                    self.user_by_key[user_key] = user
+            elif user is None:
+                continue
+            elif command_name == 'update':
+                if 'username' in params or ('email' in params and (user['type'] == 'adobeID' or not user['username'])):
+                    # the change affects the user key, which only the server can tell us about
+                    self.invalidate()
+                self.update_user(user, params)
+            elif command_name == 'add_to_groups':
+                current = {user_sync.helper.normalize_string(group) for group in user['groups']}
+                user['groups'] = user['groups'] + [group for group in params['groups']
+                                                   if user_sync.helper.normalize_string(group) not in current]
+            elif command_name == 'remove_from_groups':
+                if params.get('all_groups'):
+                    user['groups'] = []
+                else:
+                    removed = {user_sync.helper.normalize_string(group) for group in params['groups']}
+                    user['groups'] = [group for group in user['groups']
+                                      if user_sync.helper.normalize_string(group) not in removed]
+            elif command_name == 'remove_from_organization':
+                self.user_by_key.pop(user_key, None)
+                user = None
+
+    def save(self):
+        """
+        Write the cache, if users were read in this run.
+        """
+        if self.user_by_key is None:
+            return
+        self.logger.debug("Writing %d users to cache '%s'", len(self.user_by_key), self.state_file.path)
+        self.state_file.save({
+            'version': self.version,
+            'org_id': self.org_id,
+            'refreshed': self.refreshed,
+            'users': self.user_by_key,
+        })
+
+    @staticmethod
+    def make_user(user_key, commands, existing_user=None):
+        """
+        Make a cache entry for a newly created user.  The identity type, username and domain
+        are those in the user key, so the entry will produce the same key when read back.
+        """
+        id_type, username, domain = user_key.split(',')
+        email = commands.email or (username if '@' in username else None)
+        user = {
+            'email': email,
+            'status': 'active',
+            'username': username,
+            'domain': domain or (email.split('@')[-1] if email else ''),
+            'country': None,
+            'firstname': None,
+            'lastname': None,
+            'type': id_type,
+            'groups': [],
+        }
+        if existing_user:
+            user.update(existing_user)
+        return user
+
+    @staticmethod
+    def update_user(user, params):
+        for key, value in six.iteritems(params):
+            if key == 'first_name':
+                user['firstname'] = value
+            elif key == 'last_name':
+                user['lastname'] = value
+            elif key in ('email', 'username', 'country'):
+                user[key] = value
+
+    @staticmethod
+    def copy_user(user):
+        user = dict(user)
+        user['groups'] = list(user.get('groups') or [])
+        return user
+
+
 class Commands(object):
     def __init__(self, identity_type=None, email=None, username=None, domain=None):
         """
@@ -274,30 +618,242 @@ class Commands(object):
         return params
 
 
+class RateLimiter(object):
+    """
+    A token bucket that paces the requests made to one UMAPI host during a run, shared by every connection to
+    that host (so by the action managers and queries of the primary and all secondary orgs alike).
+
+    The rate adapts to the server: when a request is throttled (429, or 502-504), every caller waits out the
+    server's Retry-After advice and the rate is halved; while responses come back quickly, the rate creeps
+    back up (by about one request per second, every second) to the configured maximum.  Responses slower
+    than slow_response_seconds reduce the rate a little, since a struggling server throttles next.  With no
+    configured maximum, requests are not paced at all until the server first throttles them.
+    """
+    # limiters by host, shared by the connectors of the current run (see reset_limiters)
+    limiter_by_host = {}
+    limiter_lock = threading.Lock()
+
+    # the responses that mean the server is overloaded, and the request should be sent again later
+    throttle_codes = (429, 502, 503, 504)
+    min_rate = 0.5
+    default_retry_after = 5
+    # how far back the request rate is measured, when the server throttles requests that were not being paced
+    rate_window = 5.0
+
+    @classmethod
+    def get_limiter(cls, host, max_rate, slow_response_seconds, logger):
+        """
+        Return the run's limiter for a host, making it if this is the first connector to that host.
+        :type host: str
+        :param max_rate: highest allowed requests per second, or 0 for no limit
+        :param slow_response_seconds: responses that take longer than this slow the rate down (0 to ignore)
+        :type logger: logging.Logger
+        :rtype RateLimiter
+        """
+        with cls.limiter_lock:
+            limiter = cls.limiter_by_host.get(host)
+            if limiter is None:
+                cls.limiter_by_host[host] = limiter = cls(host, max_rate, slow_response_seconds, logger)
+            else:
+                limiter.add_limits(max_rate, slow_response_seconds)
+            return limiter
+
+    @classmethod
+    def reset_limiters(cls):
+        """
+        Forget the limiters of any earlier run, so that a new run starts pacing each host afresh.
+        """
+        with cls.limiter_lock:
+            cls.limiter_by_host.clear()
+
+    def __init__(self, host, max_rate, slow_response_seconds, logger):
+        """
+        :type host: str
+        :param max_rate: highest allowed requests per second, or 0 for no limit
+        :param slow_response_seconds: responses that take longer than this slow the rate down (0 to ignore)
+        :type logger: logging.Logger
+        """
+        self.host = host
+        self.max_rate = float(max_rate) if max_rate > 0 else None
+        self.slow_response_seconds = slow_response_seconds if slow_response_seconds > 0 else None
+        self.rate = self.max_rate
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.last_refill = time.time()
+        self.blocked_until = 0.0
+        self.request_times = []
+        self.request_count = 0
+        self.throttle_count = 0
+
+    def add_limits(self, max_rate, slow_response_seconds):
+        """
+        Apply the limits configured for another connector to the same host, keeping the stricter of each.
+        """
+        with self.lock:
+            if max_rate > 0 and (self.max_rate is None or max_rate < self.max_rate):
+                self.max_rate = float(max_rate)
+                self.rate = min(self.rate or self.max_rate, self.max_rate)
+            if slow_response_seconds > 0 and (self.slow_response_seconds is None or
+                                              slow_response_seconds < self.slow_response_seconds):
+                self.slow_response_seconds = slow_response_seconds
+
+    def acquire(self):
+        """
+        Wait until a request may be made.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate is None:
+                    wait = 0
+                else:
+                    self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, max(self.rate, 1.0))
+                    self.last_refill = now
+                    wait = 0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+                    if not wait:
+                        self.tokens -= 1.0
+                if not wait:
+                    self.request_count += 1
+                    if self.rate is None:
+                        self.request_times.append(now)
+                        while now - self.request_times[0] > self.rate_window:
+                            self.request_times.pop(0)
+                    return
+            time.sleep(wait)
+
+    def record_response(self, status_code, retry_after, seconds):
+        """
+        Adapt the rate to the outcome of a request.
+        :type status_code: int
+        :param retry_after: the value of the response's Retry-After header, if any
+        :param seconds: how long the server took to respond
+        """
+        with self.lock:
+            now = time.time()
+            if status_code in self.throttle_codes:
+                self.throttle_count += 1
+                wait = self.parse_retry_after(retry_after, now)
+                if now + wait > self.blocked_until:
+                    self.blocked_until = now + wait
+                    # one request may go as soon as the wait is over, and the rest are paced from then on
+                    self.tokens = 1.0
+                    self.last_refill = self.blocked_until
+                    if self.rate is None:
+                        self.rate = max(len(self.request_times) / self.rate_window, self.min_rate * 2)
+                    self.rate = max(self.rate / 2, self.min_rate)
+                    self.logger.info('Server %s is throttling requests: waiting %d seconds, '
+                                     'then sending at most %.1f requests per second', self.host, wait, self.rate)
+            elif self.rate is not None:
+                if self.slow_response_seconds and seconds > self.slow_response_seconds:
+                    self.rate = max(self.rate * 0.9, self.min_rate)
+                elif self.max_rate is None or self.rate < self.max_rate:
+                    self.rate += 1.0 / self.rate
+                    if self.max_rate is not None:
+                        self.rate = min(self.rate, self.max_rate)
+
+    def parse_retry_after(self, retry_after, now):
+        if retry_after:
+            parsed = email.utils.parsedate_tz(retry_after)
+            try:
+                wait = email.utils.mktime_tz(parsed) - now if parsed else float(retry_after)
+                return max(wait, 0)
+            except (ValueError, OverflowError):
+                pass
+        return self.default_retry_after
+
+    def get_statistics(self):
+        """Return the count of requests made so far, and how many were throttled."""
+        return self.request_count, self.throttle_count
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends each request through a rate limiter, and tells the limiter how the server responded.  A request
+    that is throttled (see RateLimiter.throttle_codes), or that fails to connect or times out, is sent again
+    (up to retries more times): after a throttled request, the limiter waits out the server's Retry-After
+    advice, and after a failed one, the wait grows exponentially.  The connections this is mounted on don't
+    retry requests themselves, so each wait happens only once.
+    """
+    retry_first_delay = 15
+    retry_random_delay = 5
+
+    def __init__(self, rate_limiter, retries=0, **kwargs):
+        """
+        :type rate_limiter: RateLimiter
+        :param retries: how many times a request may be sent again
+        """
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        logger = self.rate_limiter.logger
+        for attempt in range(1, self.retries + 2):
+            self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt > self.retries:
+                    raise
+                wait = 2 ** (attempt - 1) * self.retry_first_delay + random.randint(0, self.retry_random_delay)
+                logger.warning('UMAPI request failed on try %d (%s), waiting %d seconds to retry', attempt, e, wait)
+                time.sleep(wait)
+                continue
+            self.rate_limiter.record_response(response.status_code, response.headers.get('Retry-After'),
+                                              time.time() - start)
+            if response.status_code not in self.rate_limiter.throttle_codes or attempt > self.retries:
+                return response
+            logger.warning('UMAPI request throttled (code %d on try %d), retrying', response.status_code, attempt)
+            response.close()
+
+
 class ActionManager(object):
-    next_request_id = 1
+    # shared by the action managers of every connector, which may be creating actions on different threads
+    request_ids = itertools.count(1)
+
+    # the largest number of actions the UMAPI server accepts in a single call
+    batch_size = 10
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, max_workers=1, connection_factory=None):
         """
+        Actions are collected into batches, and each full batch is handed to a pool of
+        worker threads which send it while the caller goes on to compute further actions.
+        At most max_workers batches are being sent (and max_workers more are waiting)
+        at any one time.  The results of sent batches (error logging, statistics, callbacks)
+        are always processed on the caller's thread.
+        Each worker sends its batches on a connection of its own, made by connection_factory.
+        Without a factory, the workers take turns with the given connection, which must then
+        not be used by anything else while batches are in flight.
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type max_workers: int
+        :type connection_factory: callable() -> umapi_client.Connection
         """
         self.action_count = 0
         self.error_count = 0
         self.items = []
         self.connection = connection
+        self.connection_factory = connection_factory
+        self.connection_lock = threading.Lock()
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        self.max_workers = max(max_workers, 1)
+        self.workers = []
+        self.batches_in_flight = 0
+        self.batch_queue = six.moves.queue.Queue(self.max_workers)
+        self.result_queue = six.moves.queue.Queue()
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
         return self.action_count, self.error_count
 
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
-        return request_id
+        return 'action_%d' % next(ActionManager.request_ids)
 
     def create_action(self, commands):
         identity_type = commands.identity_type
@@ -339,44 +895,93 @@ class ActionManager(object):
         self.items.append(item)
         self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if len(self.items) >= self.batch_size:
+            self._submit_batch()
+        self._process_results(wait=False)
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.items) > 0 or self.batches_in_flight > 0
 
-    def _execute_action(self, action):
+    def flush(self):
         """
-        :type action: umapi_client.UserAction
+        Send any actions that are still queued, and wait for every batch in flight to complete.
         """
-        try:
-            _, sent, _ = self.connection.execute_single(action)
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+        while self.items:
+            self._submit_batch()
+        self._process_results(wait=True)
 
-    def flush(self):
+    def _submit_batch(self):
+        """
+        Hand the next batch of queued items to the workers.  This blocks if the workers are busy
+        and max_workers batches are already waiting, so the number of unsent actions stays bounded.
+        """
+        batch, self.items = self.items[:self.batch_size], self.items[self.batch_size:]
+        if not batch:
+            return
+        if not self.workers:
+            for i in range(self.max_workers):
+                worker = threading.Thread(target=self._run_worker, name='%s-%d' % (self.logger.name, i + 1))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.batches_in_flight += 1
+        # each batch's result goes to the queue that was current when it was submitted
+        self.batch_queue.put((batch, self.result_queue))
+
+    def _run_worker(self):
+        connection = None
+        while True:
+            batch, result_queue = self.batch_queue.get()
+            actions = [item['action'] for item in batch]
+            try:
+                if self.connection_factory is None:
+                    with self.connection_lock:
+                        self.connection.execute_multiple(actions, immediate=True)
+                else:
+                    if connection is None:
+                        connection = self.connection_factory()
+                    connection.execute_multiple(actions, immediate=True)
+            except Exception as e:
+                result_queue.put((batch, e))
+            else:
+                result_queue.put((batch, None))
+            self.batch_queue.task_done()
+
+    def _process_results(self, wait):
+        """
+        Process the results of completed batches.  If processing them raises an error, the results of
+        the batches still in flight are not waited for: they are dropped when they arrive.
+        :param wait: if True, wait for all batches in flight to complete; otherwise process only those already done
+        """
+        processed = False
         try:
-            _, sent, _ = self.connection.execute_queued()
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
-
-    def process_sent_items(self, total_sent, batch_error=None):
+            while self.batches_in_flight > 0:
+                try:
+                    batch, error = self.result_queue.get(wait)
+                except six.moves.queue.Empty:
+                    break
+                self.batches_in_flight -= 1
+                if error is None:
+                    self.process_sent_items(batch)
+                elif isinstance(error, umapi_client.BatchError):
+                    self.process_sent_items(batch, error)
+                elif isinstance(error, umapi_client.UnavailableError):
+                    raise AssertionException("Error contacting UMAPI server: %s" % error)
+                else:
+                    raise error
+            processed = True
+        finally:
+            if not processed:
+                self.batches_in_flight = 0
+                self.result_queue = six.moves.queue.Queue()
+
+    def process_sent_items(self, sent_items, batch_error=None):
         """
-        Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
+        Log any processing errors for sent items, and invoke any callbacks
+        :param sent_items: the items (dicts with action and callback) that were sent in a batch
         :param batch_error: exception for a batch-level error that affected all items, if there was one
         :return: 
         """
-        # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
-
         # collect sent actions, their errors, their callbacks
         details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
 
@@ -384,7 +989,7 @@ class ActionManager(object):
         if batch_error:
             request_ids = str([action.frame.get("requestID") for action, _, _ in details])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
+            self.error_count += len(sent_items)
         else:
             for action, errors, _ in details:
                 if errors:
@@ -20,6 +20,7 @@
 
 import csv
 import datetime
+import json
 import os
 import sys
 
@@ -150,6 +151,58 @@ class CSVAdapter:
                 writer.writerow(row)
 
 
+class StateFile(object):
+    """
+    Read and write a JSON file holding state that is kept from one run to the next, such as a cache.
+    A missing or unreadable file is treated as having no state, so the caller just starts over.
+    """
+    def __init__(self, path, logger):
+        """
+        :type path: str
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.logger = logger
+
+    def load(self):
+        """
+        :rtype dict or None
+        """
+        if not os.path.isfile(self.path):
+            self.logger.debug("No state file found at '%s'", self.path)
+            return None
+        try:
+            with open(self.path, 'r') as input_file:
+                state = json.load(input_file)
+        except (IOError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable state file '%s': %s", self.path, e)
+            return None
+        if not isinstance(state, dict):
+            self.logger.warning("Ignoring state file '%s': unexpected content", self.path)
+            return None
+        return state
+
+    def save(self, state):
+        """
+        Write the state to a temporary file and then move it into place,
+        so an interrupted run never leaves a partially-written file behind.
+        :type state: dict
+        """
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as output_file:
+                json.dump(state, output_file)
+            if is_py2():
+                # py2 has no atomic replace, and rename fails on Windows if the target exists
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(temp_path, self.path)
+            else:
+                os.replace(temp_path, self.path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't write state file '%s': %s" % (self.path, e))
+
+
 class JobStats:
     line_left_count = 10
     line_width = 60
@@ -22,6 +22,8 @@
 import logging
 import six
 import re
+import sys
+import threading
 
 import user_sync.connector.umapi
 import user_sync.error
@@ -49,6 +51,7 @@ class RuleProcessor(object):
         'extended_attributes': None,
         'process_groups': False,
         'max_adobe_only_users': 200,
+        'max_secondary_workers': 1,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
         'remove_strays': False,
         'strategy': 'sync',
@@ -109,6 +112,9 @@ class RuleProcessor(object):
         self.primary_users_created = set()
         self.secondary_users_created = set()
         self.updated_user_keys = set()
+        # secondary umapis may be processed concurrently, so the counters, user key sets, stray map and
+        # email overrides they share are only written under this lock
+        self.shared_state_lock = threading.Lock()
 
         # stray key input path comes in, stray_list_output_path goes out
         self.stray_key_map = self.make_stray_key_map()
@@ -172,6 +178,9 @@ class RuleProcessor(object):
 
         self.prepare_umapi_infos()
 
+        if directory_connector is not None and not self.push_umapi:
+            self.prefetch_umapi_users(umapi_connectors)
+
         if directory_connector is not None:
             load_directory_stats = JobStats("Load from Directory", divider="-")
             load_directory_stats.log_start(logger)
@@ -189,12 +198,28 @@ class RuleProcessor(object):
             if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
                 self.create_umapi_groups(umapi_connectors)
             self.sync_umapi_users(umapi_connectors)
+            # users prefetched for an org that turned out to have nothing to sync are no longer wanted
+            umapi_connectors.stop_prefetching()
         if self.will_process_strays:
             self.process_strays(umapi_connectors)
         umapi_connectors.execute_actions()
+        umapi_connectors.save_user_caches()
         umapi_stats.log_end(logger)
         self.log_action_summary(umapi_connectors)
 
+    def prefetch_umapi_users(self, umapi_connectors):
+        """
+        Let the umapi connectors start reading their users while we load the directory.
+        Secondary umapis are only read if they have mapped groups (or could get them
+        from additional group rules), because otherwise they won't be synced.
+        :type umapi_connectors: UmapiConnectors
+        """
+        umapi_connectors.get_primary_connector().prefetch_users()
+        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+            umapi_info = self.umapi_info_by_name.get(umapi_name)
+            if self.options.get('additional_groups') or (umapi_info and umapi_info.get_mapped_groups()):
+                umapi_connector.prefetch_users()
+
     def validate_and_log_additional_groups(self, umapi_info):
         """
         :param umapi_info: UmapiTargetInfo
@@ -339,6 +364,9 @@ class RuleProcessor(object):
 
     def read_desired_user_groups(self, mappings, directory_connector):
         """
+        Directory users are mapped one by one as the connector yields them, so users from a connector that
+        streams them (such as LDAP, when no group searches are needed) are mapped while the rest are still
+        being read.
         :type mappings: dict(str, list(AdobeGroup))
         :type directory_connector: user_sync.connector.directory.DirectoryConnector
         """
@@ -349,6 +377,9 @@ class RuleProcessor(object):
         if directory_group_filter is not None:
             directory_group_filter = set(directory_group_filter)
         extended_attributes = options.get('extended_attributes')
+        after_mapping_hook = options['after_mapping_hook']
+        additional_groups = options.get('additional_groups', [])
+        primary_umapi_info = self.get_umapi_info(PRIMARY_UMAPI_NAME)
 
         directory_user_by_user_key = self.directory_user_by_user_key
         filtered_directory_user_by_user_key = self.filtered_directory_user_by_user_key
@@ -373,7 +404,7 @@ class RuleProcessor(object):
                 continue
 
             filtered_directory_user_by_user_key[user_key] = directory_user
-            self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
+            primary_umapi_info.add_desired_group_for(user_key, None)
 
             # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
             self.after_mapping_hook_scope['source_groups'] = set()
@@ -386,7 +417,7 @@ class RuleProcessor(object):
                         self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
 
             # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
+            if after_mapping_hook is not None:
                 self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
 
                 target_attributes = dict()
@@ -400,7 +431,7 @@ class RuleProcessor(object):
 
                 # invoke the customer's hook code
                 self.log_after_mapping_hook_scope(before_call=True)
-                exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
+                exec(after_mapping_hook, self.after_mapping_hook_scope)
                 self.log_after_mapping_hook_scope(after_call=True)
 
                 # copy modified attributes back to the user object
@@ -414,7 +445,6 @@ class RuleProcessor(object):
                 else:
                     self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
 
-            additional_groups = self.options.get('additional_groups', [])
             member_groups = directory_user.get('member_groups', [])
             for member_group in member_groups:
                 for group_rule in additional_groups:
@@ -479,25 +509,75 @@ class RuleProcessor(object):
             self.primary_users_created.add(user_key)
             self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
 
-        # then sync the secondary connectors
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
-            umapi_info = self.get_umapi_info(umapi_name)
-            if len(umapi_info.get_mapped_groups()) == 0:
-                continue
-            self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
-            if self.push_umapi:
-                secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
-            else:
-                secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
-            for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
-                # We only create users who have group mappings in the secondary umapi
-                if groups_to_add:
-                    self.logger.info('Adding user to umapi %s with user key: %s', umapi_name, user_key)
+        # then sync the secondary connectors, once the users created in the primary actually exist
+        if umapi_connectors.get_secondary_connectors():
+            umapi_connector.get_action_manager().flush()
+        self.for_each_secondary(umapi_connectors, self.sync_secondary_umapi_users)
+
+    def sync_secondary_umapi_users(self, umapi_name, umapi_connector):
+        """
+        Sync the directory users against the users of one secondary umapi connector.
+        This requires that the primary umapi has already been synced.
+        :type umapi_name: str
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        """
+        umapi_info = self.get_umapi_info(umapi_name)
+        if len(umapi_info.get_mapped_groups()) == 0:
+            return
+        self.logger.debug('%sing users to secondary umapi %s...', "Push" if self.push_umapi else "Sync", umapi_name)
+        if self.push_umapi:
+            secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+        else:
+            secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+        for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
+            # We only create users who have group mappings in the secondary umapi
+            if groups_to_add:
+                self.logger.info('Adding user to umapi %s with user key: %s', umapi_name, user_key)
+                with self.shared_state_lock:
                     self.secondary_users_created.add(user_key)
                     if user_key not in self.primary_users_created:
                         # We pushed an existing user to a secondary in order to update his groups
                         self.updated_user_keys.add(user_key)
-                    self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+                self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+        umapi_connector.get_action_manager().flush()
+
+    def for_each_secondary(self, umapi_connectors, work):
+        """
+        Call work(umapi_name, umapi_connector) for each secondary umapi connector, with up to
+        max_secondary_workers of the calls running at the same time.  Returns when all calls are done;
+        if any of them raised an exception, the first such exception is re-raised.
+        :type umapi_connectors: UmapiConnectors
+        :type work: callable(str, user_sync.connector.umapi.UmapiConnector)
+        """
+        secondaries = list(six.iteritems(umapi_connectors.get_secondary_connectors()))
+        worker_count = min(self.options['max_secondary_workers'], len(secondaries))
+        if worker_count <= 1:
+            for umapi_name, umapi_connector in secondaries:
+                work(umapi_name, umapi_connector)
+            return
+        pending = six.moves.queue.Queue()
+        for secondary in secondaries:
+            pending.put(secondary)
+        errors = []
+
+        def run_worker():
+            while not errors:
+                try:
+                    umapi_name, umapi_connector = pending.get_nowait()
+                except six.moves.queue.Empty:
+                    return
+                try:
+                    work(umapi_name, umapi_connector)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        workers = [threading.Thread(target=run_worker, name='secondary-%d' % (i + 1)) for i in range(worker_count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            six.reraise(*errors[0])
 
     def create_umapi_groups(self, umapi_connectors):
         """
@@ -565,11 +645,12 @@ class RuleProcessor(object):
         :param user_key: user_key (str) from a user in that connector
         :param removed_groups: a set of adobe_groups to be removed from the user in that umapi
         """
-        if user_key is None:
-            if umapi_name not in self.stray_key_map:
-                self.stray_key_map[umapi_name] = {}
-        else:
-            self.stray_key_map[umapi_name][user_key] = removed_groups
+        with self.shared_state_lock:
+            if user_key is None:
+                if umapi_name not in self.stray_key_map:
+                    self.stray_key_map[umapi_name] = {}
+            else:
+                self.stray_key_map[umapi_name][user_key] = removed_groups
 
     def process_strays(self, umapi_connectors):
         """
@@ -625,8 +706,8 @@ class RuleProcessor(object):
                 username = self.email_override[username]
             return user_sync.connector.umapi.Commands(identity_type=id_type, username=username, domain=domain)
 
-        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+        def manage_secondary_strays(umapi_name, umapi_connector):
+            """Manage the primary strays that are also strays in the given secondary umapi"""
             secondary_strays = self.get_stray_keys(umapi_name)
             for user_key in primary_strays:
                 if user_key in secondary_strays:
@@ -650,10 +731,14 @@ class RuleProcessor(object):
                     else:
                         # haven't done anything, don't send commands
                         continue
-                    umapi_connector.send_commands(commands)
-            # make sure the commands for each umapi are executed before moving to the next
+                    umapi_connector.send_commands(commands, user_key=user_key)
+            # make sure the commands for each umapi are executed before we return
             umapi_connector.get_action_manager().flush()
 
+        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end;
+        # this doesn't return until all the secondary commands have been executed
+        self.for_each_secondary(umapi_connectors, manage_secondary_strays)
+
         # finish with the primary umapi
         primary_connector = umapi_connectors.get_primary_connector()
         for user_key in primary_strays:
@@ -675,7 +760,7 @@ class RuleProcessor(object):
             else:
                 # haven't done anything, don't send commands
                 continue
-            primary_connector.send_commands(commands)
+            primary_connector.send_commands(commands, user_key=user_key)
         # make sure the actions get sent
         primary_connector.get_action_manager().flush()
 
@@ -767,7 +852,7 @@ class RuleProcessor(object):
                 groups_to_remove = umapi_info.get_mapped_groups() - groups_to_add
                 commands.remove_groups(groups_to_remove)
             commands.add_groups(groups_to_add)
-        umapi_connector.send_commands(commands)
+        umapi_connector.send_commands(commands, user_key=user_key)
 
     def update_umapi_user(self, umapi_info, user_key, umapi_connector,
                           attributes_to_update=None, groups_to_add=None, groups_to_remove=None,
@@ -786,7 +871,8 @@ class RuleProcessor(object):
         :type umapi_user: dict # with type, username, domain, and email entries
         """
         if attributes_to_update or groups_to_add or groups_to_remove:
-            self.updated_user_keys.add(user_key)
+            with self.shared_state_lock:
+                self.updated_user_keys.add(user_key)
         if attributes_to_update:
             self.logger.info('Updating info for user key: %s changes: %s', user_key, attributes_to_update)
         if groups_to_add or groups_to_remove:
@@ -819,7 +905,7 @@ class RuleProcessor(object):
         commands.update_user(attributes_to_update)
         commands.remove_groups(groups_to_remove)
         commands.add_groups(groups_to_add)
-        umapi_connector.send_commands(commands)
+        umapi_connector.send_commands(commands, user_key=user_key)
 
     def update_umapi_users_for_connector(self, umapi_info, umapi_connector):
         """
@@ -838,29 +924,45 @@ class RuleProcessor(object):
         # the way we construct the return vaue is to start with a map from all directory users
         # to their groups in this umapi, make a copy, and pop off any adobe users we find.
         # That way, any key/value pairs left in the map are the unmatched adobe users and their groups.
-        user_to_group_map = umapi_info.get_desired_groups_by_user_key()
-        user_to_group_map = {} if user_to_group_map is None else user_to_group_map.copy()
+        # Groups are compared as bitsets (see UmapiTargetInfo.get_group_bits).
+        user_to_group_map = umapi_info.get_desired_group_bits_by_user_key().copy()
 
         # compute all static options before looping over users
         in_primary_org = self.is_primary_org(umapi_info)
         update_user_info = self.will_update_user_info(umapi_info)
         process_groups = self.will_process_groups()
+        mapped_group_bits = umapi_info.get_mapped_group_bits()
+        exclude_group_bits = umapi_info.get_group_bits(self.exclude_groups, add_new=True) if in_primary_org else 0
 
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
+        # read the adobe users from the cache if it's recent enough, otherwise from the server
+        # (in which case we refill the cache as we go)
+        user_cache = umapi_connector.get_user_cache()
+        if user_cache is not None and user_cache.is_current():
+            umapi_users = user_cache.iter_users()
+            refill_cache = False
+        else:
+            umapi_users = umapi_connector.iter_users()
+            refill_cache = user_cache is not None
+            if refill_cache:
+                user_cache.start_refresh()
+
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
-        for umapi_user in umapi_connector.iter_users():
+        for umapi_user in umapi_users:
             # get the basic data about this user; initialize change markers to "no change"
             user_key = self.get_umapi_user_key(umapi_user)
             if not user_key:
                 self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
                 continue
+            if refill_cache:
+                user_cache.add_user(user_key, umapi_user)
             umapi_info.add_umapi_user(user_key, umapi_user)
             attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
+            current_group_bits = umapi_info.get_group_bits(umapi_user.get('groups'))
             groups_to_add = set()
             groups_to_remove = set()
 
@@ -868,10 +970,10 @@ class RuleProcessor(object):
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
+            desired_group_bits = user_to_group_map.pop(user_key, None) or 0
 
             # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
+            if self.is_umapi_user_excluded(in_primary_org, user_key, current_group_bits, exclude_group_bits):
                 continue
 
             self.map_email_override(umapi_user)
@@ -883,11 +985,13 @@ class RuleProcessor(object):
                 # for removal from any mapped groups.
                 if self.exclude_strays:
                     self.logger.debug("Excluding Adobe-only user: %s", user_key)
-                    self.excluded_user_count += 1
+                    with self.shared_state_lock:
+                        self.excluded_user_count += 1
                 elif self.will_process_strays:
                     self.logger.debug("Found Adobe-only user: %s", user_key)
                     self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
+                                   None if not process_groups else
+                                   umapi_info.get_group_names(current_group_bits & mapped_group_bits))
             else:
                 # There is a selected directory user who matches this adobe user,
                 # so mark any changed umapi attributes,
@@ -897,8 +1001,9 @@ class RuleProcessor(object):
                 if update_user_info:
                     attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
                 if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
+                    groups_to_add = umapi_info.get_group_names(desired_group_bits & ~current_group_bits)
+                    groups_to_remove = umapi_info.get_group_names(current_group_bits & ~desired_group_bits &
+                                                                  mapped_group_bits)
 
             # Finally, execute the attribute and group adjustments
             self.update_umapi_user(umapi_info, user_key, umapi_connector,
@@ -906,7 +1011,8 @@ class RuleProcessor(object):
 
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
-        return user_to_group_map
+        return dict((user_key, umapi_info.get_group_names(group_bits))
+                    for user_key, group_bits in six.iteritems(user_to_group_map))
 
     def map_email_override(self, umapi_user):
         """
@@ -918,9 +1024,17 @@ class RuleProcessor(object):
         email = umapi_user.get('email', '')
         username = umapi_user.get('username', '')
         if '@' in username and username != email:
-            self.email_override[username] = email
+            with self.shared_state_lock:
+                self.email_override[username] = email
 
-    def is_umapi_user_excluded(self, in_primary_org, user_key, current_groups):
+    def is_umapi_user_excluded(self, in_primary_org, user_key, current_group_bits, exclude_group_bits):
+        """
+        :type in_primary_org: bool
+        :type user_key: str
+        :param current_group_bits: the user's groups, as bits from the umapi's UmapiTargetInfo.get_group_bits
+        :param exclude_group_bits: the exclude_groups, as bits from the same UmapiTargetInfo
+        :rtype bool
+        """
         if in_primary_org:
             self.primary_user_count += 1
             # in the primary umapi, we actually check the exclusion conditions
@@ -929,7 +1043,7 @@ class RuleProcessor(object):
                 self.logger.debug("Excluding adobe user (due to type): %s", user_key)
                 self.excluded_user_count += 1
                 return True
-            if len(current_groups & self.exclude_groups) > 0:
+            if current_group_bits & exclude_group_bits:
                 self.logger.debug("Excluding adobe user (due to group): %s", user_key)
                 self.excluded_user_count += 1
                 return True
@@ -1180,6 +1294,14 @@ class UmapiConnectors(object):
     def get_secondary_connectors(self):
         return self.secondary_connectors
 
+    def save_user_caches(self):
+        for connector in self.connectors:
+            connector.save_user_cache()
+
+    def stop_prefetching(self):
+        for connector in self.connectors:
+            connector.stop_prefetch()
+
     def execute_actions(self):
         while True:
             had_work = False
@@ -1270,7 +1392,12 @@ class UmapiTargetInfo(object):
         self.name = name
         self.mapped_groups = set()
         self.non_normalize_mapped_groups = set()
-        self.desired_groups_by_user_key = {}
+        # each group we know about is numbered, so sets of groups can be held as bitsets (ints)
+        self.group_names = []
+        self.group_id_by_name = {}
+        self.group_id_by_raw_name = {}
+        self.mapped_group_bits = 0
+        self.desired_group_bits_by_user_key = {}
         self.umapi_user_by_user_key = {}
         self.umapi_users_loaded = False
         self.stray_by_user_key = {}
@@ -1291,6 +1418,7 @@ class UmapiTargetInfo(object):
         normalized_group_name = normalize_string(group)
         self.mapped_groups.add(normalized_group_name)
         self.non_normalize_mapped_groups.add(group)
+        self.mapped_group_bits |= self.get_group_bits([normalized_group_name], add_new=True)
 
     def add_additional_group(self, rename_group, member_group):
         normalized_rename_group = normalize_string(rename_group)
@@ -1306,27 +1434,74 @@ class UmapiTargetInfo(object):
     def get_non_normalize_mapped_groups(self):
         return self.non_normalize_mapped_groups
 
+    def get_mapped_group_bits(self):
+        return self.mapped_group_bits
+
+    def get_group_bits(self, group_names, add_new=False):
+        """
+        Convert a collection of group names to a bitset, with one bit for each group.
+        Groups that have no number yet are numbered if add_new is True, and otherwise left out:
+        they can't be in any of the other bitsets, so leaving them out doesn't change any comparison.
+        :type group_names: iterable(str) or None
+        :type add_new: bool
+        :rtype int
+        """
+        bits = 0
+        if group_names:
+            group_id_by_raw_name = self.group_id_by_raw_name
+            for group_name in group_names:
+                # most names are seen over and over, so remember their ids (or -1 if unknown) as given
+                group_id = group_id_by_raw_name.get(group_name)
+                if group_id is None:
+                    normalized_group_name = normalize_string(group_name)
+                    group_id = self.group_id_by_name.get(normalized_group_name, -1)
+                    if group_id < 0 and add_new:
+                        group_id = len(self.group_names)
+                        self.group_names.append(normalized_group_name)
+                        self.group_id_by_name[normalized_group_name] = group_id
+                        # forget the names remembered as unknown
+                        group_id_by_raw_name.clear()
+                    group_id_by_raw_name[group_name] = group_id
+                if group_id >= 0:
+                    bits |= 1 << group_id
+        return bits
+
+    def get_group_names(self, group_bits):
+        """
+        Convert a bitset from get_group_bits back to a set of (normalized) group names.
+        :type group_bits: int
+        :rtype set(str)
+        """
+        names = set()
+        while group_bits:
+            lowest_bit = group_bits & -group_bits
+            names.add(self.group_names[lowest_bit.bit_length() - 1])
+            group_bits ^= lowest_bit
+        return names
+
+    def get_desired_group_bits_by_user_key(self):
+        return self.desired_group_bits_by_user_key
+
     def get_desired_groups_by_user_key(self):
-        return self.desired_groups_by_user_key
+        return dict((user_key, self.get_group_names(group_bits))
+                    for user_key, group_bits in six.iteritems(self.desired_group_bits_by_user_key))
 
     def get_desired_groups(self, user_key):
         """
         :type user_key: str
         """
-        desired_groups = self.desired_groups_by_user_key.get(user_key)
-        return desired_groups
+        group_bits = self.desired_group_bits_by_user_key.get(user_key)
+        return None if group_bits is None else self.get_group_names(group_bits)
 
     def add_desired_group_for(self, user_key, group):
         """
         :type user_key: str
         :type group: Optional(str)
         """
-        desired_groups = self.get_desired_groups(user_key)
-        if desired_groups is None:
-            self.desired_groups_by_user_key[user_key] = desired_groups = set()
+        group_bits = self.desired_group_bits_by_user_key.get(user_key, 0)
         if group is not None:
-            normalized_group_name = normalize_string(group)
-            desired_groups.add(normalized_group_name)
+            group_bits |= self.get_group_bits([group], add_new=True)
+        self.desired_group_bits_by_user_key[user_key] = group_bits
 
     def add_umapi_user(self, user_key, user):
         """